@@ -0,0 +1,230 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from uuid import uuid4
+import hashlib
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, the development server runs a single process anyway
+    fcntl = None
+
+LOCK_FILE_NAME = '.lock'
+
+# a temporary file which hasn't been written for this long was left by a process which died while building it
+STALE_TMP_SECONDS = 3600
+
+class CachingStream(object):
+    """Yields the chunks of an archive while writing them to a temporary file.
+
+    The file becomes the cached archive once every chunk is written. If the stream fails or is closed
+    before the end, the file is removed and the archive is built again by the next request.
+    """
+
+    def __init__(self, cache, key, building, chunks):
+        self._cache = cache
+        self._key = key
+        self._building = building
+        self._chunks = chunks
+        self._iterator = iter(chunks)
+        self._tmp_path = '{}.{}.tmp'.format(cache._path(key), uuid4().hex)
+        self._file = open(self._tmp_path, 'wb')
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._iterator)
+        except StopIteration:
+            self._finish()
+            raise
+        except Exception:
+            self.close()
+            raise
+        self._file.write(chunk)
+        return chunk
+
+    def _finish(self):
+        self._done = True
+        try:
+            self._file.close()
+            self._cache._add(self._key, self._tmp_path)
+        except OSError:
+            # the archive was sent in full, it's only not cached
+            if os.path.exists(self._tmp_path):
+                os.remove(self._tmp_path)
+        finally:
+            self._cache._release(self._key, self._building)
+
+    def close(self):
+        if self._done:
+            return
+        self._done = True
+        try:
+            self._file.close()
+            os.remove(self._tmp_path)
+            if hasattr(self._chunks, 'close'):
+                self._chunks.close()
+        finally:
+            self._cache._release(self._key, self._building)
+
+class ArtifactCache(object):
+    """Archives of immutable artifacts on local disk, bounded by a byte budget and evicted least recently used first.
+
+    The directory is shared by the worker processes. Each keeps an index of the archives it has seen, which is
+    synced with the directory under a file lock whenever archives are evicted. Recency is kept in the modification
+    time of the archives, so the workers evict in the same order. An archive another worker has evicted is built again.
+
+    A missing archive is streamed to the client while it's written to the cache. Only one request of a process
+    builds it, concurrent requests for the same key wait for it. Archives are written to a temporary file and renamed,
+    so a partial archive is never served.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        # key -> size in bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._building = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.enabled:
+            os.makedirs(self._directory, exist_ok = True)
+            with self._lock:
+                self._evict()
+
+    @property
+    def enabled(self):
+        return self._max_bytes > 0
+
+    @staticmethod
+    def key(*values):
+        return hashlib.sha256('|'.join([str(value) for value in values]).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._directory, key)
+
+    @contextmanager
+    def _directory_lock(self):
+        with open(os.path.join(self._directory, LOCK_FILE_NAME), 'a') as lockFile:
+            if fcntl:
+                fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def _scan(self):
+        """ return (modification time, key, size) of the archives in the directory, the stale temporary files are removed """
+        files = []
+        now = time.time()
+        for name in os.listdir(self._directory):
+            if name.startswith('.'):
+                continue
+            path = self._path(name)
+            try:
+                stat = os.stat(path)
+                if not name.endswith('.tmp'):
+                    files.append((stat.st_mtime, name, stat.st_size))
+                elif now - stat.st_mtime > STALE_TMP_SECONDS:
+                    os.remove(path)
+            except OSError:
+                # removed by another worker meanwhile
+                pass
+        return files
+
+    def _evict(self, keep = None):
+        """ sync the index with the directory and remove the least recently used archives over the budget.
+            keep is the archive about to be served, it's kept even if it's over the budget on its own """
+        with self._directory_lock():
+            files = sorted(self._scan())
+            total = sum([size for mtime, name, size in files])
+            entries = OrderedDict()
+            for mtime, name, size in files:
+                if total > self._max_bytes and name != keep:
+                    try:
+                        os.remove(self._path(name))
+                    except OSError:
+                        pass
+                    total = total - size
+                else:
+                    entries[name] = size
+        self._entries = entries
+        self._bytes = total
+
+    def _drop(self, key):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self._bytes = self._bytes - size
+
+    def _open(self, key):
+        """ return the archive opened for reading, or None if it was removed by another worker. """
+        path = self._path(key)
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            self._drop(key)
+            return None
+        # an evicted archive stays readable through the open file
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return file
+
+    def open(self, key, build):
+        """ return (archive opened for reading, None) on a hit. on a miss return (None, chunks), build() returns
+            the chunks of the archive and chunks yields them while they are written to the cache. """
+        while True:
+            with self._lock:
+                if key in self._entries or os.path.exists(self._path(key)):
+                    file = self._open(key)
+                    if file:
+                        if key not in self._entries:
+                            # built by another worker
+                            self._entries[key] = os.fstat(file.fileno()).st_size
+                            self._bytes = self._bytes + self._entries[key]
+                        self._entries.move_to_end(key)
+                        self.hits = self.hits + 1
+                        return file, None
+                building = self._building.get(key)
+                if not building:
+                    building = threading.Event()
+                    self._building[key] = building
+                    self.misses = self.misses + 1
+                    break
+            # wait for the other request, build again if it failed
+            building.wait()
+
+        try:
+            return None, CachingStream(self, key, building, build())
+        except Exception:
+            self._release(key, building)
+            raise
+
+    def _add(self, key, tmpPath):
+        size = os.path.getsize(tmpPath)
+        os.replace(tmpPath, self._path(key))
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = size
+            self._bytes = self._bytes + size
+            if self._bytes > self._max_bytes:
+                self._evict(key)
+
+    def _release(self, key, building):
+        with self._lock:
+            del self._building[key]
+        building.set()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'bytes': self._bytes, 'building': len(self._building), 'hits': self.hits, 'misses': self.misses}
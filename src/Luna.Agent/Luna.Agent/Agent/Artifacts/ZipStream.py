@@ -0,0 +1,242 @@
+from collections import deque
+import os
+import shutil
+import struct
+import time
+import zlib
+
+# formats that are compressed already, deflating them costs CPU without saving space
+INCOMPRESSIBLE_EXTENSIONS = {'.pt', '.pth', '.onnx', '.parquet', '.orc', '.avro', '.gz', '.tgz', '.bz2', '.xz', '.zst',
+                             '.lz4', '.zip', '.7z', '.jar', '.whl', '.npz', '.jpg', '.jpeg', '.png', '.gif', '.webp',
+                             '.mp3', '.mp4', '.avi', '.mov'}
+
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+CENTRAL_HEADER_SIGNATURE = 0x02014b50
+ZIP64_END_SIGNATURE = 0x06064b50
+ZIP64_LOCATOR_SIGNATURE = 0x07064b50
+END_SIGNATURE = 0x06054b50
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# sizes are in the data descriptor, the names are UTF-8
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+VERSION = 20
+ZIP64_VERSION = 45
+# the external attributes hold unix permissions
+CREATE_SYSTEM_UNIX = 3
+ZIP64_EXTRA_ID = 0x0001
+
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP16_LIMIT = 0xFFFF
+
+# an empty final block, ends a deflate stream made of flushed blocks
+DEFLATE_END = b'\x03\x00'
+
+# files whose first block doesn't deflate below this ratio are stored
+DEFLATE_MAX_RATIO = 0.95
+
+# the longest stored deflate block
+STORED_BLOCK_LIMIT = 0xFFFF
+
+def deflate_block(block, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # a sync flush ends on a byte boundary without ending the stream, so blocks compressed on their own can be concatenated
+    compressed = compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    if len(compressed) < len(block):
+        return compressed
+    # the block doesn't compress, it's written as stored deflate blocks which only add 5 bytes per 64KB
+    return b''.join([struct.pack('<BHH', 0, len(part), len(part) ^ 0xFFFF) + part
+                     for part in [block[offset:offset + STORED_BLOCK_LIMIT] for offset in range(0, len(block), STORED_BLOCK_LIMIT)]])
+
+def dos_date_time(mtime):
+    # the zip format can't represent dates before 1980
+    year, month, day, hour, minute, second = time.localtime(max(mtime, 315532800))[:6]
+    return (year - 1980) << 9 | month << 5 | day, hour << 11 | minute << 5 | second // 2
+
+class ZipEntry(object):
+
+    def __init__(self, name, path, stat, compress_type):
+        self.name = name.replace(os.sep, '/').encode('utf-8')
+        self.path = path
+        self.compress_type = compress_type
+        self.date, self.time = dos_date_time(stat.st_mtime)
+        self.external_attr = (stat.st_mode & 0xFFFF) << 16
+        self.flags = FLAG_DATA_DESCRIPTOR | FLAG_UTF8
+        # the sizes are written before the data, so deflated data a bit larger than the file needs zip64 as well
+        self.zip64 = stat.st_size * 1.05 >= ZIP32_LIMIT
+        self.header_offset = 0
+        self.crc = 0
+        self.compress_size = 0
+        self.file_size = 0
+
+    def local_header(self):
+        if self.zip64:
+            # the sizes are in the data descriptor, the zip64 extra field only says they are 8 bytes
+            extra = struct.pack('<HHQQ', ZIP64_EXTRA_ID, 16, 0, 0)
+            size = ZIP32_LIMIT
+        else:
+            extra = b''
+            size = 0
+        return struct.pack('<LHHHHHLLLHH', LOCAL_HEADER_SIGNATURE, ZIP64_VERSION if self.zip64 else VERSION, self.flags,
+                           self.compress_type, self.time, self.date, 0, size, size, len(self.name), len(extra)) + self.name + extra
+
+    def data_descriptor(self):
+        return struct.pack('<LLQQ' if self.zip64 else '<LLLL', DATA_DESCRIPTOR_SIGNATURE, self.crc, self.compress_size, self.file_size)
+
+    def central_header(self):
+        # the zip64 extra field holds the values which don't fit, in this order
+        values = []
+        fileSize = self.file_size
+        compressSize = self.compress_size
+        headerOffset = self.header_offset
+        if self.zip64 or fileSize >= ZIP32_LIMIT:
+            values.append(fileSize)
+            fileSize = ZIP32_LIMIT
+        if self.zip64 or compressSize >= ZIP32_LIMIT:
+            values.append(compressSize)
+            compressSize = ZIP32_LIMIT
+        if headerOffset >= ZIP32_LIMIT:
+            values.append(headerOffset)
+            headerOffset = ZIP32_LIMIT
+        extra = struct.pack('<HH' + 'Q' * len(values), ZIP64_EXTRA_ID, 8 * len(values), *values) if values else b''
+        version = ZIP64_VERSION if values else VERSION
+        return struct.pack('<LBBHHHHHLLLHHHHHLL', CENTRAL_HEADER_SIGNATURE, version, CREATE_SYSTEM_UNIX, version, self.flags,
+                           self.compress_type, self.time, self.date, self.crc, compressSize, fileSize, len(self.name),
+                           len(extra), 0, 0, 0, self.external_attr, headerOffset) + self.name + extra
+
+def end_of_central_directory(count, size, offset):
+    """ the end of central directory record, preceded by the zip64 record and locator if the values don't fit """
+    data = b''
+    if count >= ZIP16_LIMIT or size >= ZIP32_LIMIT or offset >= ZIP32_LIMIT:
+        zip64Offset = offset + size
+        data = struct.pack('<LQHHLLQQQQ', ZIP64_END_SIGNATURE, 44, ZIP64_VERSION, ZIP64_VERSION, 0, 0, count, count, size, offset)
+        data = data + struct.pack('<LLQL', ZIP64_LOCATOR_SIGNATURE, 0, zip64Offset, 1)
+        count = min(count, ZIP16_LIMIT)
+        size = min(size, ZIP32_LIMIT)
+        offset = min(offset, ZIP32_LIMIT)
+    return data + struct.pack('<LHHHHLLH', END_SIGNATURE, 0, 0, count, count, size, offset, 0)
+
+class ZipStream(object):
+    """Zips the files of a directory while it is iterated, yielding the archive in chunks.
+
+    Files are read in blocks. Blocks of compressible files are deflated on the executor, a bounded number
+    ahead of the block being written, so memory stays at a few blocks whatever the size of the files.
+    Files in compressed formats, or whose first block doesn't compress, are stored, and a later block which
+    doesn't compress is written as stored deflate blocks. The output isn't seekable, so entries are written
+    with data descriptors, and the central directory is written at the end from the entries written so far.
+    """
+
+    def __init__(self, path, block_size = 1024 * 1024, remove_when_done = False, executor = None, max_pending = 8, level = 6, metrics = None):
+        self._path = path
+        self._block_size = block_size
+        self._remove_when_done = remove_when_done
+        self._executor = executor
+        self._max_pending = max_pending
+        self._level = level
+        self._metrics = metrics
+        self._iterator = None
+
+    def _blocks(self):
+        """ yield (entry, block, compressed block or None) in archive order, the block is None at the end of each file.
+            the first block of a file which may compress is deflated here, the file is stored if it doesn't compress well """
+        for root, dirs, files in os.walk(self._path):
+            for file in files:
+                filePath = os.path.join(root, file)
+                if os.path.splitext(file)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+                    compressType = ZIP_STORED
+                else:
+                    compressType = ZIP_DEFLATED
+                entry = ZipEntry(os.path.relpath(filePath, self._path), filePath, os.stat(filePath), compressType)
+                with open(filePath, 'rb') as src:
+                    block = src.read(self._block_size)
+                    if block and compressType == ZIP_DEFLATED:
+                        compressed = deflate_block(block, self._level)
+                        if len(compressed) > len(block) * DEFLATE_MAX_RATIO:
+                            entry.compress_type = ZIP_STORED
+                        else:
+                            yield entry, block, compressed
+                            block = src.read(self._block_size)
+                    while block:
+                        yield entry, block, None
+                        block = src.read(self._block_size)
+                yield entry, None, None
+
+    def _submit(self, entry, block, compressed):
+        if block is None or entry.compress_type == ZIP_STORED or compressed is not None:
+            return entry, block, compressed
+        if self._executor:
+            return entry, block, self._executor.submit(deflate_block, block, self._level)
+        return entry, block, deflate_block(block, self._level)
+
+    def _write(self, state, entry, block, compressed):
+        """ return the bytes of the block. state is [entries written, offset] """
+        entries = state[0]
+        data = b''
+        if not entries or entries[-1] is not entry:
+            entry.header_offset = state[1]
+            entries.append(entry)
+            data = entry.local_header()
+
+        if block is None:
+            if entry.compress_type == ZIP_DEFLATED:
+                entry.compress_size = entry.compress_size + len(DEFLATE_END)
+                data = data + DEFLATE_END
+            data = data + entry.data_descriptor()
+        else:
+            if compressed is None:
+                payload = block
+            elif isinstance(compressed, bytes):
+                payload = compressed
+            else:
+                payload = compressed.result()
+            entry.crc = zlib.crc32(block, entry.crc)
+            entry.file_size = entry.file_size + len(block)
+            entry.compress_size = entry.compress_size + len(payload)
+            data = data + payload
+
+        state[1] = state[1] + len(data)
+        return data
+
+    def _generate(self):
+        startTime = time.time()
+        pending = deque()
+        state = [[], 0]
+        try:
+            for entry, block, compressed in self._blocks():
+                pending.append(self._submit(entry, block, compressed))
+                if len(pending) > self._max_pending:
+                    yield self._write(state, *pending.popleft())
+            while pending:
+                yield self._write(state, *pending.popleft())
+
+            entries, offset = state
+            centralDirectory = b''.join([entry.central_header() for entry in entries])
+            yield centralDirectory + end_of_central_directory(len(entries), len(centralDirectory), offset)
+
+            if self._metrics:
+                self._metrics.observe('archive.build_seconds', time.time() - startTime)
+                fileSize = sum([entry.file_size for entry in entries])
+                if fileSize:
+                    self._metrics.observe('archive.compression_ratio', sum([entry.compress_size for entry in entries]) / fileSize)
+        finally:
+            for entry, block, compressed in pending:
+                if compressed is not None and not isinstance(compressed, bytes):
+                    compressed.cancel()
+            if self._remove_when_done:
+                shutil.rmtree(self._path, ignore_errors = True)
+
+    def __iter__(self):
+        if self._iterator is None:
+            self._iterator = self._generate()
+        return self._iterator
+
+    def close(self):
+        """ stop zipping, the directory is removed even if the stream was never iterated """
+        if self._iterator is not None:
+            self._iterator.close()
+        elif self._remove_when_done:
+            shutil.rmtree(self._path, ignore_errors = True)
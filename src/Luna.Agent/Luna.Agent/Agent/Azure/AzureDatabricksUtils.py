@@ -1,16 +1,16 @@
 from uuid import uuid4
 from luna.utils import ProjectUtils
-from Agent import key_vault_client
+from Agent import key_vault_client, aad_token_cache, http_client_pool, dbfs_executor, mlflow_run_cache, mlflow_lock
+from Agent.Azure.DbfsDownloader import DbfsDownloader
 import json
+from contextlib import contextmanager
 import tempfile
-import zipfile
+import shutil
 import os
-import requests
 from datetime import date, datetime
 from Agent.Exception.LunaExceptions import LunaServerException, LunaUserException
 from http import HTTPStatus
 from adal import AuthenticationContext
-import base64
 from Agent.Data.GitRepo import GitRepo
 import mlflow
 from mlflow.tracking import MlflowClient
@@ -18,52 +18,46 @@ from mlflow.tracking import MlflowClient
 AAD_RESOURCE_URL_FORMAT = "https://login.microsoftonline.com/{}"
 MGMT_TOKEN_RESOURCE_ID = "https://management.core.windows.net/"
 ACCESS_TOKEN_RESOURCE_ID = "2ff814a6-3304-4ab8-85cb-cd0e6f879c1d"
-DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
 ADB_REST_URL_FORMAT = "{}/api/2.0/{}"
+# experiment ids and the parent run of an operation never change
+IMMUTABLE_RUN_INFO_TTL_SECONDS = 3600
+# bound of the search for the child runs of a page of operations
+CHILD_RUN_SEARCH_PAGE_SIZE = 100
+CHILD_RUN_SEARCH_MAX_PAGES = 10
 
 class AzureDatabricksUtils(object):
-    _access_token = ""
-    _mgmt_token = ""
-    _token_expires_on = datetime.max
     _workspace = None
 
     def __init__(self, workspace):
-        if workspace.AADApplicationSecret:
+        if not workspace.AADApplicationSecret:
             workspace.AADApplicationSecret =key_vault_client.get_secret(workspace.AADApplicationSecretName).value
         self._workspace = workspace
-        self.refreshTokens()
 
-    def refreshTokens(self):
+    def acquireToken(self, resource):
         auth_context = AuthenticationContext(AAD_RESOURCE_URL_FORMAT.format(self._workspace.AADTenantId))
+        token_response = auth_context.acquire_token_with_client_credentials(resource, self._workspace.AADApplicationId, self._workspace.AADApplicationSecret)
+        return token_response["accessToken"], token_response["expiresIn"]
 
-        token_response = auth_context.acquire_token_with_client_credentials(MGMT_TOKEN_RESOURCE_ID, self._workspace.AADApplicationId, self._workspace.AADApplicationSecret)
-        self._mgmt_token = token_response["accessToken"]
-        expires_on = datetime.strptime(token_response["expiresOn"], DATETIME_FORMAT)
-        if expires_on < self._token_expires_on:
-            self._token_expires_on = expires_on
-
-        token_response = auth_context.acquire_token_with_client_credentials(ACCESS_TOKEN_RESOURCE_ID, self._workspace.AADApplicationId, self._workspace.AADApplicationSecret)
-        self._access_token = token_response["accessToken"]
-        expires_on = datetime.strptime(token_response["expiresOn"], DATETIME_FORMAT)
-        if expires_on < self._token_expires_on:
-            self._token_expires_on = expires_on
+    def getToken(self, resource):
+        # tokens are shared by all instances using the same service principal
+        key = (self._workspace.AADTenantId.lower(), self._workspace.AADApplicationId.lower(), resource)
+        return aad_token_cache.get_token(key, lambda: self.acquireToken(resource))
 
     def getMgmtToken(self):
-        if self._token_expires_on < datetime.utcnow():
-            self.refreshTokens()
-        return self._mgmt_token
+        return self.getToken(MGMT_TOKEN_RESOURCE_ID)
 
     def getAccessToken(self):
-        if self._token_expires_on < datetime.utcnow():
-            self.refreshTokens()
-        return self._access_token
+        return self.getToken(ACCESS_TOKEN_RESOURCE_ID)
 
-    def send_get_request(self, url, body):
+    def getRequestHeaders(self):
         headers = {}
         headers["X-Databricks-Azure-Workspace-Resource-Id"] = self._workspace.ResourceId
         headers["X-Databricks-Azure-SP-Management-Token"] = self.getMgmtToken()
         headers["Authorization"] = "Bearer {}".format(self.getAccessToken())
-        response = requests.get(url, body, headers=headers)
+        return headers
+
+    def send_get_request(self, url, body):
+        response = http_client_pool.get(url, params=body, headers=self.getRequestHeaders())
         return response.json()
 
     def getModel(self, mlModel):
@@ -76,14 +70,28 @@ class AzureDatabricksUtils(object):
 
         return self.send_get_request(url, body)
 
+    @contextmanager
+    def useMlflowWorkspace(self):
+        """ point mlflow at the workspace. mlflow reads the workspace and token from process-wide settings,
+            so the mlflow calls of all threads are serialized. the previous tracking uri is restored when done,
+            an AML project submission running outside of the lock keeps reading its own """
+        token = self.getAccessToken()
+        with mlflow_lock:
+            trackingUri = mlflow.get_tracking_uri()
+            os.environ['MLFLOW_TRACKING_URI'] = 'databricks'
+            os.environ['DATABRICKS_HOST'] = self._workspace.WorkspaceUrl
+            os.environ['DATABRICKS_TOKEN'] = token
+            mlflow.set_tracking_uri("databricks")
+            mlflow.set_registry_uri("databricks")
+            try:
+                yield
+            finally:
+                mlflow.set_tracking_uri(trackingUri)
+
     def getExperimentName(self, subscriptionId):
         return "/Users/{}/{}".format(self._workspace.AADApplicationId.lower(), subscriptionId)
 
-    def runProject(self, subscription, apiVersion, operationName, userInput, predecessorOperationId='na'):
-        os.environ['MLFLOW_TRACKING_URI'] = 'databricks'
-        os.environ['DATABRICKS_HOST'] = self._workspace.WorkspaceUrl
-        os.environ['DATABRICKS_TOKEN'] = self.getAccessToken()
-
+    def runProject(self, subscription, apiVersion, operationName, userInput, predecessorOperationId='na', operationId = None):
         # TODO: use the real config file
         backend_config = {
             "spark_version": "7.3.x-scala2.12",
@@ -93,136 +101,202 @@ class AzureDatabricksUtils(object):
         
         #with open('backend_config.json', 'w+') as file:
         #    json.dump(backend_config, file)
-        mlflow.set_tracking_uri("databricks")
-        mlflow.set_registry_uri("databricks")
         # mlflow.set_tracking_uri(os.environ['ODBC_CONNECTION_STRING'])
         exp_name = self.getExperimentName(subscription.SubscriptionId)
-        exp = mlflow.get_experiment_by_name(exp_name)
-
-        if not exp:
-            mlflow.create_experiment(exp_name)
+        repo = GitRepo.GetById(apiVersion.GitRepoId)
+        fullUrl = "https://{}@{}".format(repo.PersonalAccessToken, repo.HttpUrl[8:])
+        with self.useMlflowWorkspace():
+            exp = mlflow.get_experiment_by_name(exp_name)
+
+            if not exp:
+                mlflow.create_experiment(exp_name)
+                
+            mlflow.set_experiment(exp_name)
+            with mlflow.start_run():
+                mlflow.run(fullUrl, 
+                         parameters = userInput,
+                         entry_point = operationName, 
+                         experiment_name=exp_name, 
+                         backend="databricks", 
+                         backend_config = backend_config,
+                         version = apiVersion.GitVersion,
+                         synchronous = False)
             
-        mlflow.set_experiment(exp_name)
-        with mlflow.start_run():
-            repo = GitRepo.GetById(apiVersion.GitRepoId)
-            fullUrl = "https://{}@{}".format(repo.PersonalAccessToken, repo.HttpUrl[8:])
-            mlflow.run(fullUrl, 
-                     parameters = userInput,
-                     entry_point = operationName, 
-                     experiment_name=exp_name, 
-                     backend="databricks", 
-                     backend_config = backend_config,
-                     version = apiVersion.GitVersion,
-                     synchronous = False)
-        
-            operationId = str('a' + uuid4().hex[1:])
-            tags={'userId': subscription.Owner, 
-              'applicationName': subscription.ApplicationName, 
-              'apiName': subscription.APIName, 
-              'apiVersion': apiVersion.VersionName,
-              'operationName': operationName,
-              'operationId': operationId,
-              'subscriptionId': subscription.SubscriptionId,
-              'predecessorOperationId': predecessorOperationId}
-            mlflow.set_tags(tags)
+                if not operationId:
+                    operationId = str('a' + uuid4().hex[1:])
+                tags={'userId': subscription.Owner, 
+                  'applicationName': subscription.ApplicationName, 
+                  'apiName': subscription.APIName, 
+                  'apiVersion': apiVersion.VersionName,
+                  'operationName': operationName,
+                  'operationId': operationId,
+                  'subscriptionId': subscription.SubscriptionId,
+                  'predecessorOperationId': predecessorOperationId}
+                mlflow.set_tags(tags)
 
         return operationId
     
-    def getOperationLog(self, operationId, userId, subscriptionId):
-        
+    def getOperationLog(self, operationId, userId, subscriptionId, offset = 0):
+        """ return the bytes of the log from offset, only the range after offset is read from DBFS """
         runInfo, operationName = self.getRunInfoByTags(operationId, userId, subscriptionId)
-        client = MlflowClient()
 
         try:
-            with tempfile.TemporaryDirectory() as tmp:
-                path = os.path.join(tmp, 'output/log.txt')
-                files = client.download_artifacts(runInfo['run_id'], 'output/log.txt', tmp)
-                with open(path) as file:
-                    return file.read(file)
+            return self.getDbfsDownloader().read(runInfo['artifact_uri'][5:] + '/output/log.txt', offset)
         except Exception as ex:
             raise LunaUserException(HTTPStatus.NOT_FOUND, "Log of operation {} does not exist or you do not have permission to access it.".format(operationId))
         
     def getOperationOutput(self, operationId, userId, subscriptionId, outputType = "json"):
         
         runInfo, operationName = self.getRunInfoByTags(operationId, userId, subscriptionId)
-        client = MlflowClient()
 
         if outputType == "json":
             try:
                 with tempfile.TemporaryDirectory() as tmp:
                     path = os.path.join(tmp, 'output/output.json')
-                    files = client.download_artifacts(runInfo['run_id'], 'output/output.json', tmp)
+                    with self.useMlflowWorkspace():
+                        files = MlflowClient().download_artifacts(runInfo['run_id'], 'output/output.json', tmp)
                     with open(path) as file:
                         return json.load(file)
             except Exception as ex:
                 raise LunaUserException(HTTPStatus.NOT_FOUND, "JSON output of operation {} does not exist or you do not have permission to access it.".format(operationId))
         elif outputType == "file":
-            tmp = tempfile.TemporaryDirectory().name
-            localPath = os.path.join(tmp, "output")
-            if not os.path.exists(localPath):
-                os.makedirs(localPath)
-            local_path = client.download_artifacts(runInfo['run_id'], "output", localPath)
-        
-            zip_file_path = os.path.join(tmp, "output_{}.zip".format(operationId))
-            zipf = zipfile.ZipFile(zip_file_path, "w", zipfile.ZIP_DEFLATED)
-            self.zipdir(localPath, zipf, "output_{}".format(operationId))
-            zipf.close()
-            return zip_file_path
-
-    def getRunInfoByTags(self, operationId, userId, subscriptionId):
-               
-        os.environ['MLFLOW_TRACKING_URI'] = 'databricks'
-        os.environ['DATABRICKS_HOST'] = self._workspace.WorkspaceUrl
-        os.environ['DATABRICKS_TOKEN'] = self.getAccessToken()
-        
-        mlflow.set_registry_uri("databricks")
-        mlflow.set_tracking_uri("databricks")
-        
+            localPath = tempfile.mkdtemp()
+            try:
+                with self.useMlflowWorkspace():
+                    local_path = MlflowClient().download_artifacts(runInfo['run_id'], "output", localPath)
+            except Exception:
+                shutil.rmtree(localPath, ignore_errors=True)
+                raise
+            return localPath
+
+    def getExperimentId(self, subscriptionId):
         exp_name = self.getExperimentName(subscriptionId)
-        exp = mlflow.get_experiment_by_name(exp_name)
-        filter_string = "tags.userId ILIKE '{}' AND tags.operationId ILIKE '{}' AND tags.subscriptionId ILIKE '{}'".format(userId, operationId, subscriptionId)
-        runs = mlflow.search_runs([exp.experiment_id], filter_string=filter_string)
+        def load():
+            with self.useMlflowWorkspace():
+                exp = mlflow.get_experiment_by_name(exp_name)
+            return exp.experiment_id if exp else None
+        return mlflow_run_cache.get_or_load(('experiment', self._workspace.WorkspaceUrl, exp_name), load, IMMUTABLE_RUN_INFO_TTL_SECONDS)
+
+    @staticmethod
+    def toTimestampMs(startTime):
+        return int(startTime.timestamp() * 1000)
+
+    def getChildRuns(self, experimentId, parentRuns):
+        """ return the latest child run of the parent runs keyed by the parent run id, parentRuns maps the parent run ids
+            to their start time in ms. a single missing child run is searched by its parent run id. more are searched
+            together among the runs started since the oldest of their parents, since a child run starts after its parent,
+            newest first and a page at a time until all are found or CHILD_RUN_SEARCH_MAX_PAGES pages were read. """
+        childRuns = {}
+        missing = {}
+        for runId, startTime in parentRuns.items():
+            childRun = mlflow_run_cache.get(('childRun', self._workspace.WorkspaceUrl, runId))
+            if childRun is None:
+                missing[runId] = startTime
+            else:
+                childRuns[runId] = childRun
+        if not missing:
+            return childRuns
+
+        if len(missing) == 1:
+            runId = next(iter(missing))
+            filter_string = "tags.mlflow.parentRunId = '{}'".format(runId)
+            with self.useMlflowWorkspace():
+                runs = mlflow.search_runs([experimentId], filter_string=filter_string, max_results=1, order_by=["attributes.start_time DESC"])
+            if runs.shape[0] > 0:
+                childRuns[runId] = runs.iloc[0]
+                mlflow_run_cache.set(('childRun', self._workspace.WorkspaceUrl, runId), childRuns[runId])
+            return childRuns
+
+        found = {}
+        seen = set()
+        minStartTime = min(missing.values())
+        maxStartTime = None
+        for page in range(CHILD_RUN_SEARCH_MAX_PAGES):
+            filter_string = "tags.mlflow.parentRunId LIKE '%' AND attributes.start_time >= {}".format(minStartTime)
+            if maxStartTime is not None:
+                filter_string = filter_string + " AND attributes.start_time <= {}".format(maxStartTime)
+            with self.useMlflowWorkspace():
+                runs = mlflow.search_runs([experimentId], filter_string=filter_string, max_results=CHILD_RUN_SEARCH_PAGE_SIZE,
+                                          order_by=["attributes.start_time DESC"])
+            # newest first
+            for index, row in runs.iterrows():
+                if row['run_id'] not in seen:
+                    seen.add(row['run_id'])
+                    found.setdefault(row['tags.mlflow.parentRunId'], row)
+            if runs.shape[0] < CHILD_RUN_SEARCH_PAGE_SIZE or all([runId in found for runId in missing]):
+                break
+            # the next page starts at the oldest run of this one, the runs started in the same ms are skipped by run id
+            oldestStartTime = AzureDatabricksUtils.toTimestampMs(runs.iloc[-1]['start_time'])
+            if oldestStartTime == maxStartTime:
+                # a whole page started in the same ms, move past it
+                oldestStartTime = oldestStartTime - 1
+            maxStartTime = oldestStartTime
+
+        for runId, childRun in found.items():
+            # the other child runs found are cached as well, they are likely listed next
+            mlflow_run_cache.set(('childRun', self._workspace.WorkspaceUrl, runId), childRun)
+            if runId in missing:
+                childRuns[runId] = childRun
+        return childRuns
+
+    def getParentRun(self, experimentId, operationId, userId, subscriptionId):
+        """ return (run id, operation name, start time in ms) of the run submitted for the operation, None if there is none """
+        def load():
+            filter_string = "tags.userId ILIKE '{}' AND tags.operationId ILIKE '{}' AND tags.subscriptionId ILIKE '{}'".format(userId, operationId, subscriptionId)
+            with self.useMlflowWorkspace():
+                runs = mlflow.search_runs([experimentId], filter_string=filter_string)
+            if runs.shape[0] == 0:
+                return None
+            return runs.iloc[0]['run_id'], runs.iloc[0]['tags.operationName'], AzureDatabricksUtils.toTimestampMs(runs.iloc[0]['start_time'])
+
+        return mlflow_run_cache.get_or_load(('operation', self._workspace.WorkspaceUrl, experimentId, userId, operationId), load, IMMUTABLE_RUN_INFO_TTL_SECONDS)
+
+    def hasOperationRun(self, operationId, userId, subscriptionId):
+        """ whether a run was submitted for the operation, its child run may not have started yet """
+        experimentId = self.getExperimentId(subscriptionId)
+        return bool(experimentId) and self.getParentRun(experimentId, operationId, userId, subscriptionId) is not None
 
-        if runs.shape[0] == 0:
+    def getRunInfoByTags(self, operationId, userId, subscriptionId):
+        experimentId = self.getExperimentId(subscriptionId)
+        if not experimentId:
             raise LunaUserException(HTTPStatus.NOT_FOUND, "The operation {} does not exist or you do not have permission to acces it.".format(operationId))
 
-        operationName = runs.iloc[0]['tags.operationName']
-        filter_string = "tags.mlflow.parentRunId ILIKE '{}'".format(runs.iloc[0]['run_id'])
-        
-        runs = mlflow.search_runs([exp.experiment_id], filter_string=filter_string)
+        parentRun = self.getParentRun(experimentId, operationId, userId, subscriptionId)
+        if not parentRun:
+            raise LunaUserException(HTTPStatus.NOT_FOUND, "The operation {} does not exist or you do not have permission to acces it.".format(operationId))
 
-        if runs.shape[0] == 0:
+        runId, operationName, startTime = parentRun
+        childRuns = self.getChildRuns(experimentId, {runId: startTime})
+        if runId not in childRuns:
             raise LunaUserException(HTTPStatus.NOT_FOUND, "The operation {} does not exist or you do not have permission to acces it.".format(operationId))
 
-        return runs.iloc[0], operationName
+        return childRuns[runId], operationName
 
-    def listAllOperations(self, operationName, userId, subscriptionId):
-        
-        os.environ['MLFLOW_TRACKING_URI'] = 'databricks'
-        os.environ['DATABRICKS_HOST'] = self._workspace.WorkspaceUrl
-        os.environ['DATABRICKS_TOKEN'] = self.getAccessToken()
-        
-        mlflow.set_registry_uri("databricks")
-        
-        exp_name = self.getExperimentName(subscriptionId)
-        exp = mlflow.get_experiment_by_name(exp_name)
+    def listAllOperations(self, operationName, userId, subscriptionId, top = None, skip = 0):
+        """ return a page of operations and whether there are more """
+        experimentId = self.getExperimentId(subscriptionId)
+        if not experimentId:
+            return [], False
         filter_string = "tags.userId ILIKE '{}' AND tags.operationName ILIKE '{}' AND tags.subscriptionId ILIKE '{}'".format(userId, operationName, subscriptionId)
-        runs = mlflow.search_runs([exp.experiment_id], filter_string=filter_string)
+        with self.useMlflowWorkspace():
+            runs = mlflow.search_runs([experimentId], filter_string=filter_string)
+        hasMore = bool(top) and runs.shape[0] > skip + top
+        runs = runs.iloc[skip:skip + top] if top else runs.iloc[skip:]
 
+        childRuns = self.getChildRuns(experimentId, {row['run_id']: AzureDatabricksUtils.toTimestampMs(row['start_time']) for index, row in runs.iterrows()})
         resultList = []
         for index, row in runs.iterrows():
-            
-            filter_string = "tags.mlflow.parentRunId ILIKE '{}'".format(row['run_id'])
-            child_runs = mlflow.search_runs([exp.experiment_id], filter_string=filter_string)
+            # the project didn't start a child run yet
+            run = childRuns.get(row['run_id'], row)
             result = {'operationId': row["tags.operationId"],
                       'operationName': operationName,
-                      'startTime': child_runs.iloc[0]['start_time'],
-                      'endTime': child_runs.iloc[0]['end_time'],
-                      'status': child_runs.iloc[0]['status']
+                      'startTime': run['start_time'],
+                      'endTime': run['end_time'],
+                      'status': run['status']
                 }
             resultList.append(result)
 
-        return resultList
+        return resultList, hasMore
 
     def getOperationStatus(self, operationId, userId, subscriptionId):
  
@@ -236,68 +310,44 @@ class AzureDatabricksUtils(object):
 
         return result
 
-    def downloadModel(self, mlModel):
+    def getModelVersion(self, mlModel):
+        """ resolve the latest version to the actual version number """
+        if mlModel.ModelVersion != '0' and mlModel.ModelVersion != 'latest':
+            return mlModel.ModelVersion
+        url = ADB_REST_URL_FORMAT.format(self._workspace.WorkspaceUrl, "mlflow/registered-models/get-latest-versions")
+        body = {
+            "name": mlModel.ModelName
+            }
+        response = self.send_get_request(url, body)
+        if not response.get("model_versions"):
+            raise LunaUserException(HTTPStatus.NOT_FOUND, "Model not found in the model repo. Contact the publisher to correct the error.");
+        return str(max([int(version["version"]) for version in response["model_versions"]]))
+
+    def downloadModel(self, mlModel, modelVersion = None):
         # TODO: see if we can use python library
         url = ADB_REST_URL_FORMAT.format(self._workspace.WorkspaceUrl, "mlflow/model-versions/get-download-uri")
         body = {
             "name": mlModel.ModelName,
-            "version": mlModel.ModelVersion
+            "version": modelVersion if modelVersion else mlModel.ModelVersion
             }
 
         response = self.send_get_request(url, body)
         artifacts_path = response["artifact_uri"][5:]
         
-        tmp = tempfile.TemporaryDirectory().name
-        localPath = os.path.join(tmp, "model")
-        self.downloadFiles(localPath, artifacts_path, True, 0)
-        
-        zip_file_path = os.path.join(tmp, "model_{}.zip".format(mlModel.ModelName))
-        zipf = zipfile.ZipFile(zip_file_path, "w", zipfile.ZIP_DEFLATED)
-        self.zipdir(localPath, zipf, "model_{}".format(mlModel.ModelName))
-        zipf.close()
-        return zip_file_path
-        
-    def zipdir(self, path, ziph, dir):
-    # ziph is zipfile handle
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                ziph.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), path))
-
-    def downloadFile(self, localPath, path, size):
-        with open(localPath, 'wb+') as file:
-            while True:
-                offset = 0
-                url = ADB_REST_URL_FORMAT.format(self._workspace.WorkspaceUrl, "dbfs/read")
-                body = {
-                    "path": path,
-                    "offset": offset,
-                    "length": 1024 * 1024
-                    }
-                response = self.send_get_request(url, body)
-                file.write(base64.b64decode(response["data"]))
-                offset = offset + 1024 * 1024
-                if offset > size:
-                    break;
-        return
+        # the caller zips and removes the directory
+        localPath = tempfile.mkdtemp()
+        try:
+            self.downloadFiles(localPath, artifacts_path, True, 0)
+        except Exception:
+            shutil.rmtree(localPath, ignore_errors=True)
+            raise
+        return localPath
 
     def getFileNameFromPath(self, path):
         return path[path.rindex('/')+1:]
 
-    def downloadFiles(self, localPath, path, is_dir, size):
-        
-        # download the file
-        if not is_dir:
-            self.downloadFile(localPath, path, size)
-        else:
-            if not os.path.exists(localPath):
-                os.makedirs(localPath)
-            url = ADB_REST_URL_FORMAT.format(self._workspace.WorkspaceUrl, "dbfs/list")
-
-            body = {
-                "path": path
-                }
-
-            files = self.send_get_request(url, body)
-            for file in files["files"]:
-                self.downloadFiles(os.path.join(localPath, self.getFileNameFromPath(file["path"])), file["path"], file["is_dir"], file["file_size"])
+    def getDbfsDownloader(self):
+        return DbfsDownloader(ADB_REST_URL_FORMAT.format(self._workspace.WorkspaceUrl, "{}"), self.getRequestHeaders, http_client_pool, dbfs_executor)
 
+    def downloadFiles(self, localPath, path, is_dir, size):
+        self.getDbfsDownloader().download(localPath, path, is_dir, size)
@@ -4,10 +4,11 @@ from azureml.core.webservice import AksWebservice, Webservice, AciWebservice
 from azureml.pipeline.core import PublishedPipeline
 from azureml.core.authentication import ServicePrincipalAuthentication
 from luna.utils import ProjectUtils
-from Agent import key_vault_client
+from Agent import key_vault_client, mlflow_lock, aml_project_lock
 import json
+import itertools
 import tempfile
-import zipfile
+import shutil
 import os
 from Agent.Exception.LunaExceptions import LunaServerException, LunaUserException
 from Agent.Data.AMLPipelineEndpoint import AMLPipelineEndpoint
@@ -16,6 +17,7 @@ import mlflow
 import mlflow.azureml
 from Agent.Data.GitRepo import GitRepo
 from mlflow.exceptions import ExecutionException
+from mlflow.tracking import MlflowClient
 
 class AzureMLUtils(object):
     """The utlitiy class to execute and monitor runs in AML"""
@@ -56,22 +58,32 @@ class AzureMLUtils(object):
         ws = Workspace(subscriptionId, resourceGroupName, workspaceName, auth)
         self._workspace = ws
 
-    def downloadModel(self, mlModel):
-        if mlModel.ModelVersion == '0' or mlModel.ModelVersion == 'latest':
-            mlModel.ModelVersion = None
-        model = Model(self._workspace, name=mlModel.ModelName, version = mlModel.ModelVersion)
+    def getRegisteredModel(self, mlModel, modelVersion = None):
+        # the model metadata is cached and shared across requests, don't modify it
+        if not modelVersion:
+            modelVersion = mlModel.ModelVersion
+        if modelVersion == '0' or modelVersion == 'latest':
+            modelVersion = None
+        model = Model(self._workspace, name=mlModel.ModelName, version = modelVersion)
 
         if not model:
             raise LunaUserException(HTTPStatus.NOT_FOUND, "Model not found in the model repo. Contact the publisher to correct the error.");
-        
-        tmp = tempfile.TemporaryDirectory().name
-        path = os.path.join(tmp, "model")
-        zip_file_path = os.path.join(tmp, "model_{}.zip".format(mlModel.ModelName))
-        files = model.download(path)
-        zipf = zipfile.ZipFile(zip_file_path, "w", zipfile.ZIP_DEFLATED)
-        self.zipdir(path, zipf, "model_{}".format(mlModel.ModelName))
-        zipf.close()
-        return zip_file_path
+        return model
+
+    def getModelVersion(self, mlModel):
+        """ resolve the latest version to the actual version number """
+        return str(self.getRegisteredModel(mlModel).version)
+
+    def downloadModel(self, mlModel, modelVersion = None):
+        model = self.getRegisteredModel(mlModel, modelVersion)
+        # the caller zips and removes the directory
+        path = tempfile.mkdtemp()
+        try:
+            files = model.download(path)
+        except Exception:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        return path
 
     def getEndpoint(self, apiVersion):
         service = Webservice(self._workspace, apiVersion.EndpointName)
@@ -84,8 +96,9 @@ class AzureMLUtils(object):
         list = url.split('/')
         return list[-1]
 
-    def submitPipelineRun(self, subscription, apiVersion, pipelineEndpoint, userInput, predecessorOperationId = 'na'):
-        operationId = str('a' + uuid4().hex[1:])
+    def submitPipelineRun(self, subscription, apiVersion, pipelineEndpoint, userInput, predecessorOperationId = 'na', operationId = None):
+        if not operationId:
+            operationId = str('a' + uuid4().hex[1:])
         experimentName = subscription.SubscriptionId
         exp = Experiment(self._workspace, experimentName)
         tags={'userId': subscription.Owner, 
@@ -111,9 +124,10 @@ class AzureMLUtils(object):
         exp.submit(pipeline, tags = tags, pipeline_parameters=input)
         return operationId
      
-    def runProject(self, subscription, apiVersion, operationName, userInput, predecessorOperationId='na'):
+    def runProject(self, subscription, apiVersion, operationName, userInput, predecessorOperationId='na', operationId = None):
         
-        operationId = str('a' + uuid4().hex[1:])
+        if not operationId:
+            operationId = str('a' + uuid4().hex[1:])
         experimentName = subscription.SubscriptionId
         tags={'userId': subscription.Owner, 
               'applicationName': subscription.ApplicationName, 
@@ -124,24 +138,33 @@ class AzureMLUtils(object):
               'subscriptionId': subscription.SubscriptionId,
               'predecessorOperationId': predecessorOperationId}
         
-        mlflow.set_tracking_uri(self._workspace.get_mlflow_tracking_uri())
-        mlflow.set_experiment(experimentName)
         backend_config = {"COMPUTE": apiVersion.LinkedServiceComputeTarget, "USE_CONDA": True}
         
         repo = GitRepo.GetById(apiVersion.GitRepoId)
         fullUrl = "https://{}@{}".format(repo.PersonalAccessToken, repo.HttpUrl[8:])
-        # work around a logging issue in AML to avoid logging PAT
-        os.environ['AZUREML_GIT_REPOSITORY_URI'] = repo.HttpUrl
-        try:
-            run = mlflow.projects.run(uri=fullUrl, 
-                                  version = apiVersion.GitVersion,
-                                  entry_point= operationName,
-                                  parameters=userInput,
-                                  backend = "azureml",
-                                  backend_config = backend_config,
-                                  synchronous=False)
-        except ExecutionException as e:
-            raise LunaUserException(HTTPStatus.BAD_REQUEST, str(e.message))
+        # the submission clones the repository and builds the environment, it runs outside of the mlflow lock so the
+        # Databricks calls of the other threads don't wait for it. the experiment is passed by id, so only the tracking
+        # uri is read from the process-wide settings, the Databricks calls restore it when they are done
+        trackingUri = self._workspace.get_mlflow_tracking_uri()
+        with aml_project_lock:
+            client = MlflowClient(tracking_uri = trackingUri)
+            experiment = client.get_experiment_by_name(experimentName)
+            experimentId = experiment.experiment_id if experiment else client.create_experiment(experimentName)
+            with mlflow_lock:
+                mlflow.set_tracking_uri(trackingUri)
+            # work around a logging issue in AML to avoid logging PAT
+            os.environ['AZUREML_GIT_REPOSITORY_URI'] = repo.HttpUrl
+            try:
+                run = mlflow.projects.run(uri=fullUrl, 
+                                      version = apiVersion.GitVersion,
+                                      entry_point= operationName,
+                                      parameters=userInput,
+                                      experiment_id = experimentId,
+                                      backend = "azureml",
+                                      backend_config = backend_config,
+                                      synchronous=False)
+            except ExecutionException as e:
+                raise LunaUserException(HTTPStatus.BAD_REQUEST, str(e.message))
         run._run.set_tags(tags)
         return operationId
 
@@ -176,30 +199,45 @@ class AzureMLUtils(object):
         except StopIteration:
             raise LunaUserException(HTTPStatus.NOT_FOUND, 'Operation with id {} does not exist.'.format(operationId))
 
-    def listAllOperations(self, operationName, userId, subscriptionId, runType = "azureml.PipelineRun"):
+    def hasOperationRun(self, operationId, userId, subscriptionId, runType = "azureml.PipelineRun"):
+        """ whether a run was submitted for the operation, its child run may not have started yet """
+        exp = Experiment(self._workspace, subscriptionId)
+        tags = {'userId': userId,
+                'operationId': operationId,
+                'subscriptionId': subscriptionId}
+        return next(exp.get_runs(type=runType, tags=tags), None) is not None
+
+    def listAllOperations(self, operationName, userId, subscriptionId, runType = "azureml.PipelineRun", top = None, skip = 0, executor = None):
+        """ return a page of operations and whether there are more, the run details are fetched on the executor if given """
         experimentName = subscriptionId
         exp = Experiment(self._workspace, experimentName)
         tags = {'userId': userId,
                 'operationName': operationName,
                 'subscriptionId': subscriptionId}
         runs = exp.get_runs(type=runType, tags=tags)
-        resultList = []
-        while True:
-            try:
-                run = next(runs)
-                details = run.get_details()
-                result = {'operationId': run.tags["operationId"],
-                          'operationName': operationName,
-                          'startTime': details["startTimeUtc"],
-                          'endTime': details["endTimeUtc"],
-                          'status': run.status
-                    }
-                resultList.append(result)
-            except StopIteration:
-                break
-        return resultList
+        # one more run than the page size tells whether there is a next page
+        page = list(itertools.islice(runs, skip, skip + top + 1 if top else None))
+        hasMore = bool(top) and len(page) > top
+        if hasMore:
+            page = page[:top]
+
+        def getResult(run):
+            details = run.get_details()
+            return {'operationId': run.tags["operationId"],
+                    'operationName': operationName,
+                    'startTime': details.get("startTimeUtc"),
+                    'endTime': details.get("endTimeUtc"),
+                    'status': run.status
+                }
+
+        if executor:
+            resultList = list(executor.map(getResult, page))
+        else:
+            resultList = [getResult(run) for run in page]
+        return resultList, hasMore
     
-    def getOperationLog(self, operationId, userId, subscriptionId, runType="azureml.PipelineRun"):
+    def getOperationLog(self, operationId, userId, subscriptionId, runType="azureml.PipelineRun", offset = 0):
+        """ return the bytes of the log from offset. the run history doesn't serve ranges, the whole log is downloaded """
         
         tags = {'userId': userId,
                 'operationId': operationId,
@@ -208,19 +246,20 @@ class AzureMLUtils(object):
         experimentName = subscriptionId
         exp = Experiment(self._workspace, experimentName)
         runs = exp.get_runs(type=runType, tags=tags)
-        try:
-            run = next(runs)
-            child_runs = run.get_children()
-            child_run = next(child_runs)
-            with tempfile.TemporaryDirectory() as tmp:
-                path = os.path.join(tmp, 'log.txt')
-                files = child_run.download_file('/logs/log.txt', path)
-                with open(path) as file:
-                    return file.read()
-        except Exception:
-            return ""
+        # the log doesn't exist until the run and its child run have started and written to it. other errors are
+        # raised, so a failed download isn't taken for an empty log
+        run = next(runs, None)
+        child_run = next(run.get_children(), None) if run else None
+        if not child_run or 'logs/log.txt' not in child_run.get_file_names():
+            return b""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'log.txt')
+            files = child_run.download_file('/logs/log.txt', path)
+            with open(path, 'rb') as file:
+                file.seek(offset)
+                return file.read()
 
-    def getOperationOutput(self, operationName, operationId, userId, subscriptionId, runType="azureml.PipelineRun", outputType = "json"):
+    def getOperationOutput(self, operationId, userId, subscriptionId, runType="azureml.PipelineRun", outputType = "json"):
         
         tags = {'userId': userId,
                 'operationId': operationId,
@@ -240,25 +279,18 @@ class AzureMLUtils(object):
                     with open(path) as file:
                         return json.load(file), "json"
             elif outputType == 'file':
-                tmp = tempfile.TemporaryDirectory().name
-                path = os.path.join(tmp, "outputs")
-                zip_file_path = os.path.join(tmp, "output_{}.zip".format(operationId))
-                files = child_run.download_files("/outputs", path, append_prefix=False)
-                zipf = zipfile.ZipFile(zip_file_path, "w", zipfile.ZIP_DEFLATED)
-                self.zipdir(path, zipf, "outputs")
-                zipf.close()
-                return zip_file_path, "file"
+                path = tempfile.mkdtemp()
+                try:
+                    files = child_run.download_files("/outputs", path, append_prefix=False)
+                except Exception:
+                    shutil.rmtree(path, ignore_errors=True)
+                    raise
+                return path, "file"
             else:
                 return None, None
         except StopIteration:
             return None, None
 
-    def zipdir(self, path, ziph, dir):
-    # ziph is zipfile handle
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                ziph.write(os.path.join(root, file), arcname = os.path.relpath(os.path.join(root, file), path))
-
     def listAllOperationOutputs(self, operationNoun, userId, subscriptionId):
         operationName = self.GetOperationNameByNoun(operationNoun)
         experimentName = subscriptionId
@@ -271,7 +303,7 @@ class AzureMLUtils(object):
         while True:
             try:
                 run = next(runs)
-                output, outputType = self.getOperationOutput(operationNoun, run.tags["operationId"], userId, subscriptionId, downloadFiles=False)
+                output, outputType = self.getOperationOutput(run.tags["operationId"], userId, subscriptionId)
                 if output:
                     if outputType == "model" or outputType == "endpoint":
                         results.append(output)
@@ -0,0 +1,88 @@
+from Agent.Exception.LunaExceptions import LunaServerException
+from http import HTTPStatus
+import base64
+import os
+import time
+
+# the largest range dbfs/read returns in one call
+DBFS_READ_MAX_BYTES = 1024 * 1024
+
+class DbfsDownloader(object):
+    """Downloads DBFS files and directories through the DBFS REST API.
+
+    The directory tree is listed first, then every 1 MB range of every file is read as its own task
+    on the executor and written to its offset in the local file. Tasks never wait for other tasks,
+    so a bounded executor can be shared by all downloads. Throttled and failed reads are retried
+    with exponential backoff.
+    """
+
+    def __init__(self, rest_url_format, get_headers, http_client_pool, executor, retries = 3, backoff_factor = 0.5):
+        """ rest_url_format is the REST API url with a placeholder for the operation, get_headers() returns the auth headers """
+        self._rest_url_format = rest_url_format
+        self._get_headers = get_headers
+        self._http_client_pool = http_client_pool
+        self._executor = executor
+        self._retries = retries
+        self._backoff_factor = backoff_factor
+
+    def _get(self, operation, params):
+        url = self._rest_url_format.format(operation)
+        attempt = 0
+        while True:
+            response = self._http_client_pool.get(url, params=params, headers=self._get_headers())
+            if response.ok:
+                return response.json()
+            if attempt >= self._retries or (response.status_code != HTTPStatus.TOO_MANY_REQUESTS and response.status_code < 500):
+                raise LunaServerException("DBFS {} of {} failed with status code {}: {}".format(operation, params["path"], response.status_code, response.text))
+            time.sleep(self._backoff_factor * (2 ** attempt))
+            attempt = attempt + 1
+
+    def _list(self, localPath, path):
+        """ create the local directories, return (local path, dbfs path, size) of the files in the tree """
+        os.makedirs(localPath, exist_ok = True)
+        files = []
+        for file in self._get("dbfs/list", {"path": path}).get("files", []):
+            fileLocalPath = os.path.join(localPath, file["path"][file["path"].rindex('/')+1:])
+            if file["is_dir"]:
+                files.extend(self._list(fileLocalPath, file["path"]))
+            else:
+                files.append((fileLocalPath, file["path"], file["file_size"]))
+        return files
+
+    def _read_range(self, localPath, path, offset, length):
+        data = base64.b64decode(self._get("dbfs/read", {"path": path, "offset": offset, "length": length})["data"])
+        if len(data) != length:
+            raise LunaServerException("DBFS read of {} at offset {} returned {} bytes, expected {}.".format(path, offset, len(data), length))
+        with open(localPath, 'r+b') as file:
+            file.seek(offset)
+            file.write(data)
+
+    def read(self, path, offset = 0):
+        """ return the bytes of the file from offset """
+        size = self._get("dbfs/get-status", {"path": path})["file_size"]
+        chunks = []
+        while offset < size:
+            length = min(DBFS_READ_MAX_BYTES, size - offset)
+            chunks.append(base64.b64decode(self._get("dbfs/read", {"path": path, "offset": offset, "length": length})["data"]))
+            offset = offset + length
+        return b''.join(chunks)
+
+    def download(self, localPath, path, is_dir, size = 0):
+        if is_dir:
+            files = self._list(localPath, path)
+        else:
+            files = [(localPath, path, size)]
+
+        futures = []
+        try:
+            for fileLocalPath, filePath, fileSize in files:
+                # allocate the file, the ranges are written in any order
+                with open(fileLocalPath, 'wb') as file:
+                    file.truncate(fileSize)
+                for offset in range(0, fileSize, DBFS_READ_MAX_BYTES):
+                    futures.append(self._executor.submit(self._read_range, fileLocalPath, filePath, offset, min(DBFS_READ_MAX_BYTES, fileSize - offset)))
+            for future in futures:
+                future.result()
+        finally:
+            for future in futures:
+                future.cancel()
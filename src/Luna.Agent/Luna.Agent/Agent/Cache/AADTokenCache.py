@@ -0,0 +1,8 @@
+from Agent.Cache.RefreshAheadCache import RefreshAheadCache
+
+class AADTokenCache(RefreshAheadCache):
+    """Process level cache of AAD access tokens keyed by (tenant id, client id, resource)"""
+
+    def get_token(self, key, acquire):
+        """ acquire is called to get a new token, it returns (access token, expires in seconds) """
+        return self.get(key, acquire)
@@ -0,0 +1,112 @@
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+import hashlib
+import logging
+import threading
+import time
+
+class APIKeyIndex(object):
+    """In-process index from the hash of an api key to the secret storing it and the owning subscription"""
+
+    def __init__(self, key_vault_helper, refresh_interval_seconds = 30):
+        self._key_vault_helper = key_vault_helper
+        self._refresh_interval_seconds = refresh_interval_seconds
+        # key hash -> (secret name, subscription id)
+        self._index = {}
+        # secret name -> (key hash, subscription id, secret updated time)
+        self._secrets = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._last_refreshed = None
+        # bumped whenever a new key is indexed, so keys rejected before that can be looked up again
+        self.generation = 0
+
+    @staticmethod
+    def hash_key(api_key):
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+    def is_built(self):
+        return self._last_refreshed is not None
+
+    def refresh_due(self):
+        return not self.is_built() or time.monotonic() - self._last_refreshed > self._refresh_interval_seconds
+
+    def lookup(self, api_key):
+        """ return (secret name, subscription id) of the api key, or None. Costs at most one key vault read. """
+        key_hash = self.hash_key(api_key)
+        with self._lock:
+            entry = self._index.get(key_hash)
+        if not entry:
+            return None
+
+        secret_name, subscription_id = entry
+        # double check with the key vault, the key might have been regenerated since it was indexed
+        try:
+            current_value = self._key_vault_helper.get_secret(secret_name, use_buffer = False)
+        except ResourceNotFoundError:
+            self._remove_secret(secret_name)
+            return None
+        if current_value == api_key:
+            return entry
+        self._index_secret(secret_name, subscription_id, current_value)
+        return None
+
+    def refresh(self, subscriptions):
+        """ index secrets of new subscriptions and secrets updated in the key vault since last refresh """
+        with self._refresh_lock:
+            # another thread might have refreshed the index while we are waiting for the lock
+            if not self.refresh_due():
+                return
+
+            owners = {}
+            for subscription in subscriptions:
+                for secret_name in [subscription.PrimaryKeySecretName, subscription.SecondaryKeySecretName]:
+                    if secret_name:
+                        owners[secret_name] = subscription.SubscriptionId
+
+            updated_times = {}
+            for secret in self._key_vault_helper.list_secret_properties():
+                if secret.name in owners:
+                    updated_times[secret.name] = secret.updated_on
+
+            for secret_name in list(self._secrets):
+                if secret_name not in owners:
+                    self._remove_secret(secret_name)
+
+            for secret_name, subscription_id in owners.items():
+                indexed = self._secrets.get(secret_name)
+                updated_on = updated_times.get(secret_name)
+                if indexed and indexed[1] == subscription_id and updated_on and indexed[2] == updated_on:
+                    continue
+                try:
+                    value = self._key_vault_helper.get_secret(secret_name, use_buffer = False)
+                except ResourceNotFoundError:
+                    # the secret was deleted, its key doesn't authenticate anymore
+                    logging.getLogger(__name__).info('API key secret {} not found'.format(secret_name))
+                    self._remove_secret(secret_name)
+                    continue
+                except HttpResponseError as e:
+                    # disabled or unreadable, keep what was indexed and read it again on the next refresh.
+                    # one bad secret mustn't keep the keys of the other subscriptions out of the index
+                    logging.getLogger(__name__).info('Failed to read API key secret {}: {}'.format(secret_name, e))
+                    continue
+                self._index_secret(secret_name, subscription_id, value, updated_on)
+
+            self._last_refreshed = time.monotonic()
+
+    def _index_secret(self, secret_name, subscription_id, value, updated_on = None):
+        with self._lock:
+            self._remove_secret_locked(secret_name)
+            if value:
+                key_hash = self.hash_key(value)
+                self._index[key_hash] = (secret_name, subscription_id)
+                self._secrets[secret_name] = (key_hash, subscription_id, updated_on)
+                self.generation = self.generation + 1
+
+    def _remove_secret(self, secret_name):
+        with self._lock:
+            self._remove_secret_locked(secret_name)
+
+    def _remove_secret_locked(self, secret_name):
+        indexed = self._secrets.pop(secret_name, None)
+        if indexed and self._index.get(indexed[0], (None,))[0] == secret_name:
+            del self._index[indexed[0]]
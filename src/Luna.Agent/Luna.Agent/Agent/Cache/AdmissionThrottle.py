@@ -0,0 +1,41 @@
+from collections import OrderedDict
+import threading
+import time
+
+class AdmissionThrottle(object):
+    """Per-source token buckets. Only failures take tokens, so well behaved sources are never throttled."""
+
+    def __init__(self, refill_per_second = 1.0, burst = 10, max_sources = 10000):
+        self._refill_per_second = refill_per_second
+        self._burst = burst
+        self._max_sources = max_sources
+        # source -> (tokens, last updated time)
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.throttled = 0
+
+    def _tokens(self, source, now):
+        bucket = self._buckets.get(source)
+        if not bucket:
+            return self._burst
+        tokens, updated = bucket
+        return min(self._burst, tokens + (now - updated) * self._refill_per_second)
+
+    def allow(self, source):
+        with self._lock:
+            if self._tokens(source, time.monotonic()) >= 1:
+                return True
+            self.throttled = self.throttled + 1
+            return False
+
+    def record_failure(self, source):
+        with self._lock:
+            now = time.monotonic()
+            self._buckets[source] = (max(0, self._tokens(source, now) - 1), now)
+            self._buckets.move_to_end(source)
+            while len(self._buckets) > self._max_sources:
+                self._buckets.popitem(last = False)
+
+    def stats(self):
+        with self._lock:
+            return {'sources': len(self._buckets), 'throttled': self.throttled}
@@ -0,0 +1,81 @@
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+class ClientPool(object):
+    """Process-wide pool of authenticated clients keyed by id.
+
+    A client is rebuilt when it is older than the time to live or when the credential fingerprint
+    it was built with changes (for example, after a secret rotation).
+    """
+
+    def __init__(self, ttl_seconds = 1800, max_size = 64):
+        self._ttl_seconds = ttl_seconds
+        self._max_size = max_size
+        # key -> (client, fingerprint, created time)
+        self._clients = OrderedDict()
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(*values):
+        return hashlib.sha256('|'.join([str(value) for value in values]).encode('utf-8')).hexdigest()
+
+    def _get_live(self, key, fingerprint = None):
+        entry = self._clients.get(key)
+        if not entry or time.monotonic() - entry[2] > self._ttl_seconds:
+            return None
+        if fingerprint and entry[1] != fingerprint:
+            return None
+        return entry
+
+    def is_live(self, key):
+        with self._lock:
+            return self._get_live(key) is not None
+
+    def checkout(self, key, fingerprint, factory):
+        """ return the pooled client of key, factory is called to build one if there's no live client """
+        with self._lock:
+            entry = self._get_live(key, fingerprint)
+            if entry:
+                self._clients.move_to_end(key)
+                self.hits = self.hits + 1
+                return entry[0]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # only one thread builds the client of a key, the others wait and reuse it
+        with key_lock:
+            try:
+                with self._lock:
+                    entry = self._get_live(key, fingerprint)
+                    if entry:
+                        self.hits = self.hits + 1
+                        return entry[0]
+                    self.misses = self.misses + 1
+                client = factory()
+                with self._lock:
+                    self._clients[key] = (client, fingerprint, time.monotonic())
+                    self._clients.move_to_end(key)
+                    while len(self._clients) > self._max_size:
+                        self._clients.popitem(last = False)
+                return client
+            finally:
+                # the lock is only needed while the client is built, the waiting threads already hold it
+                with self._lock:
+                    if self._key_locks.get(key) is key_lock:
+                        del self._key_locks[key]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._clients.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._clients), 'hits': self.hits, 'misses': self.misses}
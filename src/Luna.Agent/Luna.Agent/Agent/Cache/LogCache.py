@@ -0,0 +1,85 @@
+from collections import OrderedDict
+import threading
+import time
+
+class LogEntry(object):
+
+    def __init__(self):
+        self.data = bytearray()
+        self.complete = False
+        self.fetched_at = 0.0
+        self.lock = threading.Lock()
+
+class LogCache(object):
+    """Bytes of operation logs fetched so far, bounded by their total size and number and evicted least recently used first.
+
+    Only the bytes after the cached ones are fetched, at most once per refresh interval however many clients
+    are tailing the log. The log of a finished operation is never fetched again.
+    """
+
+    def __init__(self, max_bytes = 256 * 1024 * 1024, refresh_seconds = 2, max_entries = 10000):
+        self._max_bytes = max_bytes
+        # empty logs cost no bytes, they are bounded by their number
+        self._max_entries = max_entries
+        self._refresh_seconds = refresh_seconds
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.fetches = 0
+        self.fetched_bytes = 0
+
+    def _entry(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = LogEntry()
+                self._entries[key] = entry
+                self._evict(entry)
+            self._entries.move_to_end(key)
+            return entry
+
+    def _evict(self, keep):
+        """ evict the least recently used entries other than keep until the cache is within its bounds """
+        while (self._bytes > self._max_bytes or len(self._entries) > self._max_entries) and len(self._entries) > 1:
+            evictedKey, evicted = self._entries.popitem(last = False)
+            if evicted is keep:
+                self._entries[evictedKey] = evicted
+                continue
+            self._bytes = self._bytes - len(evicted.data)
+
+    def _append(self, key, entry, data):
+        entry.data.extend(data)
+        with self._lock:
+            self.fetches = self.fetches + 1
+            self.fetched_bytes = self.fetched_bytes + len(data)
+            # the entry may have been evicted while it was fetched
+            if self._entries.get(key) is not entry:
+                return
+            self._bytes = self._bytes + len(data)
+            self._evict(entry)
+
+    def read(self, key, offset, max_bytes, fetch, complete):
+        """ return (log bytes from offset, whether the log is complete). fetch(offset) returns the log bytes
+            from offset, complete tells whether the operation has finished. a read never ends inside a UTF-8 character. """
+        entry = self._entry(key)
+        with entry.lock:
+            if not entry.complete and (complete or time.monotonic() - entry.fetched_at >= self._refresh_seconds):
+                self._append(key, entry, fetch(len(entry.data)))
+                entry.fetched_at = time.monotonic()
+                entry.complete = complete
+            else:
+                with self._lock:
+                    self.hits = self.hits + 1
+
+            end = len(entry.data)
+            if max_bytes and offset + max_bytes < end:
+                end = offset + max_bytes
+                # step back over the continuation bytes of the character being cut
+                while end > offset + 1 and entry.data[end] & 0xC0 == 0x80:
+                    end = end - 1
+            return bytes(entry.data[offset:end]), entry.complete and end >= len(entry.data)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'bytes': self._bytes, 'hits': self.hits, 'fetches': self.fetches, 'fetched_bytes': self.fetched_bytes}
@@ -0,0 +1,72 @@
+import threading
+import time
+
+class RefreshAheadCache(object):
+    """A cache of values with their own expiry, such as access tokens.
+
+    Values close to expiry are refreshed in the background while the current one is still served.
+    Only one refresh per key runs at a time, concurrent callers wait for it instead of loading it again.
+    """
+
+    def __init__(self, refresh_before_seconds = 300, release = None):
+        """ release is called on the background refresh threads when they are done, to free thread-local resources such as db sessions """
+        self._refresh_before_seconds = refresh_before_seconds
+        self._release = release
+        # key -> (value, expires at)
+        self._values = {}
+        self._key_locks = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.refreshes = 0
+
+    def get(self, key, load):
+        """ load is called to get a new value, it returns (value, expires in seconds) """
+        with self._lock:
+            entry = self._values.get(key)
+            now = time.monotonic()
+            if entry and entry[1] > now:
+                self.hits = self.hits + 1
+                if entry[1] - now < self._refresh_before_seconds and key not in self._refreshing:
+                    self._refreshing.add(key)
+                    threading.Thread(target=self._refresh_in_background, args=(key, load), daemon=True).start()
+                return entry[0]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # the value might be refreshed by another thread while we are waiting for the lock
+            with self._lock:
+                entry = self._values.get(key)
+                if entry and entry[1] > time.monotonic():
+                    return entry[0]
+            return self._refresh(key, load)
+
+    def _refresh(self, key, load):
+        value, expires_in = load()
+        with self._lock:
+            self._values[key] = (value, time.monotonic() + float(expires_in))
+            self.refreshes = self.refreshes + 1
+        return value
+
+    def _refresh_in_background(self, key, load):
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                self._refresh(key, load)
+        except Exception:
+            # keep serving the current value, the next call after it expires will refresh synchronously
+            pass
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+            if self._release:
+                self._release()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._values), 'hits': self.hits, 'refreshes': self.refreshes}
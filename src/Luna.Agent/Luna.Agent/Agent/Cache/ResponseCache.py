@@ -0,0 +1,53 @@
+from collections import OrderedDict
+import threading
+import time
+
+class ResponseCache(object):
+    """LRU cache of HTTP responses bounded by the total size of the bodies, each entry has its own time to live"""
+
+    def __init__(self, max_bytes = 64 * 1024 * 1024, max_entry_bytes = 1024 * 1024):
+        self._max_bytes = max_bytes
+        self._max_entry_bytes = max_entry_bytes
+        # key -> (status code, content type, body, expires at)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ return (status code, content type, body) or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[3] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits = self.hits + 1
+                return entry[:3]
+            if entry:
+                self._remove(key)
+            self.misses = self.misses + 1
+            return None
+
+    def set(self, key, status_code, content_type, body, ttl_seconds):
+        if len(body) > self._max_entry_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (status_code, content_type, body, time.monotonic() + ttl_seconds)
+            self._bytes = self._bytes + len(body)
+            while self._bytes > self._max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes = self._bytes - len(entry[2])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses}
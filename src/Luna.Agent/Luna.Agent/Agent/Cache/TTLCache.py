@@ -0,0 +1,62 @@
+from collections import OrderedDict
+import threading
+import time
+
+class TTLCache(object):
+    """A thread-safe, size bounded LRU cache whose entries expire after a time to live"""
+
+    def __init__(self, max_size = 1024, ttl_seconds = 300):
+        self._max_size = max_size
+        self._ttl_seconds = ttl_seconds
+        # key -> (value, expires at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default = None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits = self.hits + 1
+                return entry[0]
+            if entry:
+                del self._entries[key]
+            self.misses = self.misses + 1
+            return default
+
+    def set(self, key, value, ttl_seconds = None):
+        if ttl_seconds is None:
+            ttl_seconds = self._ttl_seconds
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last = False)
+
+    def get_or_load(self, key, loader, ttl_seconds = None):
+        """ read through the cache, loader is only called on a miss. None is never cached. """
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            if value is not None:
+                self.set(key, value, ttl_seconds)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
@@ -1,14 +1,33 @@
 class Constants(object):
     API_VERSION_QUERY_PARAM_NAME = 'api-version'
     OUTPUT_TYPE_QUERY_PARAM_NAME = 'output-type'
+    TOP_QUERY_PARAM_NAME = 'top'
+    CONTINUATION_TOKEN_QUERY_PARAM_NAME = 'continuation-token'
+    OFFSET_QUERY_PARAM_NAME = 'offset'
+    MAX_BYTES_QUERY_PARAM_NAME = 'max-bytes'
+    WAIT_QUERY_PARAM_NAME = 'wait'
+    CONTINUATION_TOKEN_HEADER = 'x-ms-continuation'
     AUTHORIZATION_HEADER = 'Authorization'
     API_KEY_HEADER = 'api-key'
+    IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
     BEARER_TOKEN_PREFIX = 'Bearer '
     DEFAULT_SUBSCRIPTION_ID = 'default'
     HTTP_CONTENT_TYPE_ZIP = 'application/zip'
     HTTP_CONTENT_TYPE_JSON = 'application/json'
+    HTTP_CONTENT_TYPE_EVENT_STREAM = 'text/event-stream'
     HTTP_CONTENT_TYPE_HEADER_NAME = 'Content-Type'
+    HTTP_CONTENT_DISPOSITION_HEADER_NAME = 'Content-Disposition'
+    STREAM_CHUNK_SIZE = 64 * 1024
+    MICRO_BATCHING_SETTINGS_NAME = 'microBatching'
+    RESPONSE_CACHE_SETTINGS_NAME = 'responseCache'
+    DEDUPLICATION_SETTINGS_NAME = 'deduplication'
+    CACHE_STATUS_HEADER = 'X-Cache-Status'
     PREDECESSOR_OP_ID_NA = 'na'
     AML_PIPELINE_RUN_TYPE = 'azureml.PipelineRun'
     AML_SCRIPT_RUN_TYPE = 'azureml.scriptrun'
-    OPERATION_STATUS_PARAMETER_NAME = 'status'
\ No newline at end of file
+    OPERATION_STATUS_PARAMETER_NAME = 'status'
+    OPERATION_QUEUED_STATUS = 'Queued'
+    OPERATION_SUBMITTING_STATUS = 'Submitting'
+    OPERATION_SUBMISSION_FAILED_STATUS = 'SubmissionFailed'
+    AML_TERMINAL_STATUSES = ['Completed', 'Failed', 'Canceled']
+    ADB_TERMINAL_STATUSES = ['FINISHED', 'FAILED', 'KILLED']
\ No newline at end of file
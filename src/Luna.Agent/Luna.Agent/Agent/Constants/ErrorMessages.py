@@ -8,9 +8,17 @@ class UserErrorMessage(object):
     OPERATION_NOT_IN_STATUS = "Operation {} is not in {} status."
     INVALID_CERT = 'Invalid certificate.'
     INVALID_API_KEY = 'The api key is invalid.'
+    TOO_MANY_INVALID_API_KEYS = 'Too many requests with invalid api keys. Retry later.'
     API_NOT_EXIST = 'The API {} in application {} does not exist or you do not have permission to access it.'
     SUBSCRIPTION_NOT_EXIST = "The subscription {} doesn't exist or api key is invalid."
     API_VERSION_NOT_EXIST = "The specified API or API version does not exist or you do not have permission to access it."
     API_VERSION_REQUIRED = "The api-version query parameter is required."
     AAD_TOKEN_REQUIRED = "AAD token is required."
+    INVALID_TOP = "The top query parameter must be an integer between 1 and {}."
+    INVALID_CONTINUATION_TOKEN = "The continuation token is invalid."
+    INVALID_NON_NEGATIVE_INTEGER = "The {} query parameter must be a non-negative integer."
+    BATCH_INPUT_REQUIRED = "The request body must be a JSON object with a list of records in field {}."
+    INVALID_IDEMPOTENCY_KEY = "The Idempotency-Key header must be at most {} characters."
+    IDEMPOTENCY_KEY_REUSED = "The Idempotency-Key {} was already used with a different request."
+    SUBMISSION_FAILED = "The operation could not be submitted. Retry later or contact the publisher."
     INTERNAL_SERVER_ERROR = "The server encountered an internal error and was unable to complete your request."
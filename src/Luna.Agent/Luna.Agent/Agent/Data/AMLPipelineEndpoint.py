@@ -1,5 +1,5 @@
 from sqlalchemy import Column, Integer, String, or_
-from Agent import Base, Session
+from Agent import Base, Session, metadata_cache
 
 class AMLPipelineEndpoint(Base):
     """description of class"""
@@ -16,15 +16,25 @@ class AMLPipelineEndpoint(Base):
 
     @staticmethod
     def ListAll(apiVersionId):
+        return metadata_cache.get_or_load(('AMLPipelineEndpoints', apiVersionId), lambda: AMLPipelineEndpoint.LoadAll(apiVersionId))
+
+    @staticmethod
+    def LoadAll(apiVersionId):
         session = Session()
         pipelines = session.query(AMLPipelineEndpoint).filter_by(APIVersionId = apiVersionId).all()
-        session.close()
+        for item in pipelines:
+            session.expunge(item)
         return pipelines
     
     @staticmethod
     def Get(apiVersionId, pipelineName):
+        return metadata_cache.get_or_load(('AMLPipelineEndpoint', apiVersionId, pipelineName), lambda: AMLPipelineEndpoint.Load(apiVersionId, pipelineName))
+
+    @staticmethod
+    def Load(apiVersionId, pipelineName):
         session = Session()
         model = session.query(AMLPipelineEndpoint).filter_by(APIVersionId = apiVersionId, PipelineEndpointName = pipelineName).first()
 
-        session.close()
+        if model:
+            session.expunge(model)
         return model
\ No newline at end of file
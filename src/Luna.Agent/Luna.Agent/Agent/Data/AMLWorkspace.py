@@ -1,5 +1,5 @@
 from sqlalchemy import Column, Integer, String
-from Agent import Base, Session, key_vault_helper
+from Agent import Base, Session, key_vault_helper, metadata_cache
 from Agent.Azure.AzureMLUtils import AzureMLUtils
 import uuid
 
@@ -26,9 +26,19 @@ class AMLWorkspace(Base):
 
     DeploymentClusters = []
 
-    def GetByIdWithSecrets(workspaceId):
+    def GetByIdWithSecrets(workspaceId, refreshSecret = False):
+        workspace = metadata_cache.get_or_load(('AMLWorkspace', workspaceId), lambda: AMLWorkspace.Load(workspaceId))
+        return AMLWorkspace.CopyWithSecret(workspace, key_vault_helper.get_secret(workspace.AADApplicationSecretName, use_buffer = not refreshSecret))
+
+    def CopyWithSecret(workspace, secret):
+        """ the cached workspace is shared by all requests, the secret is set on a copy of it """
+        copy = AMLWorkspace(**{column.name: getattr(workspace, column.name) for column in AMLWorkspace.__table__.columns})
+        copy.AADApplicationSecret = secret
+        return copy
+
+    def Load(workspaceId):
         session = Session()
         workspace = session.query(AMLWorkspace).filter_by(Id = workspaceId).first()
-        workspace.AADApplicationSecret = key_vault_helper.get_secret(workspace.AADApplicationSecretName)
-        session.close()
+        if workspace:
+            session.expunge(workspace)
         return workspace
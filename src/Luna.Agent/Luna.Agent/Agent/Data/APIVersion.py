@@ -1,5 +1,7 @@
 from sqlalchemy import Column, Integer, String, Boolean
-from Agent import Base, Session
+from Agent import Base, Session, metadata_cache
+from Agent.Constants.Constants import Constants
+import json
 
 class APIVersion(Base):
     """description of class"""
@@ -39,9 +41,52 @@ class APIVersion(Base):
     APIName = Column(String)
     APIType = Column(String)
 
+    # advanced setting -> numeric fields and their minimum values
+    NUMERIC_SETTINGS = {Constants.MICRO_BATCHING_SETTINGS_NAME: {'windowMs': 0, 'maxBatchSize': 1},
+                        Constants.RESPONSE_CACHE_SETTINGS_NAME: {'ttlSeconds': 0},
+                        Constants.DEDUPLICATION_SETTINGS_NAME: {'windowSeconds': 0}}
+
+    def GetAdvancedSettings(self):
+        """ the advanced settings are free form, return an empty dict if they are not a JSON object.
+            a setting with a non-numeric or out of range value is dropped, which disables it. the result is kept on the
+            api version, which is cached, so the settings are only parsed once """
+        settings = getattr(self, '_advancedSettings', None)
+        if settings is None:
+            settings = APIVersion.ParseAdvancedSettings(self.AdvancedSettings)
+            self._advancedSettings = settings
+        return settings
+
+    @staticmethod
+    def ParseAdvancedSettings(text):
+        try:
+            settings = json.loads(text) if text else {}
+        except ValueError:
+            return {}
+        if not isinstance(settings, dict):
+            return {}
+
+        for name, fields in APIVersion.NUMERIC_SETTINGS.items():
+            setting = settings.get(name)
+            if setting is None:
+                continue
+            if not isinstance(setting, dict) or any(not APIVersion.IsNumberAtLeast(setting.get(field, minimum), minimum) for field, minimum in fields.items()):
+                del settings[name]
+        return settings
+
+    @staticmethod
+    def IsNumberAtLeast(value, minimum):
+        return isinstance(value, (int, float)) and not isinstance(value, bool) and value >= minimum
+
     @staticmethod
     def Get(applicationName, apiName, versionName):
+        return metadata_cache.get_or_load(('APIVersion', applicationName, apiName, versionName),
+                                          lambda: APIVersion.Load(applicationName, apiName, versionName))
+
+    @staticmethod
+    def Load(applicationName, apiName, versionName):
         session = Session()
         version = session.query(APIVersion).filter_by(ApplicationName = applicationName, APIName = apiName, VersionName = versionName).first()
-        session.close()
+        # cached objects are shared across requests, detach them from the request session
+        if version:
+            session.expunge(version)
         return version
\ No newline at end of file
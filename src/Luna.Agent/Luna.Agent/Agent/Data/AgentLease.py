@@ -0,0 +1,42 @@
+from sqlalchemy import Column, String, DateTime, or_
+from sqlalchemy.exc import IntegrityError
+from Agent import Base, Session
+from datetime import datetime, timedelta
+
+class AgentLease(Base):
+    """Leases held by one agent process at a time, so a background job runs in only one of the workers and instances"""
+
+    __tablename__ = 'agent_leases'
+
+    Name = Column(String, primary_key = True)
+
+    Holder = Column(String)
+
+    ExpiresTime = Column(DateTime)
+
+    LastUpdatedTime = Column(DateTime)
+
+    @staticmethod
+    def TryAcquire(name, holder, leaseSeconds):
+        """ acquire the lease if it's free or expired, or renew it if holder has it already. return whether holder has it """
+        session = Session()
+        now = datetime.utcnow()
+        count = session.query(AgentLease).filter(AgentLease.Name == name,
+                                                 or_(AgentLease.Holder == holder, AgentLease.ExpiresTime <= now)) \
+                                         .update({AgentLease.Holder: holder,
+                                                  AgentLease.ExpiresTime: now + timedelta(seconds = leaseSeconds),
+                                                  AgentLease.LastUpdatedTime: now}, synchronize_session = False)
+        session.commit()
+        if count > 0:
+            return True
+        if session.query(AgentLease).filter_by(Name = name).first():
+            return False
+
+        session.add(AgentLease(Name = name, Holder = holder, ExpiresTime = now + timedelta(seconds = leaseSeconds), LastUpdatedTime = now))
+        try:
+            session.commit()
+            return True
+        except IntegrityError:
+            # another process created the lease first
+            session.rollback()
+            return False
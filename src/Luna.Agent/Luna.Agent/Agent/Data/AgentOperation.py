@@ -0,0 +1,238 @@
+from sqlalchemy import Column, Integer, Float, String, Boolean, DateTime, or_, and_, func
+from Agent import Base, Session
+from Agent.Constants.Constants import Constants
+from datetime import datetime, timedelta
+
+class AgentOperation(Base):
+    """Operations submitted through the agent. Queued operations are submitted by the submission queue, they are
+    Submitting while an agent submits them. The status of the submitted ones is refreshed by the operation poller until it's terminal"""
+
+    __tablename__ = 'agent_operations'
+
+    # there is no backend run to query yet
+    UNSUBMITTED_STATUSES = [Constants.OPERATION_QUEUED_STATUS, Constants.OPERATION_SUBMITTING_STATUS]
+
+    OperationId = Column(String, primary_key = True)
+
+    SubscriptionId = Column(String)
+
+    UserId = Column(String)
+
+    ApplicationName = Column(String)
+
+    APIName = Column(String)
+
+    APIVersionName = Column(String)
+
+    OperationName = Column(String)
+
+    PredecessorOperationId = Column(String)
+
+    Status = Column(String)
+
+    Progress = Column(Float)
+
+    StartTime = Column(String)
+
+    EndTime = Column(String)
+
+    IsTerminal = Column(Boolean)
+
+    # JSON output of a terminal operation, it doesn't change anymore
+    Output = Column(String)
+
+    # JSON request body, kept until the operation is submitted
+    Input = Column(String)
+
+    Attempts = Column(Integer)
+
+    LastError = Column(String)
+
+    # a queued operation is submitted once it's due, claiming it pushes this back for the duration of the submission
+    NextAttemptTime = Column(DateTime)
+
+    IdempotencyKey = Column(String)
+
+    # hash of the subscription, api version, operation and request body, to find duplicate submissions
+    RequestHash = Column(String)
+
+    CreatedTime = Column(DateTime)
+
+    LastUpdatedTime = Column(DateTime)
+
+    # when the status was last read from the backend, an operation whose status can't be read isn't counted as running forever
+    LastPolledTime = Column(DateTime)
+
+    def ToStatus(self):
+        status = {'operationId': self.OperationId,
+                'operationName': self.OperationName,
+                'startTime': self.StartTime,
+                'endTime': self.EndTime,
+                'status': self.Status,
+                'progress': self.Progress
+            }
+        if self.Status == Constants.OPERATION_SUBMISSION_FAILED_STATUS:
+            status['error'] = self.LastError
+        return status
+
+    @staticmethod
+    def ToText(value):
+        # NaN and NaT (not yet ended runs in mlflow search results) are not equal to themselves
+        if value is None or value != value:
+            return None
+        return str(value)
+
+    @staticmethod
+    def Create(operation):
+        session = Session()
+        operation.IsTerminal = False
+        if operation.Attempts is None:
+            operation.Attempts = 0
+        operation.CreatedTime = datetime.utcnow()
+        operation.LastUpdatedTime = operation.CreatedTime
+        session.add(operation)
+        session.commit()
+        return
+
+    @staticmethod
+    def Get(operationId, subscriptionId, userId):
+        session = Session()
+        return session.query(AgentOperation).filter_by(OperationId = operationId, SubscriptionId = subscriptionId, UserId = userId).first()
+
+    @staticmethod
+    def GetById(operationId):
+        session = Session()
+        return session.query(AgentOperation).filter_by(OperationId = operationId).first()
+
+    @staticmethod
+    def GetByIdempotencyKey(subscriptionId, userId, idempotencyKey):
+        session = Session()
+        return session.query(AgentOperation).filter_by(SubscriptionId = subscriptionId, UserId = userId, IdempotencyKey = idempotencyKey).first()
+
+    @staticmethod
+    def ClearIdempotencyKey(operation):
+        session = Session()
+        operation.IdempotencyKey = None
+        session.commit()
+        return
+
+    @staticmethod
+    def GetDuplicate(subscriptionId, userId, requestHash, createdAfter):
+        """ the latest operation with the same request created after createdAfter, failed submissions are not returned """
+        session = Session()
+        return session.query(AgentOperation).filter(AgentOperation.SubscriptionId == subscriptionId,
+                                                    AgentOperation.UserId == userId,
+                                                    AgentOperation.RequestHash == requestHash,
+                                                    AgentOperation.CreatedTime > createdAfter,
+                                                    or_(AgentOperation.Status == None, AgentOperation.Status != Constants.OPERATION_SUBMISSION_FAILED_STATUS)) \
+                                            .order_by(AgentOperation.CreatedTime.desc()).first()
+
+    @staticmethod
+    def ListActive(top):
+        """ the operations polled least recently come first """
+        session = Session()
+        return session.query(AgentOperation).filter(AgentOperation.IsTerminal == False,
+                                                    or_(AgentOperation.Status == None, AgentOperation.Status.notin_(AgentOperation.UNSUBMITTED_STATUSES))) \
+                                            .order_by(AgentOperation.LastUpdatedTime).limit(top).all()
+
+    @staticmethod
+    def ListQueued(topPerSubscription):
+        """ the oldest queued operations of every subscription which are due, including the ones whose submission lease expired """
+        session = Session()
+        rowNumber = func.row_number().over(partition_by = AgentOperation.SubscriptionId, order_by = AgentOperation.NextAttemptTime).label('RowNumber')
+        due = session.query(AgentOperation.OperationId, rowNumber).filter(AgentOperation.Status.in_(AgentOperation.UNSUBMITTED_STATUSES),
+                                                                          AgentOperation.NextAttemptTime <= datetime.utcnow()).subquery()
+        return session.query(AgentOperation).join(due, AgentOperation.OperationId == due.c.OperationId) \
+                                            .filter(due.c.RowNumber <= topPerSubscription) \
+                                            .order_by(AgentOperation.NextAttemptTime).all()
+
+    @staticmethod
+    def CountRunning(statusMaxAgeSeconds):
+        """ return (application name, api name, api version name, subscription id, count) of the operations being submitted
+            or submitted which aren't terminal. the ones being submitted by any agent are counted, they are Submitting.
+            the submitted ones whose status wasn't read from the backend for statusMaxAgeSeconds are not, their run
+            may have been deleted or their workspace may not be reachable anymore """
+        session = Session()
+        now = datetime.utcnow()
+        return session.query(AgentOperation.ApplicationName, AgentOperation.APIName, AgentOperation.APIVersionName, AgentOperation.SubscriptionId, func.count()) \
+                      .filter(AgentOperation.IsTerminal == False,
+                              or_(and_(or_(AgentOperation.Status == None, AgentOperation.Status.notin_(AgentOperation.UNSUBMITTED_STATUSES)),
+                                       AgentOperation.LastPolledTime > now - timedelta(seconds = statusMaxAgeSeconds)),
+                                  # an expired lease is queued again
+                                  and_(AgentOperation.Status == Constants.OPERATION_SUBMITTING_STATUS, AgentOperation.NextAttemptTime > now))) \
+                      .group_by(AgentOperation.ApplicationName, AgentOperation.APIName, AgentOperation.APIVersionName, AgentOperation.SubscriptionId).all()
+
+    @staticmethod
+    def Claim(operationId, leaseSeconds):
+        """ claim a due queued operation for submission, return None if it's not due or another agent claimed it.
+            the operation is Submitting until the lease expires, then another agent may claim it again """
+        session = Session()
+        now = datetime.utcnow()
+        count = session.query(AgentOperation).filter(AgentOperation.OperationId == operationId,
+                                                     AgentOperation.Status.in_(AgentOperation.UNSUBMITTED_STATUSES),
+                                                     AgentOperation.NextAttemptTime <= now) \
+                                             .update({AgentOperation.Status: Constants.OPERATION_SUBMITTING_STATUS,
+                                                      AgentOperation.NextAttemptTime: now + timedelta(seconds = leaseSeconds),
+                                                      AgentOperation.Attempts: AgentOperation.Attempts + 1,
+                                                      AgentOperation.LastUpdatedTime: now}, synchronize_session = False)
+        session.commit()
+        if count == 0:
+            return None
+        return session.query(AgentOperation).filter_by(OperationId = operationId).first()
+
+    @staticmethod
+    def SetSubmitted(operation):
+        """ the backend run exists, its status is read from the backend from now on """
+        session = Session()
+        operation.Status = None
+        operation.LastError = None
+        operation.NextAttemptTime = None
+        operation.LastUpdatedTime = datetime.utcnow()
+        operation.LastPolledTime = operation.LastUpdatedTime
+        session.commit()
+        return
+
+    @staticmethod
+    def SetSubmissionError(operation, error, nextAttemptTime):
+        """ retry the submission at nextAttemptTime, or give up if it's None """
+        session = Session()
+        operation.LastError = error
+        operation.NextAttemptTime = nextAttemptTime
+        if not nextAttemptTime:
+            operation.Status = Constants.OPERATION_SUBMISSION_FAILED_STATUS
+            operation.IsTerminal = True
+        else:
+            operation.Status = Constants.OPERATION_QUEUED_STATUS
+        operation.LastUpdatedTime = datetime.utcnow()
+        session.commit()
+        return
+
+    @staticmethod
+    def UpdateStatus(operation, status, isTerminal):
+        """ status is the operation status returned by the backend """
+        session = Session()
+        operation.Status = status['status']
+        operation.StartTime = AgentOperation.ToText(status.get('startTime'))
+        operation.EndTime = AgentOperation.ToText(status.get('endTime'))
+        progress = status.get('progress')
+        operation.Progress = float(progress) if progress is not None else None
+        operation.IsTerminal = isTerminal
+        operation.LastUpdatedTime = datetime.utcnow()
+        operation.LastPolledTime = operation.LastUpdatedTime
+        session.commit()
+        return
+
+    @staticmethod
+    def Touch(operation):
+        """ move the operation to the end of the poll order when its status couldn't be refreshed """
+        session = Session()
+        operation.LastUpdatedTime = datetime.utcnow()
+        session.commit()
+        return
+
+    @staticmethod
+    def SaveOutput(operation, output):
+        session = Session()
+        operation.Output = output
+        session.commit()
+        return
@@ -29,35 +29,30 @@ class AgentUser(Base):
     def ListAllUsers():
         session = Session()
         users = session.query(AgentUser).filter_by(Role = "User").all()
-        session.close()
         return users
 
     @staticmethod
     def ListAllBySubscriptionId(subscriptionId):
         session = Session()
         users = session.query(AgentUser).filter_by(SubscriptionId = subscriptionId).all()
-        session.close()
         return users
     
     @staticmethod
     def GetUser(subscriptionId, userId):
         session = Session()
         users = session.query(AgentUser).filter_by(SubscriptionId = subscriptionId, AADUserId = userId).first()
-        session.close()
         return users
 
     @staticmethod
     def ListAllAdmin():
         session = Session()
         users = session.query(AgentUser).filter_by(Role = "Admin").all()
-        session.close()
         return users
     
     @staticmethod
     def GetAdmin(userId):
         session = Session()
         users = session.query(AgentUser).filter_by(AADUserId = userId, Role="Admin").first()
-        session.close()
         return users
 
     @staticmethod
@@ -66,7 +61,6 @@ class AgentUser(Base):
         user = AgentUser.GetUser(subscriptionId, userId)
         session.delete(user)
         session.commit()
-        session.close()
         return
 
     @staticmethod
@@ -75,5 +69,4 @@ class AgentUser(Base):
         admin = AgentUser.GetAdmin(userId)
         session.delete(admin)
         session.commit()
-        session.close()
         return
\ No newline at end of file
@@ -1,5 +1,5 @@
 from sqlalchemy import Column, Integer, String
-from Agent import Base, Session, key_vault_helper
+from Agent import Base, Session, key_vault_helper, metadata_cache
 from Agent.Azure.AzureDatabricksUtils import AzureDatabricksUtils
 import uuid
 
@@ -25,8 +25,18 @@ class AzureDatabricksWorkspace(Base):
     AADApplicationSecret = ""
 
     def GetByIdWithSecrets(workspaceId):
+        workspace = metadata_cache.get_or_load(('AzureDatabricksWorkspace', workspaceId), lambda: AzureDatabricksWorkspace.Load(workspaceId))
+        return AzureDatabricksWorkspace.CopyWithSecret(workspace, key_vault_helper.get_secret(workspace.AADApplicationSecretName))
+
+    def CopyWithSecret(workspace, secret):
+        """ the cached workspace is shared by all requests, the secret is set on a copy of it """
+        copy = AzureDatabricksWorkspace(**{column.name: getattr(workspace, column.name) for column in AzureDatabricksWorkspace.__table__.columns})
+        copy.AADApplicationSecret = secret
+        return copy
+
+    def Load(workspaceId):
         session = Session()
         workspace = session.query(AzureDatabricksWorkspace).filter_by(Id = workspaceId).first()
-        workspace.AADApplicationSecret = key_vault_helper.get_secret(workspace.AADApplicationSecretName)
-        session.close()
+        if workspace:
+            session.expunge(workspace)
         return workspace
@@ -22,7 +22,6 @@ class GitRepo(Base):
     def ListAll():
         session = Session()
         repos = session.query(GitRepo).all()
-        session.close()
         return repos
     
     @staticmethod
@@ -30,7 +29,6 @@ class GitRepo(Base):
         session = Session()
         # Find the model by modelName first
         repo = session.query(GitRepo).filter_by(Id = id).first()
-        session.close()
 
         repo.PersonalAccessToken = key_vault_helper.get_secret(repo.PersonalAccessTokenSecretName)
         return repo
@@ -40,7 +38,6 @@ class GitRepo(Base):
         session = Session()
         # Find the model by modelName first
         repo = session.query(GitRepo).filter_by(RepoName = name).first()
-        session.close()
 
         repo.PersonalAccessToken = key_vault_helper.get_secret(repo.PersonalAccessTokenSecretName)
         return repo
\ No newline at end of file
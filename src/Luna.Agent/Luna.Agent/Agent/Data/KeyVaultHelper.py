@@ -21,6 +21,9 @@ class KeyVaultHelper():
         self._secret_buffer[secret_name] = secret_value
         self._key_vault_client.set_secret(secret_name, secret_value)
 
+    def list_secret_properties(self):
+        return self._key_vault_client.list_properties_of_secrets()
+
     def find_secret_name_by_value(self, secret_value):
         for secret_name in self._secret_buffer:
             # if find the secret with specified value, double check with the secret in key vault
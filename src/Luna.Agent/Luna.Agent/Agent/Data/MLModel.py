@@ -1,5 +1,5 @@
 from sqlalchemy import Column, Integer, String, or_
-from Agent import Base, Session
+from Agent import Base, Session, metadata_cache
 
 class MLModel(Base):
     """description of class"""
@@ -18,13 +18,22 @@ class MLModel(Base):
 
     @staticmethod
     def ListAll(apiVersionId):
+        return metadata_cache.get_or_load(('MLModels', apiVersionId), lambda: MLModel.LoadAll(apiVersionId))
+
+    @staticmethod
+    def LoadAll(apiVersionId):
         session = Session()
         models = session.query(MLModel).filter_by(APIVersionId = apiVersionId).all()
-        session.close()
+        for item in models:
+            session.expunge(item)
         return models
     
     @staticmethod
     def Get(apiVersionId, modelName):
+        return metadata_cache.get_or_load(('MLModel', apiVersionId, modelName), lambda: MLModel.Load(apiVersionId, modelName))
+
+    @staticmethod
+    def Load(apiVersionId, modelName):
         session = Session()
         # Find the model by modelName first
         model = session.query(MLModel).filter_by(APIVersionId = apiVersionId, ModelName = modelName).first()
@@ -32,5 +41,6 @@ class MLModel(Base):
         # If doesn't exist, find model by alternative name
         if not model:
             model = session.query(MLModel).filter_by(APIVersionId = apiVersionId, ModelAlternativeName = modelName).first()
-        session.close()
+        if model:
+            session.expunge(model)
         return model
\ No newline at end of file
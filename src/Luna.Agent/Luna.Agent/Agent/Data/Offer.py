@@ -1,5 +1,5 @@
 from sqlalchemy import Column, Integer, String
-from Agent import Base, Session
+from Agent import Base, Session, metadata_cache
 import jwt, datetime, os
 
 class Offer(Base):
@@ -39,7 +39,6 @@ class Offer(Base):
     def ListMarketplaceOffers(userId):
         session = Session()
         offers = session.query(Offer).filter_by(OfferType = 'Marketplace').all()
-        session.close()
         for offer in offers:
             offer.SubscribePageUrl = "https://ms.portal.azure.com/#create/{}.{}/preview".format(offer.PublisherMicrosoftId, offer.OfferId)
         return offers
@@ -56,7 +55,6 @@ class Offer(Base):
     def ListInternalOffers(userId):
         session = Session()
         offers = session.query(Offer).filter_by(OfferType = 'Internal').all()
-        session.close()
         for offer in offers:
             offer.SubscribePageUrl = "{}?token={}".format(offer.LandingPageUrl, Offer.GetToken(offer, userId))
         return offers
@@ -107,4 +105,5 @@ class Offer(Base):
             raise
 
         finally:
-            session.close()
+            # published APIs might have been changed with the offers
+            metadata_cache.clear()
@@ -1,5 +1,5 @@
 from sqlalchemy import Column, Integer, String
-from Agent import Base, Session
+from Agent import Base, Session, metadata_cache
 
 class PlanApplicationAPI(Base):
     """description of class"""
@@ -15,7 +15,13 @@ class PlanApplicationAPI(Base):
 
     @staticmethod
     def Exists(planId, applicationName, apiName):
+        return metadata_cache.get_or_load(('PlanApplicationAPI', planId, applicationName, apiName),
+                                          lambda: PlanApplicationAPI.Load(planId, applicationName, apiName))
+
+    @staticmethod
+    def Load(planId, applicationName, apiName):
         session = Session()
         publisher = session.query(PlanApplicationAPI).filter_by(PlanId = planId, ApplicationName = applicationName, APIName = apiName).first()
-        session.close()
+        if publisher:
+            session.expunge(publisher)
         return publisher
@@ -1,5 +1,5 @@
 from sqlalchemy import Column, Integer, String
-from Agent import Base, Session
+from Agent import Base, Session, metadata_cache
 
 class Publisher(Base):
     """description of class"""
@@ -18,7 +18,7 @@ class Publisher(Base):
         session = Session()
         session.add(publisher)
         session.commit()
-        session.close()
+        metadata_cache.clear()
         return
 
     @staticmethod
@@ -28,21 +28,19 @@ class Publisher(Base):
         dbPublisher.ControlPlaneUrl = publisher.ControlPlaneUrl
         dbPublisher.Name = publisher.Name
         session.commit()
-        session.close()
+        metadata_cache.clear()
         return publisher.ControlPlaneUrl
 
     @staticmethod
     def ListAll():
         session = Session()
         publishers = session.query(Publisher).all()
-        session.close()
         return publishers
     
     @staticmethod
     def Get(publisherId):
         session = Session()
         publisher = session.query(Publisher).filter_by(PublisherId = publisherId).first()
-        session.close()
         return publisher
 
     @staticmethod
@@ -51,5 +49,5 @@ class Publisher(Base):
         publisher = Publisher.Get(publisherId)
         session.delete(publisher)
         session.commit()
-        session.close()
+        metadata_cache.clear()
         return
\ No newline at end of file
@@ -1,5 +1,5 @@
 from sqlalchemy import Column, Integer, String, DateTime, or_
-from Agent import Base, Session, app, key_vault_helper
+from Agent import Base, Session, app, key_vault_helper, api_key_index
 from Agent.Data.AMLWorkspace import AMLWorkspace
 from Agent.Data.AgentUser import AgentUser
 from Agent.Exception.LunaExceptions import LunaServerException, LunaUserException
@@ -58,7 +58,6 @@ class Subscription(Base):
 
         session = Session()
         subscription = session.query(Subscription).filter_by(SubscriptionId = subscriptionId).first()
-        session.close()
         if not subscription:
             return None
         subscription.PrimaryKey = key_vault_helper.get_secret(subscription.PrimaryKeySecretName)
@@ -71,19 +70,28 @@ class Subscription(Base):
 
     @staticmethod
     def GetByKey(subscriptionKey):
-        session = Session()
-        secret_name = key_vault_helper.find_secret_name_by_value(subscriptionKey)
+        if not api_key_index.is_built():
+            Subscription.RefreshKeyIndex()
+        entry = api_key_index.lookup(subscriptionKey)
+        # the key might belong to a new subscription or a regenerated key, refresh the index incrementally and try again
+        if not entry and api_key_index.refresh_due():
+            Subscription.RefreshKeyIndex()
+            entry = api_key_index.lookup(subscriptionKey)
+        if not entry:
+            return None
+
+        secret_name, subscriptionId = entry
         app.logger.info(secret_name)
-        if secret_name:
-            subscription = session.query(Subscription).filter(or_(Subscription.PrimaryKeySecretName == secret_name, Subscription.SecondaryKeySecretName == secret_name)).first()            
-        else:
-            subscription = None
-        session.close()
+        session = Session()
+        subscription = session.query(Subscription).filter_by(SubscriptionId = subscriptionId).first()
         return subscription
 
+    @staticmethod
+    def RefreshKeyIndex():
+        api_key_index.refresh(Subscription.ListAll())
+
     @staticmethod
     def ListAll():
         session = Session()
         subscriptions = session.query(Subscription).all()
-        session.close()
         return subscriptions
\ No newline at end of file
@@ -0,0 +1,52 @@
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from urllib3.util.retry import Retry
+import requests
+import threading
+
+class HttpClientPool(object):
+    """Keep-alive HTTP sessions, one per upstream host.
+
+    Failed connections are retried for all methods, since the request never reached the upstream.
+    Read failures are only retried for idempotent methods.
+    """
+
+    def __init__(self, pool_size = 10, connect_timeout = 5, read_timeout = 60, retries = 2, backoff_factor = 0.1):
+        self._pool_size = pool_size
+        self._timeout = (connect_timeout, read_timeout)
+        self._retries = retries
+        self._backoff_factor = backoff_factor
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get_session(self, url):
+        parsed = urlparse(url)
+        host_url = '{}://{}'.format(parsed.scheme, parsed.netloc)
+        with self._lock:
+            session = self._sessions.get(host_url)
+            if not session:
+                retry = Retry(total = self._retries,
+                              connect = self._retries,
+                              read = self._retries,
+                              status = 0,
+                              backoff_factor = self._backoff_factor,
+                              raise_on_status = False)
+                adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = self._pool_size, max_retries = retry)
+                session = requests.Session()
+                session.mount(host_url, adapter)
+                self._sessions[host_url] = session
+            return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self._timeout)
+        return self.get_session(url).request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data = None, **kwargs):
+        return self.request('POST', url, data = data, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {'hosts': len(self._sessions)}
@@ -0,0 +1,109 @@
+import threading
+
+class BatchItem(object):
+
+    def __init__(self, records):
+        self.records = records
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class Batch(object):
+
+    def __init__(self):
+        self.items = []
+        self.size = 0
+        self.full = threading.Event()
+
+class MicroBatcher(object):
+    """Merges the records of concurrent requests to the same endpoint into one upstream call.
+
+    The first request of a batch waits for the batch window (or until the batch is full), sends
+    all records in one call and hands each request its own slice of the results. If the call fails
+    or doesn't return one result per record, the requests of the batch are sent one by one.
+    """
+
+    def __init__(self):
+        self._batches = {}
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.records = 0
+        self.fallbacks = 0
+
+    def submit(self, key, records, window_seconds, max_batch_size, send):
+        """ send(records) is called once per batch and returns one result per record. a request sent on its own
+            gets what send returns for its records """
+        item = BatchItem(records)
+        leader = False
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch and batch.size + len(records) > max_batch_size:
+                # no room for the records in the current batch, send it now and start a new one
+                del self._batches[key]
+                batch.full.set()
+                batch = None
+            if not batch:
+                batch = Batch()
+                self._batches[key] = batch
+                leader = True
+            batch.items.append(item)
+            batch.size = batch.size + len(records)
+            if batch.size >= max_batch_size:
+                del self._batches[key]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(window_seconds)
+            with self._lock:
+                if self._batches.get(key) is batch:
+                    del self._batches[key]
+                self.batches = self.batches + 1
+                self.records = self.records + batch.size
+            self._send(batch, send)
+
+        item.done.wait()
+        if item.error:
+            raise item.error
+        return item.result
+
+    def _send(self, batch, send):
+        try:
+            try:
+                results = send([record for batchItem in batch.items for record in batchItem.records])
+            except Exception:
+                if len(batch.items) == 1:
+                    raise
+                # one request's records may have failed the whole batch
+                self._send_each(batch, send)
+                return
+            if isinstance(results, list) and len(results) == batch.size:
+                offset = 0
+                for batchItem in batch.items:
+                    batchItem.result = results[offset:offset + len(batchItem.records)]
+                    offset = offset + len(batchItem.records)
+            elif len(batch.items) == 1:
+                # the result of a request sent on its own is passed on as is
+                batch.items[0].result = results
+            else:
+                # not one result per record, the endpoint doesn't score the records independently
+                self._send_each(batch, send)
+        except Exception as e:
+            for batchItem in batch.items:
+                batchItem.error = e
+        finally:
+            for batchItem in batch.items:
+                batchItem.done.set()
+
+    def _send_each(self, batch, send):
+        """ send the records of each request on their own, only the requests which fail on their own get an error """
+        with self._lock:
+            self.fallbacks = self.fallbacks + 1
+        for batchItem in batch.items:
+            try:
+                batchItem.result = send(batchItem.records)
+            except Exception as e:
+                batchItem.error = e
+
+    def stats(self):
+        with self._lock:
+            return {'batches': self.batches, 'records': self.records, 'fallbacks': self.fallbacks, 'pending': len(self._batches)}
@@ -0,0 +1,39 @@
+import threading
+
+class AgentMetrics(object):
+    """Process level counters, timings and gauges of the agent"""
+
+    def __init__(self):
+        self._counters = {}
+        # name -> [count, total, max]
+        self._timings = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            timing = self._timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] = timing[0] + 1
+            timing[1] = timing[1] + value
+            timing[2] = max(timing[2], value)
+
+    def register_gauge(self, name, func):
+        """ func is called when a snapshot is taken """
+        with self._lock:
+            self._gauges[name] = func
+
+    def snapshot(self):
+        with self._lock:
+            result = {'counters': dict(self._counters), 'timings': {}, 'gauges': {}}
+            for name, timing in self._timings.items():
+                result['timings'][name] = {'count': timing[0],
+                                           'average': timing[1] / timing[0] if timing[0] else 0,
+                                           'max': timing[2]}
+            gauges = dict(self._gauges)
+        for name, func in gauges.items():
+            result['gauges'][name] = func()
+        return result
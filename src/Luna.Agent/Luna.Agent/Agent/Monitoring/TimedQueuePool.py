@@ -0,0 +1,15 @@
+from sqlalchemy.pool import QueuePool
+import time
+
+class TimedQueuePool(QueuePool):
+    """QueuePool recording how long each connection checkout waits in the agent metrics"""
+
+    metrics = None
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            if self.metrics:
+                self.metrics.observe('db_pool.checkout_wait_seconds', time.monotonic() - start)
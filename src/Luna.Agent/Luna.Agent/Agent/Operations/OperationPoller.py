@@ -0,0 +1,42 @@
+import logging
+import threading
+import time
+
+class OperationPoller(object):
+    """Calls refresh() on a background thread every interval. refresh returns the number of operations it refreshed."""
+
+    def __init__(self, interval_seconds = 15):
+        self._interval_seconds = interval_seconds
+        self._thread = None
+        self._lock = threading.Lock()
+        self.polls = 0
+        self.refreshed = 0
+        self.errors = 0
+        self.last_poll_seconds = 0.0
+
+    def start(self, refresh):
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, args=(refresh,), daemon=True)
+            self._thread.start()
+
+    def _run(self, refresh):
+        while True:
+            time.sleep(self._interval_seconds)
+            startTime = time.time()
+            try:
+                count = refresh()
+                with self._lock:
+                    self.refreshed = self.refreshed + count
+            except Exception as e:
+                logging.getLogger(__name__).info(e)
+                with self._lock:
+                    self.errors = self.errors + 1
+            with self._lock:
+                self.polls = self.polls + 1
+                self.last_poll_seconds = time.time() - startTime
+
+    def stats(self):
+        with self._lock:
+            return {'polls': self.polls, 'refreshed': self.refreshed, 'errors': self.errors, 'last_poll_seconds': self.last_poll_seconds}
@@ -0,0 +1,85 @@
+import threading
+
+class OperationScheduler(object):
+    """Picks the queued operations to submit.
+
+    At most max_per_target operations run on a compute target and at most max_per_subscription for a subscription,
+    the rest wait in the queue. Free slots go to the subscriptions in weighted fair order (start-time fair queueing):
+    the next dispatch of a subscription starts at the later of the virtual time and the finish time of its previous
+    dispatch, and finishes 1 / weight later. The earliest start goes next and the virtual time moves to it. A subscription
+    with a deep queue gets its share of the slots without delaying the others.
+    """
+
+    def __init__(self, max_per_target = 10, max_per_subscription = 5, weights = None):
+        self._max_per_target = max_per_target
+        self._max_per_subscription = max_per_subscription
+        # subscription id -> weight, 1 if not set
+        self._weights = weights or {}
+        self._virtual_time = 0.0
+        # subscription id -> virtual finish time of its last dispatch
+        self._finish = {}
+        self._lock = threading.Lock()
+        self.dispatched = 0
+        self.queued = 0
+        self.queued_by_target = {}
+        self.oldest_wait_seconds = 0.0
+
+    def _weight(self, subscriptionId):
+        return float(self._weights.get(subscriptionId, 1))
+
+    def schedule(self, queued, running_by_target, running_by_subscription, now):
+        """ queued is a list of (operation id, target, subscription id, queued time), oldest first for each subscription.
+            running_by_target and running_by_subscription count the operations running or being submitted.
+            return the queued operations to submit now, in order. """
+        bySubscription = {}
+        for operation in queued:
+            bySubscription.setdefault(operation[2], []).append(operation)
+        runningByTarget = dict(running_by_target)
+        runningBySubscription = dict(running_by_subscription)
+
+        result = []
+        with self._lock:
+            while True:
+                best = None
+                for subscriptionId, operations in bySubscription.items():
+                    if runningBySubscription.get(subscriptionId, 0) >= self._max_per_subscription:
+                        continue
+                    # the oldest operation whose compute target has a free slot
+                    operation = next((operation for operation in operations if runningByTarget.get(operation[1], 0) < self._max_per_target), None)
+                    if operation is None:
+                        continue
+                    start = max(self._virtual_time, self._finish.get(subscriptionId, 0.0))
+                    finish = start + 1.0 / self._weight(subscriptionId)
+                    if best is None or (start, finish) < best[:2]:
+                        best = (start, finish, operation)
+                if best is None:
+                    break
+
+                start, finish, operation = best
+                operationId, target, subscriptionId, queuedTime = operation
+                self._virtual_time = start
+                self._finish[subscriptionId] = finish
+                bySubscription[subscriptionId].remove(operation)
+                runningByTarget[target] = runningByTarget.get(target, 0) + 1
+                runningBySubscription[subscriptionId] = runningBySubscription.get(subscriptionId, 0) + 1
+                result.append(operation)
+
+            # finish times before the virtual time don't make a difference anymore
+            for subscriptionId in [subscriptionId for subscriptionId, finish in self._finish.items() if finish <= self._virtual_time]:
+                del self._finish[subscriptionId]
+
+            waiting = [operation for operations in bySubscription.values() for operation in operations]
+            self.dispatched = self.dispatched + len(result)
+            self.queued = len(waiting)
+            self.queued_by_target = {}
+            for operation in waiting:
+                self.queued_by_target[str(operation[1])] = self.queued_by_target.get(str(operation[1]), 0) + 1
+            self.oldest_wait_seconds = max([(now - operation[3]).total_seconds() for operation in waiting] or [0.0])
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {'queued': self.queued,
+                    'queued_by_target': dict(self.queued_by_target),
+                    'oldest_wait_seconds': self.oldest_wait_seconds,
+                    'dispatched': self.dispatched}
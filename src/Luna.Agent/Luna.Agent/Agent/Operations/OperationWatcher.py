@@ -0,0 +1,100 @@
+import hashlib
+import json
+import threading
+import time
+
+class Watch(object):
+
+    def __init__(self, condition):
+        self.condition = condition
+        self.status = None
+        self.etag = None
+        self.is_terminal = False
+        self.error = None
+        self.subscribers = 0
+        self.last_seen = time.monotonic()
+
+class OperationWatcher(object):
+    """Long polls on the status of operations.
+
+    The first client waiting on an operation starts a watch, which polls the status on a background thread
+    and wakes every waiting client when it changes. The backend is polled once per watched operation
+    whatever the number of clients. A watch stops once the operation is terminal, or no client waited on it
+    for an interval.
+    """
+
+    def __init__(self, interval_seconds = 5, max_watches = 1000):
+        self._interval_seconds = interval_seconds
+        self._max_watches = max_watches
+        self._watches = {}
+        self._lock = threading.Lock()
+        self.polls = 0
+        self.notifications = 0
+        self.rejected = 0
+
+    @staticmethod
+    def etag(status):
+        return hashlib.sha1(json.dumps(status, sort_keys = True, default = str).encode('utf-8')).hexdigest()
+
+    def wait(self, key, poll, etag, timeout):
+        """ return (status, etag, is terminal) once the status etag differs from etag, or the current one at the timeout.
+            poll() returns (status, is terminal). the status is None if the first poll hasn't finished or there are
+            too many watches already. """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            watch = self._watches.get(key)
+            if watch is None:
+                if len(self._watches) >= self._max_watches:
+                    self.rejected = self.rejected + 1
+                    return None, None, False
+                watch = Watch(threading.Condition(self._lock))
+                self._watches[key] = watch
+                threading.Thread(target=self._run, args=(key, watch, poll), daemon=True).start()
+
+            watch.subscribers = watch.subscribers + 1
+            try:
+                while watch.error is None and (watch.status is None or (watch.etag == etag and not watch.is_terminal)):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    watch.condition.wait(remaining)
+                if watch.error is not None:
+                    raise watch.error
+                return watch.status, watch.etag, watch.is_terminal
+            finally:
+                watch.subscribers = watch.subscribers - 1
+                watch.last_seen = time.monotonic()
+
+    def _run(self, key, watch, poll):
+        while True:
+            status = None
+            error = None
+            try:
+                status, isTerminal = poll()
+            except Exception as e:
+                error = e
+            with self._lock:
+                self.polls = self.polls + 1
+                if error is not None:
+                    watch.error = error
+                else:
+                    etag = OperationWatcher.etag(status)
+                    if etag != watch.etag:
+                        watch.status = status
+                        watch.etag = etag
+                        watch.is_terminal = isTerminal
+                        self.notifications = self.notifications + 1
+                watch.condition.notify_all()
+                idle = watch.subscribers == 0 and time.monotonic() - watch.last_seen >= self._interval_seconds
+                if watch.error is not None or watch.is_terminal or idle:
+                    del self._watches[key]
+                    return
+            time.sleep(self._interval_seconds)
+
+    def stats(self):
+        with self._lock:
+            return {'watches': len(self._watches),
+                    'subscribers': sum([watch.subscribers for watch in self._watches.values()]),
+                    'polls': self.polls,
+                    'notifications': self.notifications,
+                    'rejected': self.rejected}
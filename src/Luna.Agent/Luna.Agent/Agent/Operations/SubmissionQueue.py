@@ -0,0 +1,88 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import logging
+import threading
+
+class SubmissionQueue(object):
+    """Submits queued operations to their backends on a pool of threads.
+
+    The queued operations are kept in the operation index, so they survive a restart. A dispatcher thread
+    lists the operations which are due whenever one is queued or a submission finishes, and at least every
+    interval. The scheduler decides which of them are submitted now and in which order.
+    """
+
+    def __init__(self, scheduler, threads = 4, interval_seconds = 5, metrics = None):
+        self._scheduler = scheduler
+        self._executor = ThreadPoolExecutor(threads)
+        self._interval_seconds = interval_seconds
+        self._metrics = metrics
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        # operation id -> (target, subscription id) of the operations being submitted
+        self._in_flight = {}
+        self.submitted = 0
+        self.errors = 0
+
+    def start(self, list_queued, count_running, submit):
+        """ list_queued() returns (operation id, target, subscription id, queued time) of the queued operations which are due.
+            count_running() returns the counts of the operations being submitted or submitted which aren't terminal, by target and by subscription.
+            submit(operation id) submits one of them. """
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, args=(list_queued, count_running, submit), daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        self._wake.set()
+
+    def _dispatch(self, list_queued, count_running, submit):
+        queued = list_queued()
+        runningByTarget, runningBySubscription = count_running()
+        queuedIds = set([operation[0] for operation in queued])
+        with self._lock:
+            queued = [operation for operation in queued if operation[0] not in self._in_flight]
+            # the claimed operations are counted as running already, the ones dispatched but not claimed yet are still queued
+            for operationId, (target, subscriptionId) in self._in_flight.items():
+                if operationId in queuedIds:
+                    runningByTarget[target] = runningByTarget.get(target, 0) + 1
+                    runningBySubscription[subscriptionId] = runningBySubscription.get(subscriptionId, 0) + 1
+
+        now = datetime.utcnow()
+        for operationId, target, subscriptionId, queuedTime in self._scheduler.schedule(queued, runningByTarget, runningBySubscription, now):
+            with self._lock:
+                self._in_flight[operationId] = (target, subscriptionId)
+            if self._metrics:
+                self._metrics.observe('operation_queue.wait_seconds', (now - queuedTime).total_seconds())
+            self._executor.submit(self._submit, submit, operationId)
+
+    def _run(self, list_queued, count_running, submit):
+        while True:
+            self._wake.wait(self._interval_seconds)
+            self._wake.clear()
+            try:
+                self._dispatch(list_queued, count_running, submit)
+            except Exception as e:
+                logging.getLogger(__name__).info(e)
+                with self._lock:
+                    self.errors = self.errors + 1
+
+    def _submit(self, submit, operationId):
+        try:
+            submit(operationId)
+            with self._lock:
+                self.submitted = self.submitted + 1
+        except Exception as e:
+            logging.getLogger(__name__).info(e)
+            with self._lock:
+                self.errors = self.errors + 1
+        finally:
+            with self._lock:
+                del self._in_flight[operationId]
+            # a slot is free
+            self._wake.set()
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': len(self._in_flight), 'submitted': self.submitted, 'errors': self.errors}
@@ -3,36 +3,177 @@ The flask application package.
 """
 
 from flask import Flask, request
+from werkzeug.middleware.proxy_fix import ProxyFix
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import create_engine
-import urllib, os, logging
-from sqlalchemy.orm import sessionmaker
+import urllib, os, logging, threading, tempfile, json
+from sqlalchemy.orm import sessionmaker, scoped_session
 from azure.keyvault.secrets import SecretClient
 from azure.identity import DefaultAzureCredential
 from azure.storage.blob import BlobServiceClient
 from Agent.Data.AlchemyEncoder import AlchemyEncoder
 from Agent.Data.KeyVaultHelper import KeyVaultHelper
+from Agent.Cache.APIKeyIndex import APIKeyIndex
+from Agent.Cache.TTLCache import TTLCache
+from Agent.Cache.AdmissionThrottle import AdmissionThrottle
+from Agent.Cache.ClientPool import ClientPool
+from Agent.Cache.AADTokenCache import AADTokenCache
+from Agent.Cache.RefreshAheadCache import RefreshAheadCache
+from Agent.Cache.ResponseCache import ResponseCache
+from Agent.Cache.LogCache import LogCache
+from Agent.Monitoring.AgentMetrics import AgentMetrics
+from Agent.Http.HttpClientPool import HttpClientPool
+from Agent.Http.MicroBatcher import MicroBatcher
+from Agent.Artifacts.ArtifactCache import ArtifactCache
+from Agent.Operations.OperationPoller import OperationPoller
+from Agent.Operations.OperationWatcher import OperationWatcher
+from Agent.Operations.SubmissionQueue import SubmissionQueue
+from Agent.Operations.OperationScheduler import OperationScheduler
+from Agent.Monitoring.TimedQueuePool import TimedQueuePool
+from concurrent.futures import ThreadPoolExecutor
 from logging import StreamHandler
 from applicationinsights.flask.ext import AppInsights
 
 app = Flask(__name__)
 app.config.from_object('config')
+# only trust the X-Forwarded-For entries added by our own proxies, the leftmost ones are set by the client.
+# without a proxy in front of the agent the header is the client's own, so it's only read when the proxies are configured
+trusted_proxy_count = int(os.environ.get('TRUSTED_PROXY_COUNT', '0'))
+if trusted_proxy_count > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxy_count)
 app.json_encoder = AlchemyEncoder
 
 Base = declarative_base()
 
+agent_metrics = AgentMetrics()
+
 credential = DefaultAzureCredential()
 key_vault_client = SecretClient(vault_url='https://{}.vault.azure.net/'.format(os.environ['KEY_VAULT_NAME']), credential=credential)
 
 key_vault_helper = KeyVaultHelper(key_vault_client)
 
+api_key_index = APIKeyIndex(key_vault_helper, int(os.environ.get('API_KEY_INDEX_REFRESH_INTERVAL_SECONDS', '30')))
+
+# hashes of rejected api keys, so a bad key doesn't trigger an index refresh on every request
+rejected_api_key_cache = TTLCache(int(os.environ.get('REJECTED_API_KEY_CACHE_SIZE', '10000')),
+                                  int(os.environ.get('REJECTED_API_KEY_CACHE_TTL_SECONDS', '300')))
+
+# throttle sources sending invalid api keys
+api_key_throttle = AdmissionThrottle(float(os.environ.get('INVALID_API_KEY_REFILL_PER_SECOND', '1')),
+                                     int(os.environ.get('INVALID_API_KEY_BURST', '10')))
+
+# authenticated AML workspace clients keyed by workspace id
+aml_client_pool = ClientPool(int(os.environ.get('AML_CLIENT_POOL_TTL_SECONDS', '1800')),
+                             int(os.environ.get('AML_CLIENT_POOL_SIZE', '64')))
+
+# published API metadata (api versions, plans, workspaces, models and pipelines), read on every request but rarely changed
+metadata_cache = TTLCache(int(os.environ.get('METADATA_CACHE_SIZE', '4096')),
+                          int(os.environ.get('METADATA_CACHE_TTL_SECONDS', '60')))
+
+# AAD tokens of service principals, shared across requests
+aad_token_cache = AADTokenCache(int(os.environ.get('AAD_TOKEN_REFRESH_BEFORE_SECONDS', '300')), lambda: Session.remove())
+
+# resolved scoring url and auth headers of published endpoints, keyed by api version.
+# the loader reads workspaces from the db, background refreshes release their session when done
+scoring_endpoint_cache = RefreshAheadCache(int(os.environ.get('SCORING_ENDPOINT_REFRESH_BEFORE_SECONDS', '120')), lambda: Session.remove())
+
+# keep-alive connections to the scoring endpoints
+http_client_pool = HttpClientPool(int(os.environ.get('UPSTREAM_HTTP_POOL_SIZE', '10')),
+                                  float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT_SECONDS', '5')),
+                                  float(os.environ.get('UPSTREAM_READ_TIMEOUT_SECONDS', '60')),
+                                  int(os.environ.get('UPSTREAM_RETRIES', '2')))
+
+# merges concurrent predictions of api versions with micro batching enabled
+micro_batcher = MicroBatcher()
+
+# responses of api versions with response caching enabled, keyed by the hash of the request body
+prediction_cache = ResponseCache(int(os.environ.get('PREDICTION_CACHE_MAX_BYTES', str(64 * 1024 * 1024))),
+                                 int(os.environ.get('PREDICTION_CACHE_MAX_ENTRY_BYTES', str(1024 * 1024))))
+
+# mlflow experiment ids, parent runs of the operations and their child runs in Databricks workspaces
+mlflow_run_cache = TTLCache(int(os.environ.get('MLFLOW_RUN_CACHE_SIZE', '4096')),
+                            int(os.environ.get('MLFLOW_RUN_CACHE_TTL_SECONDS', '10')))
+
+# mlflow keeps the tracking uri, experiment and Databricks credentials process-wide, every mlflow call holds this lock.
+# AML project submissions only hold it while they point mlflow at their workspace
+mlflow_lock = threading.RLock()
+
+# AML project submissions run one at a time, they pass the git repository to AML in a process-wide environment variable
+aml_project_lock = threading.RLock()
+
+# log bytes of the operations fetched so far, clients tailing a log only cause the new bytes to be fetched
+log_cache = LogCache(int(os.environ.get('LOG_CACHE_MAX_BYTES', str(256 * 1024 * 1024))),
+                     int(os.environ.get('LOG_REFRESH_SECONDS', '2')),
+                     int(os.environ.get('LOG_CACHE_SIZE', '10000')))
+
+# zipped model versions on local disk, set the budget to 0 to stream every download from the model repo
+artifact_cache = ArtifactCache(os.environ.get('ARTIFACT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'luna_artifacts')),
+                               int(os.environ.get('ARTIFACT_CACHE_MAX_BYTES', str(10 * 1024 * 1024 * 1024))))
+
+# compresses the blocks of archives being built, shared by all requests
+archive_executor = ThreadPoolExecutor(int(os.environ.get('ARCHIVE_THREADS', str(os.cpu_count() or 1))))
+
+# range reads of DBFS downloads, shared by all requests
+dbfs_executor = ThreadPoolExecutor(int(os.environ.get('DBFS_DOWNLOAD_THREADS', '8')))
+
+# fetches the details of the runs listed in one request concurrently
+operation_executor = ThreadPoolExecutor(int(os.environ.get('OPERATION_DETAILS_THREADS', '8')))
+
+# refreshes the status of the operations in the operation index which are still running
+operation_poller = OperationPoller(int(os.environ.get('OPERATION_POLL_INTERVAL_SECONDS', '15')))
+
+# watches the status of the operations clients are long polling or streaming
+operation_watcher = OperationWatcher(int(os.environ.get('OPERATION_WATCH_INTERVAL_SECONDS', '5')),
+                                     int(os.environ.get('OPERATION_MAX_WATCHES', '1000')))
+
+# limits the running operations per compute target and per subscription, the weights are a JSON object keyed by subscription id
+operation_scheduler = OperationScheduler(int(os.environ.get('OPERATION_MAX_RUNNING_PER_TARGET', '10')),
+                                         int(os.environ.get('OPERATION_MAX_RUNNING_PER_SUBSCRIPTION', '5')),
+                                         json.loads(os.environ.get('OPERATION_SUBSCRIPTION_WEIGHTS', '{}')))
+
+# submits the queued operations to the AML and Azure Databricks workspaces
+submission_queue = SubmissionQueue(operation_scheduler,
+                                   int(os.environ.get('SUBMISSION_THREADS', '4')),
+                                   int(os.environ.get('SUBMISSION_POLL_INTERVAL_SECONDS', '5')),
+                                   agent_metrics)
+
+agent_metrics.register_gauge('rejected_api_key_cache', rejected_api_key_cache.stats)
+agent_metrics.register_gauge('api_key_throttle', api_key_throttle.stats)
+agent_metrics.register_gauge('aml_client_pool', aml_client_pool.stats)
+agent_metrics.register_gauge('aad_token_cache', aad_token_cache.stats)
+agent_metrics.register_gauge('metadata_cache', metadata_cache.stats)
+agent_metrics.register_gauge('http_client_pool', http_client_pool.stats)
+agent_metrics.register_gauge('scoring_endpoint_cache', scoring_endpoint_cache.stats)
+agent_metrics.register_gauge('micro_batcher', micro_batcher.stats)
+agent_metrics.register_gauge('prediction_cache', prediction_cache.stats)
+agent_metrics.register_gauge('artifact_cache', artifact_cache.stats)
+agent_metrics.register_gauge('mlflow_run_cache', mlflow_run_cache.stats)
+agent_metrics.register_gauge('log_cache', log_cache.stats)
+agent_metrics.register_gauge('operation_poller', operation_poller.stats)
+agent_metrics.register_gauge('operation_watcher', operation_watcher.stats)
+agent_metrics.register_gauge('submission_queue', submission_queue.stats)
+agent_metrics.register_gauge('operation_scheduler', operation_scheduler.stats)
+agent_metrics.register_gauge('db_pool', lambda: {'size': engine.pool.size(),
+                                                 'checked_out': engine.pool.checkedout(),
+                                                 'overflow': engine.pool.overflow()})
+
 odbc_connection_string = os.environ['ODBC_CONNECTION_STRING']
 
-engine = create_engine(odbc_connection_string)
+TimedQueuePool.metrics = agent_metrics
+
+# size the pool against the number of worker threads, each request holds at most one connection
+engine = create_engine(odbc_connection_string,
+                       poolclass=TimedQueuePool,
+                       pool_size=int(os.environ.get('DB_POOL_SIZE', '5')),
+                       max_overflow=int(os.environ.get('DB_POOL_MAX_OVERFLOW', '10')),
+                       pool_timeout=int(os.environ.get('DB_POOL_TIMEOUT_SECONDS', '30')),
+                       pool_recycle=int(os.environ.get('DB_POOL_RECYCLE_SECONDS', '1800')),
+                       pool_pre_ping=os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true')
 
 ## engine = create_engine("mssql+pyodbc:///?odbc_connect=%s" % params)
 
-Session = sessionmaker(bind=engine, autoflush=False)
+# one session per request (or background thread), removed when the request is torn down
+Session = scoped_session(sessionmaker(bind=engine, autoflush=False))
 
 if 'APPINSIGHTS_INSTRUMENTATIONKEY' in os.environ:
     app.config['APPINSIGHTS_INSTRUMENTATIONKEY'] = os.environ['APPINSIGHTS_INSTRUMENTATIONKEY']
@@ -48,4 +189,27 @@ def after_request(response):
         appinsights.flush()
     return response
 
+@app.teardown_request
+def teardown_request(exception):
+    Session.remove()
+
 import Agent.views
+
+from Agent.Data.Subscription import Subscription
+
+# build the api key index at startup so the first requests don't pay for it
+def build_api_key_index():
+    try:
+        Subscription.RefreshKeyIndex()
+    except Exception as e:
+        app.logger.info(e)
+    finally:
+        Session.remove()
+
+threading.Thread(target=build_api_key_index, daemon=True).start()
+
+if os.environ.get('OPERATION_POLLER_ENABLED', 'true').lower() == 'true':
+    operation_poller.start(Agent.views.refreshActiveOperations)
+
+if os.environ.get('SUBMISSION_QUEUE_ENABLED', 'true').lower() == 'true':
+    submission_queue.start(Agent.views.listQueuedOperations, Agent.views.countRunningOperations, Agent.views.submitQueuedOperation)
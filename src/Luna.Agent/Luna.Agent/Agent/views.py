@@ -2,9 +2,10 @@
 Routes and views for the flask application.
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask import render_template, send_file,redirect
-from flask import jsonify, request
+from flask import jsonify, request, Response
+from werkzeug.wsgi import wrap_file
 from Agent.Azure.AzureMLUtils import AzureMLUtils
 from Agent.Azure.AzureDatabricksUtils import AzureDatabricksUtils
 from datetime import datetime
@@ -16,8 +17,11 @@ from Agent.Data.AMLPipelineEndpoint import AMLPipelineEndpoint
 from Agent.Data.Subscription import Subscription
 from Agent.Data.APIVersion import APIVersion
 from Agent.Data.MLModel import MLModel
+from Agent.Data.AgentOperation import AgentOperation
+from Agent.Data.AgentLease import AgentLease
 from sqlalchemy.orm import sessionmaker
-from Agent import engine, Session, app, key_vault_client
+from sqlalchemy.exc import IntegrityError
+from Agent import engine, Session, app, mlflow_lock, aml_project_lock, key_vault_client, api_key_index, rejected_api_key_cache, api_key_throttle, agent_metrics, aml_client_pool, metadata_cache, http_client_pool, scoring_endpoint_cache, micro_batcher, prediction_cache, artifact_cache, archive_executor, operation_executor, log_cache, operation_watcher, submission_queue
 from azure.keyvault.secrets import SecretClient
 from azure.identity import DefaultAzureCredential
 from Agent.Data.AMLWorkspace import AMLWorkspace
@@ -27,8 +31,14 @@ from Agent.Data.Offer import Offer
 from Agent.Exception.LunaExceptions import LunaServerException, LunaUserException
 from Agent.Auth.AuthHelper import AuthenticationHelper
 from Agent.Data.GitRepo import GitRepo
+from Agent.Cache.APIKeyIndex import APIKeyIndex
+from Agent.Cache.ClientPool import ClientPool
+from azureml.exceptions import AuthenticationException
+from Agent.Artifacts.ZipStream import ZipStream
+from Agent.Artifacts.ArtifactCache import ArtifactCache
+from Agent.Operations.OperationWatcher import OperationWatcher
 from Agent.Azure.GitUtils import GitUtils
-import json, os, io
+import json, os, io, time, hashlib, base64, threading, socket
 from http import HTTPStatus
 import requests
 from cryptography import x509
@@ -40,6 +50,34 @@ from Agent.Constants.Enums import APIType, ComputeType, EndpointAuthType, AMLOpe
 from Agent.Constants.Constants import Constants
 from Agent.Constants.ErrorMessages import UserErrorMessage
 
+SCORING_ENDPOINT_TTL_SECONDS = int(os.environ.get('SCORING_ENDPOINT_TTL_SECONDS', '600'))
+ARCHIVE_MAX_PENDING_BLOCKS = int(os.environ.get('ARCHIVE_MAX_PENDING_BLOCKS', '16'))
+OPERATION_POLL_BATCH_SIZE = int(os.environ.get('OPERATION_POLL_BATCH_SIZE', '100'))
+# the operation poller runs in the process holding the lease, it's taken over once the holder stopped renewing it for this long
+OPERATION_POLLER_LEASE_SECONDS = int(os.environ.get('OPERATION_POLLER_LEASE_SECONDS', '60'))
+OPERATION_POLLER_LEASE_NAME = 'operation_poller'
+# operations whose status couldn't be read from the backend for this long don't count against the concurrency limits
+OPERATION_STATUS_MAX_AGE_SECONDS = int(os.environ.get('OPERATION_STATUS_MAX_AGE_SECONDS', '3600'))
+AGENT_INSTANCE_ID = '{}:{}'.format(socket.gethostname(), os.getpid())
+OPERATION_OUTPUT_MAX_BYTES = int(os.environ.get('OPERATION_OUTPUT_MAX_BYTES', str(1024 * 1024)))
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', '100'))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', '1000'))
+# long polls and event streams end well before the worker timeout, clients reconnect to go on
+WORKER_TIMEOUT_SECONDS = int(os.environ.get('WORKER_TIMEOUT_SECONDS', '600'))
+MAX_STATUS_WAIT_SECONDS = min(int(os.environ.get('MAX_STATUS_WAIT_SECONDS', '60')), WORKER_TIMEOUT_SECONDS // 2)
+STATUS_STREAM_HEARTBEAT_SECONDS = int(os.environ.get('STATUS_STREAM_HEARTBEAT_SECONDS', '15'))
+STATUS_STREAM_MAX_SECONDS = min(int(os.environ.get('STATUS_STREAM_MAX_SECONDS', '300')), WORKER_TIMEOUT_SECONDS // 2)
+SUBMISSION_MAX_ATTEMPTS = int(os.environ.get('SUBMISSION_MAX_ATTEMPTS', '5'))
+SUBMISSION_RETRY_BACKOFF_SECONDS = int(os.environ.get('SUBMISSION_RETRY_BACKOFF_SECONDS', '30'))
+SUBMISSION_LEASE_SECONDS = int(os.environ.get('SUBMISSION_LEASE_SECONDS', '600'))
+SCHEDULER_QUEUED_PER_SUBSCRIPTION = int(os.environ.get('SCHEDULER_QUEUED_PER_SUBSCRIPTION', '100'))
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+# a retry with the same idempotency key later than this is a new operation
+IDEMPOTENCY_KEY_RETENTION_SECONDS = int(os.environ.get('IDEMPOTENCY_KEY_RETENTION_SECONDS', str(24 * 3600)))
+# requests handled concurrently by a worker, a sync worker handles one at a time so there is nothing to batch
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', '1'))
+
+
 def getToken():
     bearerToken = request.headers.get(Constants.AUTHORIZATION_HEADER)
     if not bearerToken or not bearerToken.startswith(Constants.BEARER_TOKEN_PREFIX):
@@ -48,7 +86,7 @@ def getToken():
 
 def handleExceptions(e):
     if isinstance(e, LunaUserException):
-        return e.message, e.http_status_code.value
+        return e.message, int(e.http_status_code)
     else:
         app.logger.info(e)
         return UserErrorMessage.INTERNAL_SERVER_ERROR, 500
@@ -64,6 +102,544 @@ def getAPIVersion(subscription):
 
     return apiVersion;
 
+def releaseDbConnection():
+    """ return the pooled db connection before a slow upstream call, the metadata read so far stays usable and
+        a later query checks out a connection again """
+    Session.close()
+
+def getAzureMLUtils(apiVersion):
+    # read the secret from key vault again when the pooled client is about to be rebuilt, so a rotated secret is picked up
+    amlWorkspace = AMLWorkspace.GetByIdWithSecrets(apiVersion.AMLWorkspaceId, refreshSecret = not aml_client_pool.is_live(apiVersion.AMLWorkspaceId))
+    fingerprint = ClientPool.fingerprint(amlWorkspace.ResourceId, amlWorkspace.AADTenantId, amlWorkspace.AADApplicationId, amlWorkspace.AADApplicationSecret)
+    return aml_client_pool.checkout(amlWorkspace.Id, fingerprint, lambda: AzureMLUtils(amlWorkspace))
+
+def isAuthenticationError(e):
+    if isinstance(e, AuthenticationException):
+        return True
+    response = getattr(e, 'response', None)
+    return getattr(e, 'status_code', None) == HTTPStatus.UNAUTHORIZED or getattr(response, 'status_code', None) == HTTPStatus.UNAUTHORIZED
+
+def callAzureML(apiVersion, call):
+    """ return call(amlUtil) with the pooled client of the workspace. the client is rebuilt with the secret
+        read from key vault again and the call retried once if the service principal is rejected """
+    try:
+        return call(getAzureMLUtils(apiVersion))
+    except Exception as e:
+        if not isAuthenticationError(e):
+            raise
+        app.logger.info(e)
+        aml_client_pool.invalidate(apiVersion.AMLWorkspaceId)
+        return call(getAzureMLUtils(apiVersion))
+
+def loadScoringEndpoint(apiVersion):
+    headers = {}
+    expiresIn = SCORING_ENDPOINT_TTL_SECONDS
+
+    if apiVersion.IsManualInputEndpoint:
+        requestUrl = apiVersion.EndpointUrl
+        if apiVersion.EndpointAuthType == EndpointAuthType.API_KEY.name:
+            secret = key_vault_client.get_secret(apiVersion.EndpointAuthSecretName).value
+            if apiVersion.EndpointAuthAddTo == 'HEADER':
+                headers[apiVersion.EndpointAuthKey] = secret
+            elif apiVersion.EndpointAuthType == EndpointAuthType.QUERY_ARAMETER.name:
+                requestUrl = "{}?{}={}".format(requestUrl, apiVersion.EndpointAuthKey, secret)
+            else:
+                raise LunaServerException("Unknow endpoint auth add-to target.")
+        elif apiVersion.EndpointAuthType == EndpointAuthType.SERVICE_PRINCIPAL.name:
+            raise LunaUserException(HTTPStatus.NOT_IMPLEMENTED, UserErrorMessage.NOT_IMPLEMENTED.format("Service principal"))
+    elif apiVersion.LinkedServiceType == ComputeType.AML.name:
+        endpoint = callAzureML(apiVersion, lambda amlUtil: amlUtil.getEndpoint(apiVersion))
+        requestUrl = endpoint.scoring_uri
+        if endpoint.auth_enabled:
+            if endpoint.token_auth_enabled:
+                key, refreshAfter = endpoint.get_token()
+                expiresIn = max(0, refreshAfter - time.time())
+            else:
+                key, secondaryKey = endpoint.get_keys()
+            headers[Constants.AUTHORIZATION_HEADER] = "{}{}".format(Constants.BEARER_TOKEN_PREFIX, key)
+    elif apiVersion.LinkedServiceType == ComputeType.ADB.name:
+        adbWorkspace = AzureDatabricksWorkspace.GetByIdWithSecrets(apiVersion.AzureDatabricksWorkspaceId)
+        # the access token is added per request, it is cached and refreshed by the AAD token cache
+        requestUrl = "{}/model/{}/{}/invocations".format(adbWorkspace.WorkspaceUrl, apiVersion.EndpointName, apiVersion.EndpointVersion)
+    else:
+        raise LunaUserException(HTTPStatus.NOT_FOUND, UserErrorMessage.NO_ENDPOINT_PUBLISHED)
+
+    return (requestUrl, headers), expiresIn
+
+def getScoringEndpointKey(apiVersion):
+    return (apiVersion.Id, apiVersion.LastUpdatedTime)
+
+def invalidateScoringEndpoint(apiVersion):
+    scoring_endpoint_cache.invalidate(getScoringEndpointKey(apiVersion))
+
+def getScoringRequest(apiVersion):
+    """ return the scoring url and auth headers of the endpoint, the resolved endpoint is cached per api version """
+    requestUrl, headers = scoring_endpoint_cache.get(getScoringEndpointKey(apiVersion), lambda: loadScoringEndpoint(apiVersion))
+    headers = dict(headers)
+    if not apiVersion.IsManualInputEndpoint and apiVersion.LinkedServiceType == ComputeType.ADB.name:
+        adbUtil = AzureDatabricksUtils(AzureDatabricksWorkspace.GetByIdWithSecrets(apiVersion.AzureDatabricksWorkspaceId))
+        headers[Constants.AUTHORIZATION_HEADER] = "{}{}".format(Constants.BEARER_TOKEN_PREFIX, adbUtil.getAccessToken())
+    return requestUrl, headers
+
+def postToScoringEndpoint(apiVersion, body, contentType = Constants.HTTP_CONTENT_TYPE_JSON):
+    """ post the body to the scoring endpoint, the response body is not read """
+    requestUrl, headers = getScoringRequest(apiVersion)
+    headers[Constants.HTTP_CONTENT_TYPE_HEADER_NAME] = contentType
+    releaseDbConnection()
+    response = http_client_pool.post(requestUrl, body, headers=headers, stream=True)
+    # the cached key or token might have been regenerated, resolve the endpoint again and retry once
+    if response.status_code == HTTPStatus.UNAUTHORIZED:
+        response.close()
+        invalidateScoringEndpoint(apiVersion)
+        requestUrl, headers = getScoringRequest(apiVersion)
+        headers[Constants.HTTP_CONTENT_TYPE_HEADER_NAME] = contentType
+        releaseDbConnection()
+        response = http_client_pool.post(requestUrl, body, headers=headers, stream=True)
+    return response
+
+def streamUpstreamResponse(response):
+    def generate():
+        try:
+            for chunk in response.iter_content(Constants.STREAM_CHUNK_SIZE):
+                yield chunk
+        finally:
+            response.close()
+
+    return Response(generate(),
+                    status=response.status_code,
+                    content_type=response.headers.get(Constants.HTTP_CONTENT_TYPE_HEADER_NAME, Constants.HTTP_CONTENT_TYPE_JSON))
+
+def isMicroBatchingEnabled(batchSettings):
+    return WORKER_THREADS > 1 and batchSettings is not None and batchSettings.get('enabled')
+
+def batchPredict(apiVersion, batchSettings):
+    """ merge the records of concurrent requests into one upstream call, configured by the microBatching advanced setting:
+        {"enabled": true, "windowMs": 5, "maxBatchSize": 32, "inputKey": "data", "outputKey": null}
+        inputKey is the request field holding the list of records. outputKey is the response field holding
+        one result per record, or null if the response is the list of results itself. """
+    inputKey = batchSettings.get('inputKey', 'data')
+    outputKey = batchSettings.get('outputKey')
+    body = request.get_json(force=True)
+    if not isinstance(body, dict) or not isinstance(body.get(inputKey), list):
+        raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.BATCH_INPUT_REQUIRED.format(inputKey))
+
+    # only requests with the same fields other than the records can share a batch
+    template = {key: value for key, value in body.items() if key != inputKey}
+    batchKey = (apiVersion.Id, json.dumps(template, sort_keys=True))
+
+    def send(records):
+        payload = dict(template)
+        payload[inputKey] = records
+        response = postToScoringEndpoint(apiVersion, json.dumps(payload))
+        if not response.ok:
+            # the upstream status is passed on as is, it may not be a standard one
+            raise LunaUserException(response.status_code, response.text)
+        result = response.json()
+        return result[outputKey] if outputKey else result
+
+    results = micro_batcher.submit(batchKey,
+                                   body[inputKey],
+                                   batchSettings.get('windowMs', 5) / 1000.0,
+                                   batchSettings.get('maxBatchSize', 32),
+                                   send)
+    return jsonify({outputKey: results} if outputKey else results)
+
+def getPredictionCacheKey(apiVersion, body):
+    """ json bodies are canonicalized first, so the key doesn't depend on key order or whitespace """
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, separators=(',', ':')).encode('utf-8')
+    except ValueError:
+        pass
+    return (apiVersion.Id, apiVersion.EndpointVersion, apiVersion.LastUpdatedTime, hashlib.sha256(body).hexdigest())
+
+def cachedPredict(apiVersion, advancedSettings, cacheSettings):
+    """ serve repeated inputs of deterministic endpoints from the cache, configured by the responseCache advanced setting:
+        {"enabled": true, "ttlSeconds": 300}
+        only successful responses are cached. """
+    cacheKey = getPredictionCacheKey(apiVersion, request.get_data())
+    cached = prediction_cache.get(cacheKey)
+    if cached:
+        statusCode, contentType, body = cached
+        response = Response(body, status=statusCode, content_type=contentType)
+        response.headers[Constants.CACHE_STATUS_HEADER] = 'HIT'
+        return response
+
+    batchSettings = advancedSettings.get(Constants.MICRO_BATCHING_SETTINGS_NAME)
+    if isMicroBatchingEnabled(batchSettings):
+        response = batchPredict(apiVersion, batchSettings)
+    else:
+        contentType = request.headers.get(Constants.HTTP_CONTENT_TYPE_HEADER_NAME, Constants.HTTP_CONTENT_TYPE_JSON)
+        upstream = postToScoringEndpoint(apiVersion, request.get_data(), contentType)
+        try:
+            response = Response(upstream.content,
+                                status=upstream.status_code,
+                                content_type=upstream.headers.get(Constants.HTTP_CONTENT_TYPE_HEADER_NAME, Constants.HTTP_CONTENT_TYPE_JSON))
+        finally:
+            upstream.close()
+
+    if 200 <= response.status_code < 300:
+        prediction_cache.set(cacheKey, response.status_code, response.content_type, response.get_data(), cacheSettings.get('ttlSeconds', 300))
+    response.headers[Constants.CACHE_STATUS_HEADER] = 'MISS'
+    return response
+
+def zipDirectory(path):
+    return ZipStream(path, remove_when_done=True, executor=archive_executor, max_pending=ARCHIVE_MAX_PENDING_BLOCKS, metrics=agent_metrics)
+
+def streamZipFile(path, fileName):
+    """ zip the downloaded files while sending them, the directory is removed afterwards """
+    return Response(zipDirectory(path),
+                    mimetype=Constants.HTTP_CONTENT_TYPE_ZIP,
+                    headers={Constants.HTTP_CONTENT_DISPOSITION_HEADER_NAME: 'attachment; filename={}'.format(fileName)})
+
+def encodeContinuationToken(skip):
+    return base64.urlsafe_b64encode(json.dumps({'skip': skip}).encode('utf-8')).decode('utf-8')
+
+def getPage():
+    """ return (top, skip) of the page requested by the top and continuation-token query parameters """
+    top = request.args.get(Constants.TOP_QUERY_PARAM_NAME, str(DEFAULT_PAGE_SIZE))
+    if not top.isdigit() or int(top) < 1 or int(top) > MAX_PAGE_SIZE:
+        raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.INVALID_TOP.format(MAX_PAGE_SIZE))
+
+    skip = 0
+    token = request.args.get(Constants.CONTINUATION_TOKEN_QUERY_PARAM_NAME)
+    if token:
+        try:
+            skip = int(json.loads(base64.urlsafe_b64decode(token.encode('utf-8')))['skip'])
+        except Exception:
+            raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.INVALID_CONTINUATION_TOKEN)
+        if skip < 0:
+            raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.INVALID_CONTINUATION_TOKEN)
+    return int(top), skip
+
+def getNonNegativeIntArg(name, default):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    if not value.isdigit():
+        raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.INVALID_NON_NEGATIVE_INTEGER.format(name))
+    return int(value)
+
+def getAMLRunType(apiVersion):
+    if apiVersion.APIType == APIType.pipeline.name:
+        return Constants.AML_PIPELINE_RUN_TYPE
+    elif apiVersion.APIType == APIType.mlproject.name:
+        return Constants.AML_SCRIPT_RUN_TYPE
+    raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_SUPPORTED)
+
+def queryOperationStatus(apiVersion, operationId, userId, subscriptionId):
+    """ look up the operation status in the AML or Azure Databricks workspace """
+    if apiVersion.LinkedServiceType == ComputeType.AML.name:
+        runType = getAMLRunType(apiVersion)
+        return callAzureML(apiVersion, lambda amlUtil: amlUtil.getOperationStatus(operationId, userId, subscriptionId, runType))
+    elif apiVersion.LinkedServiceType == ComputeType.ADB.name:
+        adbWorkspace = AzureDatabricksWorkspace.GetByIdWithSecrets(apiVersion.AzureDatabricksWorkspaceId)
+        adbUtil = AzureDatabricksUtils(adbWorkspace)
+        return adbUtil.getOperationStatus(operationId, userId, subscriptionId)
+    raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_SUPPORTED)
+
+def isTerminalStatus(apiVersion, status):
+    if status == Constants.OPERATION_SUBMISSION_FAILED_STATUS:
+        return True
+    if apiVersion.LinkedServiceType == ComputeType.AML.name:
+        return status in Constants.AML_TERMINAL_STATUSES
+    return status in Constants.ADB_TERMINAL_STATUSES
+
+def recordOperation(subscription, apiVersion, operationId, operationName, predecessorOperationId = Constants.PREDECESSOR_OP_ID_NA):
+    operation = AgentOperation(OperationId = operationId,
+                               SubscriptionId = subscription.SubscriptionId,
+                               UserId = subscription.Owner,
+                               ApplicationName = subscription.ApplicationName,
+                               APIName = subscription.APIName,
+                               APIVersionName = apiVersion.VersionName,
+                               OperationName = operationName,
+                               PredecessorOperationId = predecessorOperationId)
+    try:
+        AgentOperation.Create(operation)
+    except IntegrityError:
+        # a concurrent status request indexed it first
+        Session.rollback()
+        return AgentOperation.Get(operationId, subscription.SubscriptionId, subscription.Owner)
+    except Exception as e:
+        # the backend run exists already, the operation can be served without the index
+        app.logger.info(e)
+        Session.rollback()
+        return None
+    return operation
+
+def getOperationRequestHash(subscription, apiVersion, operationName, predecessorOperationId, userInput):
+    operationRequest = {'subscriptionId': subscription.SubscriptionId,
+                        'applicationName': subscription.ApplicationName,
+                        'apiName': subscription.APIName,
+                        'apiVersion': apiVersion.VersionName,
+                        'operationName': operationName,
+                        'predecessorOperationId': predecessorOperationId,
+                        'userInput': userInput}
+    return hashlib.sha256(json.dumps(operationRequest, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+def getDuplicateOperation(subscription, apiVersion, idempotencyKey, requestHash):
+    """ return the operation a retried submission should get instead of a new one. a request with an idempotency key
+        is a retry if the key was used before. without a key, it's a retry if the same request was submitted within the
+        window of the deduplication advanced setting: {"enabled": true, "windowSeconds": 300} """
+    if idempotencyKey:
+        operation = AgentOperation.GetByIdempotencyKey(subscription.SubscriptionId, subscription.Owner, idempotencyKey)
+        if operation and operation.CreatedTime < datetime.utcnow() - timedelta(seconds = IDEMPOTENCY_KEY_RETENTION_SECONDS):
+            # the key expired, it can be used for a new operation
+            AgentOperation.ClearIdempotencyKey(operation)
+            operation = None
+        if operation and operation.RequestHash != requestHash:
+            raise LunaUserException(HTTPStatus.UNPROCESSABLE_ENTITY, UserErrorMessage.IDEMPOTENCY_KEY_REUSED.format(idempotencyKey))
+        if operation:
+            agent_metrics.increment('operation_submission.idempotent_retry')
+        return operation
+
+    dedupeSettings = apiVersion.GetAdvancedSettings().get(Constants.DEDUPLICATION_SETTINGS_NAME)
+    if not dedupeSettings or not dedupeSettings.get('enabled'):
+        return None
+    createdAfter = datetime.utcnow() - timedelta(seconds = dedupeSettings.get('windowSeconds', 300))
+    operation = AgentOperation.GetDuplicate(subscription.SubscriptionId, subscription.Owner, requestHash, createdAfter)
+    if operation:
+        agent_metrics.increment('operation_submission.duplicate')
+    return operation
+
+def queueOperation(subscription, apiVersion, operationId, operationName, userInput, predecessorOperationId = Constants.PREDECESSOR_OP_ID_NA, idempotencyKey = None, requestHash = None):
+    operation = AgentOperation(OperationId = operationId,
+                               SubscriptionId = subscription.SubscriptionId,
+                               UserId = subscription.Owner,
+                               ApplicationName = subscription.ApplicationName,
+                               APIName = subscription.APIName,
+                               APIVersionName = apiVersion.VersionName,
+                               OperationName = operationName,
+                               PredecessorOperationId = predecessorOperationId,
+                               Status = Constants.OPERATION_QUEUED_STATUS,
+                               Input = json.dumps(userInput),
+                               NextAttemptTime = datetime.utcnow(),
+                               IdempotencyKey = idempotencyKey,
+                               RequestHash = requestHash)
+    AgentOperation.Create(operation)
+    submission_queue.notify()
+    return operation
+
+def submitOperation(subscription, apiVersion, operationId, operationName, userInput, predecessorOperationId):
+    """ submit the run to the AML or Azure Databricks workspace """
+    if apiVersion.APIType == APIType.pipeline.name:
+        pipeline = AMLPipelineEndpoint.Get(apiVersion.Id, operationName)
+        if not pipeline:
+            raise LunaUserException(HTTPStatus.NOT_FOUND, UserErrorMessage.OPERATION_NOT_SUPPORTED)
+        callAzureML(apiVersion, lambda amlUtil: amlUtil.submitPipelineRun(subscription, apiVersion, pipeline, userInput, predecessorOperationId, operationId))
+        return
+
+    if apiVersion.LinkedServiceType == ComputeType.ADB.name:
+        adbWorkspace = AzureDatabricksWorkspace.GetByIdWithSecrets(apiVersion.AzureDatabricksWorkspaceId)
+        AzureDatabricksUtils(adbWorkspace).runProject(subscription, apiVersion, operationName, userInput, predecessorOperationId, operationId)
+    else:
+        callAzureML(apiVersion, lambda amlUtil: amlUtil.runProject(subscription, apiVersion, operationName, userInput, predecessorOperationId, operationId))
+
+def getComputeTarget(apiVersion):
+    """ the workspace and compute target the operations of the api version run on """
+    if not apiVersion:
+        return None
+    return (apiVersion.LinkedServiceType, getLinkedWorkspaceId(apiVersion), apiVersion.LinkedServiceComputeTarget)
+
+def listQueuedOperations():
+    """ return (operation id, target, subscription id, queued time) of the queued operations which are due, called by the submission queue """
+    try:
+        result = []
+        for operation in AgentOperation.ListQueued(SCHEDULER_QUEUED_PER_SUBSCRIPTION):
+            apiVersion = APIVersion.Get(operation.ApplicationName, operation.APIName, operation.APIVersionName)
+            result.append((operation.OperationId, getComputeTarget(apiVersion), operation.SubscriptionId, operation.CreatedTime))
+        return result
+    finally:
+        Session.remove()
+
+def countRunningOperations():
+    """ return the counts of the operations being submitted or submitted which aren't terminal by compute target and by subscription,
+        called by the submission queue """
+    try:
+        byTarget = {}
+        bySubscription = {}
+        for applicationName, apiName, versionName, subscriptionId, count in AgentOperation.CountRunning(OPERATION_STATUS_MAX_AGE_SECONDS):
+            target = getComputeTarget(APIVersion.Get(applicationName, apiName, versionName))
+            byTarget[target] = byTarget.get(target, 0) + count
+            bySubscription[subscriptionId] = bySubscription.get(subscriptionId, 0) + count
+        return byTarget, bySubscription
+    finally:
+        Session.remove()
+
+def hasBackendRun(apiVersion, operationId, userId, subscriptionId):
+    """ whether a run tagged with the operation id exists in the AML or Azure Databricks workspace """
+    if apiVersion.LinkedServiceType == ComputeType.AML.name:
+        runType = getAMLRunType(apiVersion)
+        return callAzureML(apiVersion, lambda amlUtil: amlUtil.hasOperationRun(operationId, userId, subscriptionId, runType))
+    elif apiVersion.LinkedServiceType == ComputeType.ADB.name:
+        adbWorkspace = AzureDatabricksWorkspace.GetByIdWithSecrets(apiVersion.AzureDatabricksWorkspaceId)
+        return AzureDatabricksUtils(adbWorkspace).hasOperationRun(operationId, userId, subscriptionId)
+    return False
+
+def submitQueuedOperation(operationId):
+    """ submit a queued operation, failed submissions are retried with exponential backoff. called on the threads of the submission queue """
+    try:
+        operation = AgentOperation.GetById(operationId)
+        if not operation:
+            return
+        apiVersion = APIVersion.Get(operation.ApplicationName, operation.APIName, operation.APIVersionName)
+        if apiVersion and apiVersion.APIType == APIType.mlproject.name:
+            # mlflow projects are submitted one at a time per backend, claim the operation once it's its turn so
+            # the lease only runs for the submission itself
+            with aml_project_lock if apiVersion.LinkedServiceType == ComputeType.AML.name else mlflow_lock:
+                claimAndSubmitOperation(operationId)
+        else:
+            claimAndSubmitOperation(operationId)
+    finally:
+        Session.remove()
+
+def claimAndSubmitOperation(operationId):
+    operation = AgentOperation.Claim(operationId, SUBMISSION_LEASE_SECONDS)
+    if not operation:
+        return
+    try:
+        apiVersion = APIVersion.Get(operation.ApplicationName, operation.APIName, operation.APIVersionName)
+        if not apiVersion:
+            raise LunaUserException(HTTPStatus.NOT_FOUND, UserErrorMessage.API_VERSION_NOT_EXIST)
+        # a previous attempt may have created the run and then failed or run out of its lease, don't submit it twice
+        if operation.Attempts > 1 and hasBackendRun(apiVersion, operationId, operation.UserId, operation.SubscriptionId):
+            AgentOperation.SetSubmitted(operation)
+            return
+        subscription = Subscription()
+        subscription.SubscriptionId = operation.SubscriptionId
+        subscription.Owner = operation.UserId
+        subscription.ApplicationName = operation.ApplicationName
+        subscription.APIName = operation.APIName
+        submitOperation(subscription, apiVersion, operationId, operation.OperationName, json.loads(operation.Input), operation.PredecessorOperationId)
+    except Exception as e:
+        app.logger.info(e)
+        Session.rollback()
+        # user errors fail the same way again
+        if isinstance(e, LunaUserException) or operation.Attempts >= SUBMISSION_MAX_ATTEMPTS:
+            AgentOperation.SetSubmissionError(operation, e.message if isinstance(e, LunaUserException) else UserErrorMessage.SUBMISSION_FAILED, None)
+        else:
+            AgentOperation.SetSubmissionError(operation, str(e), datetime.utcnow() + timedelta(seconds = SUBMISSION_RETRY_BACKOFF_SECONDS * 2 ** (operation.Attempts - 1)))
+        return
+    AgentOperation.SetSubmitted(operation)
+
+def getOperationStatusResult(subscription, apiVersion, operationId):
+    """ read the status from the operation index, the backend is only queried when the index doesn't have it yet """
+    operation = AgentOperation.Get(operationId, subscription.SubscriptionId, subscription.Owner)
+    if operation and operation.Status:
+        return operation.ToStatus()
+
+    result = queryOperationStatus(apiVersion, operationId, subscription.Owner, subscription.SubscriptionId)
+    isTerminal = isTerminalStatus(apiVersion, result[Constants.OPERATION_STATUS_PARAMETER_NAME])
+    # the operation was submitted before the index existed, keep it once it's finished since it won't change anymore
+    if not operation and isTerminal:
+        operation = recordOperation(subscription, apiVersion, operationId, result['operationName'])
+    if operation:
+        AgentOperation.UpdateStatus(operation, result, isTerminal)
+    return result
+
+def getOperationJsonOutput(subscription, apiVersion, operationId, getOutput):
+    """ the JSON output of a terminal operation is kept in the operation index, unless it's over the size limit """
+    operation = AgentOperation.Get(operationId, subscription.SubscriptionId, subscription.Owner)
+    if operation and operation.IsTerminal and operation.Output is not None:
+        agent_metrics.increment('operation_output.hit')
+        return json.loads(operation.Output)
+
+    agent_metrics.increment('operation_output.miss')
+    output = getOutput()
+    # getOutput only returns after the status check, which records the terminal status in the index
+    operation = AgentOperation.Get(operationId, subscription.SubscriptionId, subscription.Owner)
+    if output is not None and operation and operation.IsTerminal:
+        text = json.dumps(output)
+        if len(text.encode('utf-8')) <= OPERATION_OUTPUT_MAX_BYTES:
+            AgentOperation.SaveOutput(operation, text)
+        else:
+            agent_metrics.increment('operation_output.too_large')
+    return output
+
+def refreshActiveOperations():
+    """ refresh the status of the indexed operations which haven't reached a terminal status, called by the operation poller.
+        only the process holding the poller lease refreshes them """
+    count = 0
+    try:
+        if not AgentLease.TryAcquire(OPERATION_POLLER_LEASE_NAME, AGENT_INSTANCE_ID, OPERATION_POLLER_LEASE_SECONDS):
+            return count
+        for operation in AgentOperation.ListActive(OPERATION_POLL_BATCH_SIZE):
+            try:
+                apiVersion = APIVersion.Get(operation.ApplicationName, operation.APIName, operation.APIVersionName)
+                result = queryOperationStatus(apiVersion, operation.OperationId, operation.UserId, operation.SubscriptionId)
+                AgentOperation.UpdateStatus(operation, result, isTerminalStatus(apiVersion, result[Constants.OPERATION_STATUS_PARAMETER_NAME]))
+                count = count + 1
+            except Exception as e:
+                app.logger.info(e)
+                Session.rollback()
+                AgentOperation.Touch(operation)
+    finally:
+        Session.remove()
+    return count
+
+def pollOperationStatus(apiVersion, operationId, userId, subscriptionId):
+    """ query the backend and update the operation index, called on the threads of the operation watcher """
+    try:
+        operation = AgentOperation.Get(operationId, subscriptionId, userId)
+        # there is no backend run to query before the operation is submitted
+        if operation and (operation.IsTerminal or operation.Status in AgentOperation.UNSUBMITTED_STATUSES):
+            return operation.ToStatus(), operation.IsTerminal
+        result = queryOperationStatus(apiVersion, operationId, userId, subscriptionId)
+        isTerminal = isTerminalStatus(apiVersion, result[Constants.OPERATION_STATUS_PARAMETER_NAME])
+        if operation:
+            AgentOperation.UpdateStatus(operation, result, isTerminal)
+            # same representation as the status read from the index, so the etags match
+            result = operation.ToStatus()
+        return result, isTerminal
+    finally:
+        Session.remove()
+
+def watchOperationStatus(apiVersion, operationId, userId, subscriptionId, etag, timeout):
+    """ wait until the status etag differs from etag, return (status, etag, is terminal). the status is None if it couldn't be watched """
+    return operation_watcher.wait((subscriptionId, userId, operationId),
+                                  lambda: pollOperationStatus(apiVersion, operationId, userId, subscriptionId),
+                                  etag, timeout)
+
+def formatServerSentEvent(event, data):
+    return 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data, default=str))
+
+def isLatestModelVersion(modelVersion):
+    return not modelVersion or modelVersion == '0' or modelVersion == 'latest'
+
+def getLinkedWorkspaceId(apiVersion):
+    if apiVersion.LinkedServiceType == ComputeType.AML.name:
+        return apiVersion.AMLWorkspaceId
+    return apiVersion.AzureDatabricksWorkspaceId
+
+def isNotModified(key):
+    return key in request.if_none_match
+
+def notModified(key):
+    response = Response(status=HTTPStatus.NOT_MODIFIED)
+    response.set_etag(key)
+    return response
+
+def sendCachedArtifact(key, fileName, download):
+    """ send the zipped files from the artifact cache, download() returns the directory of the files on a miss.
+        a missing archive is sent while it's written to the cache """
+    if isNotModified(key):
+        return notModified(key)
+
+    headers = {Constants.HTTP_CONTENT_DISPOSITION_HEADER_NAME: 'attachment; filename={}'.format(fileName)}
+    file, chunks = artifact_cache.open(key, lambda: zipDirectory(download()))
+    if chunks is not None:
+        response = Response(chunks, mimetype=Constants.HTTP_CONTENT_TYPE_ZIP, headers=headers)
+        response.set_etag(key)
+        return response
+
+    response = Response(wrap_file(request.environ, file, Constants.STREAM_CHUNK_SIZE),
+                        mimetype=Constants.HTTP_CONTENT_TYPE_ZIP,
+                        headers=headers,
+                        direct_passthrough=True)
+    response.content_length = os.fstat(file.fileno()).st_size
+    response.set_etag(key)
+    # answers Range and If-Range requests with 206 or 416, so clients can resume or download in parallel
+    return response.make_conditional(request, accept_ranges=True, complete_length=response.content_length)
+
 def convertOnelinePemtoPemData(pem):
     
     result = "-----BEGIN CERTIFICATE-----\n"
@@ -81,13 +657,35 @@ def convertOnelinePemtoPemData(pem):
 
     return str.encode(result)
 
+def getRequestSource():
+    # the client address as seen by the trusted proxies, X-Forwarded-For is resolved by ProxyFix when TRUSTED_PROXY_COUNT is set
+    return request.remote_addr
+
+def getSubscriptionByKey(subscriptionKey):
+    keyHash = APIKeyIndex.hash_key(subscriptionKey)
+    # the key was rejected recently and no key has been indexed since then
+    if rejected_api_key_cache.get(keyHash) == api_key_index.generation:
+        agent_metrics.increment('rejected_api_key_cache.hit')
+        raise LunaUserException(HTTPStatus.UNAUTHORIZED, UserErrorMessage.INVALID_API_KEY)
+
+    source = getRequestSource()
+    if not api_key_throttle.allow(source):
+        agent_metrics.increment('api_key_throttle.throttled')
+        raise LunaUserException(HTTPStatus.TOO_MANY_REQUESTS, UserErrorMessage.TOO_MANY_INVALID_API_KEYS)
+
+    sub = Subscription.GetByKey(subscriptionKey)
+    if not sub:
+        agent_metrics.increment('api_key.rejected')
+        rejected_api_key_cache.set(keyHash, api_key_index.generation)
+        api_key_throttle.record_failure(source)
+        raise LunaUserException(HTTPStatus.UNAUTHORIZED, UserErrorMessage.INVALID_API_KEY)
+    return sub
+
 def validateAPIKeyAndGetSubscription(applicationName, apiName, subscriptionId=Constants.DEFAULT_SUBSCRIPTION_ID):
     
     subscriptionKey = request.headers.get(Constants.API_KEY_HEADER)
     if subscriptionKey:
-        sub = Subscription.GetByKey(subscriptionKey)
-        if not sub:
-            raise LunaUserException(HTTPStatus.UNAUTHORIZED, UserErrorMessage.INVALID_API_KEY)
+        sub = getSubscriptionByKey(subscriptionKey)
         if not PlanApplicationAPI.Exists(sub.PlanId, applicationName, apiName):
             raise LunaUserException(HTTPStatus.UNAUTHORIZED, UserErrorMessage.API_NOT_EXIST.format(apiName, applicationName))
         if subscriptionId != Constants.DEFAULT_SUBSCRIPTION_ID and subscriptionId.lower() != sub.SubscriptionId.lower():
@@ -167,22 +765,28 @@ def getModel(serviceName, apiName, modelName, subscriptionId = Constants.DEFAULT
 
         mlModel = MLModel.Get(apiVersion.Id, modelName)
         if apiVersion.LinkedServiceType == ComputeType.AML.name:
-            amlWorkspace = AMLWorkspace.GetByIdWithSecrets(apiVersion.AMLWorkspaceId);
-            amlUtil = AzureMLUtils(amlWorkspace)
-            modelZipFilePath = amlUtil.downloadModel(mlModel)
+            modelUtil = getAzureMLUtils(apiVersion)
         elif apiVersion.LinkedServiceType == ComputeType.ADB.name:
             adbWorkspace = AzureDatabricksWorkspace.GetByIdWithSecrets(apiVersion.AzureDatabricksWorkspaceId)
-            adbUtil = AzureDatabricksUtils(adbWorkspace)
-            modelZipFilePath = adbUtil.downloadModel(mlModel)
+            modelUtil = AzureDatabricksUtils(adbWorkspace)
         else:
             raise LunaUserException(HTTPStatus.NOT_FOUND, UserErrorMessage.CAN_NOT_CONNECT_TO_MODEL_REPO);
         
-        with open(modelZipFilePath, 'rb') as bites:
-            return send_file(
-                 io.BytesIO(bites.read()),
-                 attachment_filename='model_{}.zip'.format(modelName),
-                 mimetype=Constants.HTTP_CONTENT_TYPE_ZIP
-            )
+        fileName = 'model_{}.zip'.format(modelName)
+        releaseDbConnection()
+        # a pinned version is known without asking the model repo, so a client with the current archive gets a 304 right away
+        if artifact_cache.enabled and not isLatestModelVersion(mlModel.ModelVersion):
+            key = ArtifactCache.key(apiVersion.LinkedServiceType, getLinkedWorkspaceId(apiVersion), mlModel.ModelName, mlModel.ModelVersion)
+            if isNotModified(key):
+                return notModified(key)
+
+        modelVersion = modelUtil.getModelVersion(mlModel)
+        if not artifact_cache.enabled:
+            return streamZipFile(modelUtil.downloadModel(mlModel, modelVersion), fileName)
+
+        # a model version is immutable, so is its archive
+        key = ArtifactCache.key(apiVersion.LinkedServiceType, getLinkedWorkspaceId(apiVersion), mlModel.ModelName, modelVersion)
+        return sendCachedArtifact(key, fileName, lambda: modelUtil.downloadModel(mlModel, modelVersion))
     except Exception as e:
         return handleExceptions(e)
     
@@ -195,41 +799,19 @@ def realtimePredict(serviceName, apiName, subscriptionId = Constants.DEFAULT_SUB
         if (apiVersion.APIType != APIType.endpoint.name):
             raise LunaUserException(HTTPStatus.NOT_FOUND, UserErrorMessage.NO_ENDPOINT_PUBLISHED)
     
-        headers = {Constants.HTTP_CONTENT_TYPE_HEADER_NAME: Constants.HTTP_CONTENT_TYPE_JSON}
-
-        if apiVersion.IsManualInputEndpoint:
-            requestUrl = apiVersion.EndpointUrl
-            if apiVersion.EndpointAuthType == EndpointAuthType.API_KEY.name:
-                secret = key_vault_client.get_secret(apiVersion.EndpointAuthSecretName).value
-                if apiVersion.EndpointAuthAddTo == 'HEADER':
-                    headers[apiVersion.EndpointAuthKey] = secret
-                elif apiVersion.EndpointAuthType == EndpointAuthType.QUERY_ARAMETER.name:
-                    requestUrl = "{}?{}={}".format(requestUrl, apiVersion.EndpointAuthKey, secret)
-                else:
-                    raise LunaServerException("Unknow endpoint auth add-to target.")
-            elif apiVersion.EndpointAuthType == EndpointAuthType.SERVICE_PRINCIPAL.name:
-                raise LunaUserException(HTTPStatus.NOT_IMPLEMENTED, UUserErrorMessage.NOT_IMPLEMENTED.format("Service principal"))
-        elif apiVersion.LinkedServiceType == ComputeType.AML.name:
-            amlWorkspace = AMLWorkspace.GetByIdWithSecrets(apiVersion.AMLWorkspaceId);
-            amlUtil = AzureMLUtils(amlWorkspace)
-            endpoint = amlUtil.getEndpoint(apiVersion)
-            requestUrl = endpoint.scoring_uri
-            if endpoint.auth_enabled:
-                if endpoint.token_auth_enabled:
-                    key, refresh = endpoint.get_token()
-                else:
-                    key, secondaryKey = endpoint.get_keys()
-                headers[Constants.AUTHORIZATION_HEADER] = "{}{}".format(Constants.BEARER_TOKEN_PREFIX, key)
-        elif apiVersion.LinkedServiceType == ComputeType.ADB.name:
-            adbWorkspace = AzureDatabricksWorkspace.GetByIdWithSecrets(apiVersion.AzureDatabricksWorkspaceId)
-            adbUtil = AzureDatabricksUtils(adbWorkspace)
-            requestUrl = "{}/model/{}/{}/invocations".format(adbWorkspace.WorkspaceUrl, apiVersion.EndpointName, apiVersion.EndpointVersion)
-            headers[Constants.AUTHORIZATION_HEADER] = "{}{}".format(Constants.BEARER_TOKEN_PREFIX, adbUtil.getAccessToken())
+        advancedSettings = apiVersion.GetAdvancedSettings()
+        cacheSettings = advancedSettings.get(Constants.RESPONSE_CACHE_SETTINGS_NAME)
+        if cacheSettings and cacheSettings.get('enabled'):
+            return cachedPredict(apiVersion, advancedSettings, cacheSettings)
 
-        response = requests.post(requestUrl, json.dumps(request.json), headers=headers)
-        if response.ok:
-            return response.json(), response.status_code
-        return response.text, response.status_code
+        batchSettings = advancedSettings.get(Constants.MICRO_BATCHING_SETTINGS_NAME)
+        if isMicroBatchingEnabled(batchSettings):
+            return batchPredict(apiVersion, batchSettings)
+
+        # forward the request body as is, the agent doesn't need to look into it
+        contentType = request.headers.get(Constants.HTTP_CONTENT_TYPE_HEADER_NAME, Constants.HTTP_CONTENT_TYPE_JSON)
+        response = postToScoringEndpoint(apiVersion, request.get_data(), contentType)
+        return streamUpstreamResponse(response)
     except Exception as e:
         return handleExceptions(e)
     
@@ -262,39 +844,40 @@ def executeOperation(serviceName, apiName, operationName, predecessorOperationId
         if apiVersion.APIType == APIType.pipeline.name:
             if apiVersion.LinkedServiceType != ComputeType.AML.name:
                 raise LunaServerException("No AML workspace found for subscription {}".format(subscriptionId))
-            pipeline = AMLPipelineEndpoint.Get(apiVersion.Id, operationName)
-            if not pipeline:
+            if not AMLPipelineEndpoint.Get(apiVersion.Id, operationName):
                 raise LunaUserException(HTTPStatus.NOT_FOUND, UserErrorMessage.OPERATION_NOT_SUPPORTED)
-            amlWorkspace = AMLWorkspace.GetByIdWithSecrets(apiVersion.AMLWorkspaceId);
-            amlUtil = AzureMLUtils(amlWorkspace)
-            if predecessorOperationId != Constants.PREDECESSOR_OP_ID_NA:
-                result = amlUtil.getOperationStatus(predecessorOperationId, subscription.Owner, subscription.SubscriptionId)
-                if result[Constants.OPERATION_STATUS_PARAMETER_NAME] != AMLOperationStatus.Completed.name:
-                    raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_IN_STATUS.format(predecessorOperationId, AMLOperationStatus.Complete.name))
-
-            opId = amlUtil.submitPipelineRun(subscription, apiVersion, pipeline, request.json, predecessorOperationId = predecessorOperationId)
+        elif apiVersion.APIType != APIType.mlproject.name or apiVersion.LinkedServiceType not in [ComputeType.AML.name, ComputeType.ADB.name]:
+            raise LunaUserException(HTTPStatus.NOT_FOUND, UserErrorMessage.NO_OPERATION_PUBLISHED)
 
-        elif apiVersion.APIType == APIType.mlproject.name:
+        if predecessorOperationId != Constants.PREDECESSOR_OP_ID_NA:
             if apiVersion.LinkedServiceType == ComputeType.ADB.name:
-                adbWorkspace = AzureDatabricksWorkspace.GetByIdWithSecrets(apiVersion.AzureDatabricksWorkspaceId)
-                adbUtil = AzureDatabricksUtils(adbWorkspace)
-                if predecessorOperationId != Constants.PREDECESSOR_OP_ID_NA:
-                    result = adbUtil.getOperationStatus(predecessorOperationId, subscription.Owner, subscription.SubscriptionId)
-                    if result[Constants.OPERATION_STATUS_PARAMETER_NAME] != ADBOperationStatus.FINISHED.name:
-                        raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_IN_STATUS.format(predecessorOperationId, ADBOperationStatus.FINISHED.name))
-                opId = adbUtil.runProject(subscription, apiVersion, operationName, request.json, predecessorOperationId = predecessorOperationId)
-            elif apiVersion.LinkedServiceType == ComputeType.AML.name:
-                amlWorkspace = AMLWorkspace.GetByIdWithSecrets(apiVersion.AMLWorkspaceId);
-                amlUtil = AzureMLUtils(amlWorkspace)
-                if predecessorOperationId != Constants.PREDECESSOR_OP_ID_NA:
-                    result = amlUtil.getOperationStatus(predecessorOperationId, subscription.Owner, subscription.SubscriptionId)
-                    if result[Constants.OPERATION_STATUS_PARAMETER_NAME] != AMLOperationStatus.Complete.name:
-                        raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_IN_STATUS.format(predecessorOperationId, AMLOperationStatus.Complete.name))
-                opId = amlUtil.runProject(subscription, apiVersion, operationName, request.json, predecessorOperationId = predecessorOperationId)
-        else:
-            raise LunaUserException(HTTPStatus.NOT_FOUND, UserErrorMessage.NO_OPERATION_PUBLISHED)
-            
-        return jsonify({'operationId': opId})
+                completedStatus = ADBOperationStatus.FINISHED.name
+            else:
+                completedStatus = AMLOperationStatus.Completed.name
+            result = getOperationStatusResult(subscription, apiVersion, predecessorOperationId)
+            if result[Constants.OPERATION_STATUS_PARAMETER_NAME] != completedStatus:
+                raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_IN_STATUS.format(predecessorOperationId, completedStatus))
+
+        idempotencyKey = request.headers.get(Constants.IDEMPOTENCY_KEY_HEADER)
+        if idempotencyKey is not None and (not idempotencyKey or len(idempotencyKey) > IDEMPOTENCY_KEY_MAX_LENGTH):
+            raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.INVALID_IDEMPOTENCY_KEY.format(IDEMPOTENCY_KEY_MAX_LENGTH))
+        requestHash = getOperationRequestHash(subscription, apiVersion, operationName, predecessorOperationId, request.json)
+        operation = getDuplicateOperation(subscription, apiVersion, idempotencyKey, requestHash)
+        if operation:
+            return jsonify({'operationId': operation.OperationId}), HTTPStatus.ACCEPTED
+
+        # the backend run is submitted by the submission queue, the status is Queued until then
+        opId = str('a' + uuid4().hex[1:])
+        try:
+            queueOperation(subscription, apiVersion, opId, operationName, request.json, predecessorOperationId, idempotencyKey, requestHash)
+        except IntegrityError:
+            # a concurrent retry with the same idempotency key queued the operation first
+            Session.rollback()
+            operation = getDuplicateOperation(subscription, apiVersion, idempotencyKey, requestHash)
+            if not operation:
+                raise
+            opId = operation.OperationId
+        return jsonify({'operationId': opId}), HTTPStatus.ACCEPTED
     
     except Exception as e:
         return handleExceptions(e)
@@ -305,26 +888,62 @@ def getOperationStatus(serviceName, apiName, operationId, subscriptionId = Const
     try:
         subscription = validateAPIKeyAndGetSubscription(serviceName, apiName, subscriptionId);
         apiVersion = getAPIVersion(subscription);
+        wait = min(getNonNegativeIntArg(Constants.WAIT_QUERY_PARAM_NAME, 0), MAX_STATUS_WAIT_SECONDS)
         
-        if apiVersion.LinkedServiceType == ComputeType.AML.name:
-            amlWorkspace = AMLWorkspace.GetByIdWithSecrets(apiVersion.AMLWorkspaceId);
-            amlUtil = AzureMLUtils(amlWorkspace)
-            if apiVersion.APIType == APIType.pipeline.name:
-                runType = Constants.AML_PIPELINE_RUN_TYPE
-            elif apiVersion.APIType == APIType.mlproject.name:
-                runType = Constants.AML_SCRIPT_RUN_TYPE
-            else:
-                raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_SUPPORTED)
-            result = amlUtil.getOperationStatus(operationId, subscription.Owner, subscription.SubscriptionId, runType)
+        result = getOperationStatusResult(subscription, apiVersion, operationId)
+        etag = OperationWatcher.etag(result)
+        # long poll, hold the request until the status changes from the one the client has
+        if wait and etag in request.if_none_match and not isTerminalStatus(apiVersion, result[Constants.OPERATION_STATUS_PARAMETER_NAME]):
+            # the watcher polls on its own thread and session
+            releaseDbConnection()
+            status, statusEtag, isTerminal = watchOperationStatus(apiVersion, operationId, subscription.Owner, subscription.SubscriptionId, etag, wait)
+            if status is not None:
+                result, etag = status, statusEtag
 
-        elif apiVersion.LinkedServiceType == ComputeType.ADB.name:
-            adbWorkspace = AzureDatabricksWorkspace.GetByIdWithSecrets(apiVersion.AzureDatabricksWorkspaceId)
-            adbUtil = AzureDatabricksUtils(adbWorkspace)
-            result = adbUtil.getOperationStatus(operationId, subscription.Owner, subscription.SubscriptionId)
+        if etag in request.if_none_match:
+            response = Response(status=HTTPStatus.NOT_MODIFIED)
         else:
-            raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_SUPPORTED)
+            response = jsonify(result)
+        response.set_etag(etag)
+        return response
+    except Exception as e:
+        return handleExceptions(e)
+
+@app.route('/apiv2/<serviceName>/<apiName>/operations/<operationId>/events', methods=['GET'])
+def streamOperationStatus(serviceName, apiName, operationId, subscriptionId = Constants.DEFAULT_SUBSCRIPTION_ID):
+    """ server-sent events, a status event on every change of the status until the operation is terminal """
+    try:
+        subscription = validateAPIKeyAndGetSubscription(serviceName, apiName, subscriptionId);
+        apiVersion = getAPIVersion(subscription);
+        result = getOperationStatusResult(subscription, apiVersion, operationId)
+        # the events are sent after the request is torn down
+        userId = subscription.Owner
+        subscriptionId = subscription.SubscriptionId
+
+        def events():
+            status, etag = result, OperationWatcher.etag(result)
+            isTerminal = isTerminalStatus(apiVersion, result[Constants.OPERATION_STATUS_PARAMETER_NAME])
+            yield formatServerSentEvent('status', status)
+            deadline = time.monotonic() + STATUS_STREAM_MAX_SECONDS
+            while not isTerminal and time.monotonic() < deadline:
+                try:
+                    status, statusEtag, isTerminal = watchOperationStatus(apiVersion, operationId, userId, subscriptionId, etag, STATUS_STREAM_HEARTBEAT_SECONDS)
+                except Exception as e:
+                    message = e.message if isinstance(e, LunaUserException) else UserErrorMessage.INTERNAL_SERVER_ERROR
+                    yield formatServerSentEvent('error', {'message': message})
+                    return
+                if status is not None and statusEtag != etag:
+                    etag = statusEtag
+                    yield formatServerSentEvent('status', status)
+                else:
+                    if status is None:
+                        # too many watched operations, try again later
+                        time.sleep(STATUS_STREAM_HEARTBEAT_SECONDS)
+                    yield ': keep-alive\n\n'
 
-        return jsonify(result)
+        return Response(events(),
+                        mimetype=Constants.HTTP_CONTENT_TYPE_EVENT_STREAM,
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
     except Exception as e:
         return handleExceptions(e)
 
@@ -335,25 +954,23 @@ def listOperations(serviceName, apiName, operationName, subscriptionId=Constants
         subscription = validateAPIKeyAndGetSubscription(serviceName, apiName, subscriptionId);
         apiVersion = getAPIVersion(subscription);
         
+        top, skip = getPage()
+        releaseDbConnection()
         if apiVersion.LinkedServiceType == ComputeType.AML.name:
-            amlWorkspace = AMLWorkspace.GetByIdWithSecrets(apiVersion.AMLWorkspaceId);
-            amlUtil = AzureMLUtils(amlWorkspace)
-            if apiVersion.APIType == APIType.pipeline.name:
-                runType = Constants.AML_PIPELINE_RUN_TYPE
-            elif apiVersion.APIType == APIType.mlproject.name:
-                runType = Constants.AML_SCRIPT_RUN_TYPE
-            else:
-                raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_SUPPORTED)
-            result = amlUtil.listAllOperations(operationName, subscription.Owner, subscription.SubscriptionId, runType)
+            runType = getAMLRunType(apiVersion)
+            result, hasMore = callAzureML(apiVersion, lambda amlUtil: amlUtil.listAllOperations(operationName, subscription.Owner, subscription.SubscriptionId, runType, top, skip, operation_executor))
 
         elif apiVersion.LinkedServiceType == ComputeType.ADB.name:
             adbWorkspace = AzureDatabricksWorkspace.GetByIdWithSecrets(apiVersion.AzureDatabricksWorkspaceId)
             adbUtil = AzureDatabricksUtils(adbWorkspace)
-            result = adbUtil.listAllOperations(operationName, subscription.Owner, subscription.SubscriptionId)
+            result, hasMore = adbUtil.listAllOperations(operationName, subscription.Owner, subscription.SubscriptionId, top, skip)
         else:
             raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_SUPPORTED)
 
-        return jsonify(result)
+        response = jsonify(result)
+        if hasMore:
+            response.headers[Constants.CONTINUATION_TOKEN_HEADER] = encodeContinuationToken(skip + top)
+        return response
     except Exception as e:
         return handleExceptions(e)
     
@@ -362,30 +979,31 @@ def getOperationLog(serviceName, apiName, operationId, subscriptionId = Constant
     try:
         subscription = validateAPIKeyAndGetSubscription(serviceName, apiName, subscriptionId);
         apiVersion = getAPIVersion(subscription);
+        offset = getNonNegativeIntArg(Constants.OFFSET_QUERY_PARAM_NAME, 0)
+        maxBytes = getNonNegativeIntArg(Constants.MAX_BYTES_QUERY_PARAM_NAME, 0)
             
         if apiVersion.LinkedServiceType == ComputeType.AML.name:
-            if apiVersion.APIType == APIType.pipeline.name:
-                runType = Constants.AML_PIPELINE_RUN_TYPE
-            elif apiVersion.APIType == APIType.mlproject.name:
-                runType = Constants.AML_SCRIPT_RUN_TYPE
-            else:
-                raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_SUPPORTED)
-            amlWorkspace = AMLWorkspace.GetByIdWithSecrets(apiVersion.AMLWorkspaceId);
-            amlUtil = AzureMLUtils(amlWorkspace)
-            operation = amlUtil.getOperationStatus(operationId, subscription.Owner, subscription.SubscriptionId, runType)
-
-            result = amlUtil.getOperationLog(operationId, subscription.Owner, subscription.SubscriptionId, runType)
+            runType = getAMLRunType(apiVersion)
+            fetch = lambda fromOffset: callAzureML(apiVersion, lambda amlUtil: amlUtil.getOperationLog(operationId, subscription.Owner, subscription.SubscriptionId, runType, fromOffset))
         elif apiVersion.LinkedServiceType == ComputeType.ADB.name:
             if apiVersion.APIType == APIType.mlproject.name:
                 adbWorkspace = AzureDatabricksWorkspace.GetByIdWithSecrets(apiVersion.AzureDatabricksWorkspaceId)
                 adbUtil = AzureDatabricksUtils(adbWorkspace)
-                operation = adbUtil.getOperationStatus(operationId, subscription.Owner, subscription.SubscriptionId)
-                result = adbUtil.getOperationLog(operationId, subscription.Owner, subscription.SubscriptionId)
+                fetch = lambda fromOffset: adbUtil.getOperationLog(operationId, subscription.Owner, subscription.SubscriptionId, fromOffset)
             else:
                 raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_SUPPORTED)
         else:
             raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_SUPPORTED)
-        return {"log": result};
+
+        # the log of a finished operation doesn't grow anymore, the status is read before the log
+        status = getOperationStatusResult(subscription, apiVersion, operationId)
+        isTerminal = isTerminalStatus(apiVersion, status[Constants.OPERATION_STATUS_PARAMETER_NAME])
+        key = (apiVersion.LinkedServiceType, getLinkedWorkspaceId(apiVersion), subscription.SubscriptionId, subscription.Owner, operationId)
+        releaseDbConnection()
+        data, isComplete = log_cache.read(key, offset, maxBytes, fetch, isTerminal)
+        return {"log": data.decode('utf-8', errors='replace'),
+                "nextOffset": offset + len(data),
+                "complete": isComplete};
     except Exception as e:
         return handleExceptions(e)
 
@@ -398,44 +1016,69 @@ def getOperationOutput(serviceName, apiName, operationId, subscriptionId = Const
         if not outputType:
             outputType = OutputType.json.name
             
-        if apiVersion.LinkedServiceType == ComputeType.AML.name:
-            if apiVersion.APIType == APIType.pipeline.name:
-                runType = Constants.AML_PIPELINE_RUN_TYPE
-            elif apiVersion.APIType == APIType.mlproject.name:
-                runType = Constants.AML_SCRIPT_RUN_TYPE
-            else:
-                raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_SUPPORTED)
-            amlWorkspace = AMLWorkspace.GetByIdWithSecrets(apiVersion.AMLWorkspaceId);
-            amlUtil = AzureMLUtils(amlWorkspace)
-            operation = amlUtil.getOperationStatus(operationId, subscription.Owner, subscription.SubscriptionId, runType)
-            if operation[Constants.OPERATION_STATUS_PARAMETER_NAME] != AMLOperationStatus.Complete.name:
-                raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.NO_OPERATION_PUBLISHED.format(operationId, AMLOperationStatus.Complete.name))
+        if outputType != OutputType.file.name and outputType != OutputType.json.name:
+            raise LunaUserException(HTTPStatus.BAD_REQUEST, "Output type {} is not supported.".format(outputType))
 
-            result = amlUtil.getOperationOutput(operationId, subscription.Owner, subscription.SubscriptionId, runType, outputType)
-        elif apiVersion.LinkedServiceType == ComputeType.ADB.name:
-            if apiVersion.APIType == APIType.mlproject.name:
-                adbWorkspace = AzureDatabricksWorkspace.GetByIdWithSecrets(apiVersion.AzureDatabricksWorkspaceId)
-                adbUtil = AzureDatabricksUtils(adbWorkspace)
-                operation = adbUtil.getOperationStatus(operationId, subscription.Owner, subscription.SubscriptionId)
-                if operation[Constants.OPERATION_STATUS_PARAMETER_NAME] != ADBOperationStatus.FINISHED.name:
-                    raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.NO_OPERATION_PUBLISHED.format(operationId, ADBOperationStatus.FINISHED.name))
-                result = adbUtil.getOperationOutput(operationId, subscription.Owner, subscription.SubscriptionId, outputType)
+        def getOutput():
+            if apiVersion.LinkedServiceType == ComputeType.AML.name:
+                if apiVersion.APIType == APIType.pipeline.name:
+                    runType = Constants.AML_PIPELINE_RUN_TYPE
+                elif apiVersion.APIType == APIType.mlproject.name:
+                    runType = Constants.AML_SCRIPT_RUN_TYPE
+                else:
+                    raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_SUPPORTED)
+                operation = getOperationStatusResult(subscription, apiVersion, operationId)
+                if operation[Constants.OPERATION_STATUS_PARAMETER_NAME] != AMLOperationStatus.Completed.name:
+                    raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.NO_OPERATION_PUBLISHED.format(operationId, AMLOperationStatus.Completed.name))
+
+                releaseDbConnection()
+                result, resultType = callAzureML(apiVersion, lambda amlUtil: amlUtil.getOperationOutput(operationId, subscription.Owner, subscription.SubscriptionId, runType, outputType))
+                return result
+            elif apiVersion.LinkedServiceType == ComputeType.ADB.name:
+                if apiVersion.APIType == APIType.mlproject.name:
+                    adbWorkspace = AzureDatabricksWorkspace.GetByIdWithSecrets(apiVersion.AzureDatabricksWorkspaceId)
+                    adbUtil = AzureDatabricksUtils(adbWorkspace)
+                    operation = getOperationStatusResult(subscription, apiVersion, operationId)
+                    if operation[Constants.OPERATION_STATUS_PARAMETER_NAME] != ADBOperationStatus.FINISHED.name:
+                        raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.NO_OPERATION_PUBLISHED.format(operationId, ADBOperationStatus.FINISHED.name))
+                    releaseDbConnection()
+                    return adbUtil.getOperationOutput(operationId, subscription.Owner, subscription.SubscriptionId, outputType)
+                else:
+                    raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_SUPPORTED)
             else:
                 raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_SUPPORTED)
-        else:
-            raise LunaUserException(HTTPStatus.BAD_REQUEST, UserErrorMessage.OPERATION_NOT_SUPPORTED)
         
-        if outputType == OutputType.file.name:
-            with open(result, 'rb') as bites:
-                return send_file(
-                     io.BytesIO(bites.read()),
-                     attachment_filename='outputs_{}.zip'.format(operationId),
-                     mimetype=Constants.HTTP_CONTENT_TYPE_ZIP
-                )
-        elif outputType == OutputType.json.name:
-            return jsonify(result)
-        else:
-            raise LunaUserException(HTTPStatus.BAD_REQUEST, "Output type {} is not supported.".format(outputType))
+        if outputType == OutputType.json.name:
+            return jsonify(getOperationJsonOutput(subscription, apiVersion, operationId, getOutput))
+
+        fileName = 'outputs_{}.zip'.format(operationId)
+        if not artifact_cache.enabled:
+            return streamZipFile(getOutput(), fileName)
+
+        # only completed operations have output files and they don't change afterwards. The operation is looked up
+        # by user and subscription, so a cached archive was built for the same caller.
+        key = ArtifactCache.key(apiVersion.LinkedServiceType, getLinkedWorkspaceId(apiVersion), subscription.SubscriptionId, subscription.Owner, operationId)
+        return sendCachedArtifact(key, fileName, getOutput)
+    except Exception as e:
+        return handleExceptions(e)
+
+@app.route('/metrics', methods=['GET'])
+def getMetrics():
+    try:
+        AuthenticationHelper.ValidateSignitureAndAdmin(getToken())
+        return jsonify(agent_metrics.snapshot())
+    except Exception as e:
+        return handleExceptions(e)
+
+@app.route('/metadata/invalidate', methods=['POST'])
+def invalidateMetadata():
+    try:
+        AuthenticationHelper.ValidateSignitureAndAdmin(getToken())
+        metadata_cache.clear()
+        prediction_cache.clear()
+        # a workspace update may come with a new service principal secret, rebuild the clients with the secret from key vault
+        aml_client_pool.clear()
+        return jsonify({})
     except Exception as e:
         return handleExceptions(e)
 
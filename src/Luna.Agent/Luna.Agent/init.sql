@@ -86,6 +86,86 @@ CREATE TABLE [dbo].[agent_offers](
 	[CreatedTime] [datetime2](7) NULL
 ) ON [PRIMARY] TEXTIMAGE_ON [PRIMARY]
 GO
+/****** Object:  Table [dbo].[agent_operations] ******/
+SET ANSI_NULLS ON
+GO
+SET QUOTED_IDENTIFIER ON
+GO
+CREATE TABLE [dbo].[agent_operations](
+	[OperationId] [nvarchar](64) NOT NULL,
+	[SubscriptionId] [nvarchar](64) NOT NULL,
+	[UserId] [nvarchar](256) NOT NULL,
+	[ApplicationName] [nvarchar](50) NOT NULL,
+	[APIName] [nvarchar](50) NOT NULL,
+	[APIVersionName] [nvarchar](50) NOT NULL,
+	[OperationName] [nvarchar](128) NOT NULL,
+	[PredecessorOperationId] [nvarchar](64) NULL,
+	[Status] [nvarchar](32) NULL,
+	[Progress] [float] NULL,
+	[StartTime] [nvarchar](64) NULL,
+	[EndTime] [nvarchar](64) NULL,
+	[IsTerminal] [bit] NOT NULL,
+	[Output] [nvarchar](max) NULL,
+	[Input] [nvarchar](max) NULL,
+	[Attempts] [int] NOT NULL,
+	[LastError] [nvarchar](max) NULL,
+	[NextAttemptTime] [datetime2](7) NULL,
+	[IdempotencyKey] [nvarchar](128) NULL,
+	[RequestHash] [nvarchar](64) NULL,
+	[CreatedTime] [datetime2](7) NOT NULL,
+	[LastUpdatedTime] [datetime2](7) NOT NULL,
+	[LastPolledTime] [datetime2](7) NULL,
+ CONSTRAINT [PK_agent_operations] PRIMARY KEY CLUSTERED 
+(
+	[OperationId] ASC
+)WITH (STATISTICS_NORECOMPUTE = OFF, IGNORE_DUP_KEY = OFF) ON [PRIMARY]
+) ON [PRIMARY] TEXTIMAGE_ON [PRIMARY]
+GO
+CREATE NONCLUSTERED INDEX [IX_agent_operations_IsTerminal] ON [dbo].[agent_operations]
+(
+	[IsTerminal] ASC,
+	[LastUpdatedTime] ASC
+)
+GO
+CREATE NONCLUSTERED INDEX [IX_agent_operations_Status] ON [dbo].[agent_operations]
+(
+	[Status] ASC,
+	[NextAttemptTime] ASC
+)
+GO
+CREATE UNIQUE NONCLUSTERED INDEX [IX_agent_operations_IdempotencyKey] ON [dbo].[agent_operations]
+(
+	[SubscriptionId] ASC,
+	[UserId] ASC,
+	[IdempotencyKey] ASC
+)
+WHERE [IdempotencyKey] IS NOT NULL
+GO
+CREATE NONCLUSTERED INDEX [IX_agent_operations_RequestHash] ON [dbo].[agent_operations]
+(
+	[SubscriptionId] ASC,
+	[RequestHash] ASC,
+	[CreatedTime] ASC
+)
+GO
+ALTER TABLE [dbo].[agent_operations] ADD  DEFAULT ((0)) FOR [Attempts]
+GO
+/****** Object:  Table [dbo].[agent_leases] ******/
+SET ANSI_NULLS ON
+GO
+SET QUOTED_IDENTIFIER ON
+GO
+CREATE TABLE [dbo].[agent_leases](
+	[Name] [nvarchar](64) NOT NULL,
+	[Holder] [nvarchar](256) NOT NULL,
+	[ExpiresTime] [datetime2](7) NOT NULL,
+	[LastUpdatedTime] [datetime2](7) NOT NULL,
+ CONSTRAINT [PK_agent_leases] PRIMARY KEY CLUSTERED 
+(
+	[Name] ASC
+)WITH (STATISTICS_NORECOMPUTE = OFF, IGNORE_DUP_KEY = OFF) ON [PRIMARY]
+) ON [PRIMARY]
+GO
 /****** Object:  Table [dbo].[agent_publishers]    Script Date: 10/2/2020 10:18:35 AM ******/
 SET ANSI_NULLS ON
 GO
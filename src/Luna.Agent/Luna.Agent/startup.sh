@@ -1,2 +1,8 @@
 apt-get -y install git
-gunicorn --bind=0.0.0.0 --timeout 600 --workers=2 runserver:app 
\ No newline at end of file
+# TRUSTED_PROXY_COUNT is the number of reverse proxies in front of the agent which append to X-Forwarded-For,
+# e.g. 1 behind the App Service front end. the client address throttled on is read from the header only when it's set,
+# otherwise clients could choose the address they are throttled by
+# threaded workers, a long poll or an event stream holds a thread instead of a whole worker
+export WORKER_THREADS=${WORKER_THREADS:-16}
+export WORKER_TIMEOUT_SECONDS=${WORKER_TIMEOUT_SECONDS:-600}
+gunicorn --bind=0.0.0.0 --timeout $WORKER_TIMEOUT_SECONDS --workers=2 --worker-class=gthread --threads=$WORKER_THREADS runserver:app
\ No newline at end of file
@@ -0,0 +1,36 @@
+"""
+Unit tests of the agent modules which don't need the flask application.
+"""
+
+import importlib.util
+import os
+
+AGENT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Agent')
+
+def load_agent_module(relativePath):
+    """ load a module of the Agent package from its file, without running Agent/__init__.py which builds the application """
+    name = 'agent_test_' + relativePath.replace('/', '_')[:-len('.py')]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(AGENT_PATH, relativePath))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def load_agent_data_modules():
+    """ stand in for the Agent package with Base and Session bound to an in-memory sqlite database, so the Data
+        modules can be imported as Agent.Data.<name> and their queries run. return the package """
+    import sys
+    import types
+    from sqlalchemy import create_engine
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker, scoped_session
+    from sqlalchemy.pool import StaticPool
+
+    package = sys.modules.get('Agent')
+    if package is None:
+        package = types.ModuleType('Agent')
+        package.__path__ = [AGENT_PATH]
+        package.engine = create_engine('sqlite://', connect_args = {'check_same_thread': False}, poolclass = StaticPool)
+        package.Base = declarative_base()
+        package.Session = scoped_session(sessionmaker(bind = package.engine))
+        sys.modules['Agent'] = package
+    return package
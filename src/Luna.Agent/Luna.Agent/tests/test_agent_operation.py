@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+import unittest
+
+try:
+    import sqlalchemy
+except ImportError:
+    sqlalchemy = None
+
+from tests import load_agent_data_modules
+
+@unittest.skipIf(sqlalchemy is None, 'sqlalchemy is not installed')
+class CountRunningTest(unittest.TestCase):
+
+    def setUp(self):
+        agent = load_agent_data_modules()
+        from Agent.Data.AgentOperation import AgentOperation
+        from Agent.Constants.Constants import Constants
+        self.AgentOperation = AgentOperation
+        self.Constants = Constants
+        self.Session = agent.Session
+        agent.Base.metadata.create_all(agent.engine)
+
+    def tearDown(self):
+        self.Session.query(self.AgentOperation).delete()
+        self.Session.commit()
+        self.Session.remove()
+
+    def create(self, operationId, status = None, isTerminal = False, lastPolledTime = None, nextAttemptTime = None):
+        operation = self.AgentOperation(OperationId = operationId, SubscriptionId = 'sub', UserId = 'user', ApplicationName = 'app',
+                                        APIName = 'api', APIVersionName = 'v1', OperationName = 'train', Status = status,
+                                        Attempts = 1, NextAttemptTime = nextAttemptTime)
+        self.AgentOperation.Create(operation)
+        operation.IsTerminal = isTerminal
+        operation.LastPolledTime = lastPolledTime
+        self.Session.commit()
+        return operation
+
+    def countRunning(self):
+        return sum([count for applicationName, apiName, versionName, subscriptionId, count in self.AgentOperation.CountRunning(600)])
+
+    def test_operations_polled_recently_are_counted(self):
+        now = datetime.utcnow()
+        self.create('running', 'Running', lastPolledTime = now)
+        self.create('submitting', self.Constants.OPERATION_SUBMITTING_STATUS, nextAttemptTime = now + timedelta(seconds = 60))
+        self.create('queued', self.Constants.OPERATION_QUEUED_STATUS, nextAttemptTime = now)
+        self.create('completed', 'Completed', isTerminal = True, lastPolledTime = now)
+        self.assertEqual(self.countRunning(), 2)
+
+    def test_operations_not_polled_for_too_long_are_not_counted(self):
+        now = datetime.utcnow()
+        self.create('running', 'Running', lastPolledTime = now)
+        self.create('deleted', 'Running', lastPolledTime = now - timedelta(seconds = 3600))
+        self.create('unreachable', None, lastPolledTime = now - timedelta(seconds = 3600))
+        self.assertEqual(self.countRunning(), 1)
+
+    def test_updated_status_counts_again(self):
+        operation = self.create('recovered', 'Running', lastPolledTime = datetime.utcnow() - timedelta(seconds = 3600))
+        self.assertEqual(self.countRunning(), 0)
+        self.AgentOperation.UpdateStatus(operation, {'status': 'Running'}, False)
+        self.assertEqual(self.countRunning(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+try:
+    from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+except ImportError:
+    HttpResponseError = None
+
+from tests import load_agent_module
+
+class SecretProperties(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.updated_on = 1
+
+class Subscription(object):
+
+    def __init__(self, subscriptionId, primaryKeySecretName, secondaryKeySecretName):
+        self.SubscriptionId = subscriptionId
+        self.PrimaryKeySecretName = primaryKeySecretName
+        self.SecondaryKeySecretName = secondaryKeySecretName
+
+class KeyVault(object):
+    """ key vault helper over a dict, secrets in missing and disabled can't be read """
+
+    def __init__(self, secrets, missing = (), disabled = ()):
+        self.secrets = secrets
+        self.missing = set(missing)
+        self.disabled = set(disabled)
+
+    def list_secret_properties(self):
+        return [SecretProperties(name) for name in self.secrets]
+
+    def get_secret(self, secret_name, use_buffer = True):
+        if secret_name in self.missing:
+            raise ResourceNotFoundError('secret {} not found'.format(secret_name))
+        if secret_name in self.disabled:
+            raise HttpResponseError('secret {} is disabled'.format(secret_name))
+        return self.secrets[secret_name]
+
+@unittest.skipIf(HttpResponseError is None, 'azure-core is not installed')
+class APIKeyIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.APIKeyIndex = load_agent_module('Cache/APIKeyIndex.py').APIKeyIndex
+        self.subscriptions = [Subscription('sub1', 'sub1-primary', 'sub1-secondary'),
+                              Subscription('sub2', 'sub2-primary', 'sub2-secondary'),
+                              Subscription('sub3', 'sub3-primary', 'sub3-secondary')]
+        self.secrets = {'sub1-primary': 'key1', 'sub1-secondary': 'key1b', 'sub2-primary': 'key2',
+                        'sub2-secondary': 'key2b', 'sub3-primary': 'key3', 'sub3-secondary': 'key3b'}
+
+    def test_missing_secret_does_not_stop_the_refresh(self):
+        index = self.APIKeyIndex(KeyVault(self.secrets, missing = ['sub1-secondary']))
+        index.refresh(self.subscriptions)
+
+        self.assertTrue(index.is_built())
+        self.assertEqual(index.lookup('key1'), ('sub1-primary', 'sub1'))
+        self.assertEqual(index.lookup('key2b'), ('sub2-secondary', 'sub2'))
+        self.assertEqual(index.lookup('key3'), ('sub3-primary', 'sub3'))
+        self.assertIsNone(index.lookup('key1b'))
+
+    def test_disabled_secret_does_not_stop_the_refresh(self):
+        index = self.APIKeyIndex(KeyVault(self.secrets, disabled = ['sub2-primary']))
+        index.refresh(self.subscriptions)
+
+        self.assertTrue(index.is_built())
+        self.assertEqual(index.lookup('key3b'), ('sub3-secondary', 'sub3'))
+        self.assertIsNone(index.lookup('key2'))
+
+    def test_deleted_secret_is_removed_from_the_index(self):
+        keyVault = KeyVault(self.secrets)
+        index = self.APIKeyIndex(keyVault, refresh_interval_seconds = 0)
+        index.refresh(self.subscriptions)
+        self.assertEqual(index.lookup('key2'), ('sub2-primary', 'sub2'))
+
+        keyVault.missing.add('sub2-primary')
+        self.assertIsNone(index.lookup('key2'))
+        self.assertEqual(index.lookup('key2b'), ('sub2-secondary', 'sub2'))
+
+if __name__ == '__main__':
+    unittest.main()
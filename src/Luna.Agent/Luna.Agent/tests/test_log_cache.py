@@ -0,0 +1,28 @@
+import unittest
+
+from tests import load_agent_module
+
+class LogCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.LogCache = load_agent_module('Cache/LogCache.py').LogCache
+
+    def test_empty_logs_are_evicted_by_number(self):
+        cache = self.LogCache(max_bytes = 1024, max_entries = 3)
+        for index in range(10):
+            self.assertEqual(cache.read('operation{}'.format(index), 0, 0, lambda offset: b'', False), (b'', False))
+
+        stats = cache.stats()
+        self.assertEqual(stats['size'], 3)
+        self.assertEqual(stats['bytes'], 0)
+
+    def test_logs_are_evicted_by_size(self):
+        cache = self.LogCache(max_bytes = 10, max_entries = 100)
+        cache.read('first', 0, 0, lambda offset: b'123456', True)
+        cache.read('second', 0, 0, lambda offset: b'123456', True)
+
+        self.assertEqual(cache.stats()['size'], 1)
+        self.assertEqual(cache.read('second', 0, 0, lambda offset: self.fail('the log is complete'), True), (b'123456', True))
+
+if __name__ == '__main__':
+    unittest.main()
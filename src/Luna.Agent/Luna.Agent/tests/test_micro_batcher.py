@@ -0,0 +1,67 @@
+import threading
+import unittest
+
+from tests import load_agent_module
+
+class MicroBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.batcher = load_agent_module('Http/MicroBatcher.py').MicroBatcher()
+
+    def submitConcurrently(self, requests, send):
+        """ submit the records of the requests as one batch, return the result or the error of each request """
+        size = sum([len(records) for records in requests])
+        outcomes = [None] * len(requests)
+
+        def submit(index):
+            try:
+                outcomes[index] = self.batcher.submit('endpoint', requests[index], 10, size, send)
+            except Exception as e:
+                outcomes[index] = e
+
+        threads = [threading.Thread(target=submit, args=(index,)) for index in range(len(requests))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        return outcomes
+
+    def test_results_are_split_by_request(self):
+        calls = []
+        def send(records):
+            calls.append(records)
+            return [record * 10 for record in records]
+
+        outcomes = self.submitConcurrently([[1, 2], [3]], send)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(outcomes), [[10, 20], [30]])
+
+    def test_dict_response_falls_back_to_one_request_each(self):
+        def send(records):
+            return {'count': len(records), 'sum': sum(records)}
+
+        outcomes = self.submitConcurrently([[1, 2], [3]], send)
+
+        self.assertIn({'count': 2, 'sum': 3}, outcomes)
+        self.assertIn({'count': 1, 'sum': 3}, outcomes)
+        self.assertEqual(self.batcher.stats()['fallbacks'], 1)
+
+    def test_failed_batch_only_fails_the_bad_request(self):
+        def send(records):
+            if 'bad' in records:
+                raise ValueError('bad record')
+            return [record.upper() for record in records]
+
+        outcomes = self.submitConcurrently([['a'], ['bad'], ['c']], send)
+
+        self.assertIn(['A'], outcomes)
+        self.assertIn(['C'], outcomes)
+        self.assertEqual(len([outcome for outcome in outcomes if isinstance(outcome, ValueError)]), 1)
+
+    def test_single_request_gets_the_response_as_is(self):
+        result = self.batcher.submit('endpoint', [1, 2], 0, 2, lambda records: {'sum': sum(records)})
+        self.assertEqual(result, {'sum': 3})
+
+if __name__ == '__main__':
+    unittest.main()
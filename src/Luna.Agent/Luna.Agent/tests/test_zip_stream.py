@@ -0,0 +1,67 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from tests import load_agent_module
+
+class ZipStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ZipStream = load_agent_module('Artifacts/ZipStream.py').ZipStream
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors = True)
+
+    def write(self, name, data):
+        with open(os.path.join(self.path, name), 'wb') as file:
+            file.write(data)
+
+    def zip(self):
+        archive = b''.join(self.ZipStream(self.path, block_size = 64 * 1024))
+        with zipfile.ZipFile(io.BytesIO(archive)) as zipFile:
+            self.assertIsNone(zipFile.testzip())
+            contents = {info.filename: (info, zipFile.read(info)) for info in zipFile.infolist()}
+        return archive, contents
+
+    def test_incompressible_file_is_stored(self):
+        data = os.urandom(300 * 1024)
+        self.write('weights.bin', data)
+        self.write('noextension', data)
+
+        archive, contents = self.zip()
+
+        for name in ['weights.bin', 'noextension']:
+            info, content = contents[name]
+            self.assertEqual(content, data)
+            self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(info.compress_size, len(data))
+        self.assertLess(len(archive), 2 * len(data) + 1024)
+
+    def test_compressible_file_is_deflated(self):
+        data = b'epoch,loss\n' + b''.join([b'%d,0.5\n' % index for index in range(50000)])
+        self.write('metrics.csv', data)
+
+        archive, contents = self.zip()
+
+        info, content = contents['metrics.csv']
+        self.assertEqual(content, data)
+        self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+        self.assertLess(info.compress_size, len(data) / 2)
+
+    def test_incompressible_blocks_after_a_compressible_one_are_not_inflated(self):
+        data = b'a' * 64 * 1024 + os.urandom(256 * 1024)
+        self.write('mixed.dat', data)
+
+        archive, contents = self.zip()
+
+        info, content = contents['mixed.dat']
+        self.assertEqual(content, data)
+        self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+        self.assertLessEqual(info.compress_size, len(data))
+
+if __name__ == '__main__':
+    unittest.main()